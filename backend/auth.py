@@ -1,31 +1,69 @@
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Callable, Optional
+import hashlib
+import logging
 import os
+import secrets
+import threading
+import time
 
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import delete, event, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from database import get_db
+from cache import LRUCache
+from database import SessionLocal, get_async_db, get_db
 import models
 import schemas
 
 SECRET_KEY = os.getenv("SECRET_KEY", "default-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+# Expired and revoked refresh tokens are kept this long before being
+# purged, so a replayed rotated-out token still revokes its family.
+REFRESH_TOKEN_RETENTION_DAYS = int(os.getenv("REFRESH_TOKEN_RETENTION_DAYS", "7"))
+# How often RefreshTokenPurger runs; 0 disables it (e.g. when a scheduled
+# `python cli.py purge-tokens` does the job instead).
+REFRESH_TOKEN_PURGE_INTERVAL_SECONDS = float(os.getenv("REFRESH_TOKEN_PURGE_INTERVAL_SECONDS", "3600"))
+
+logger = logging.getLogger(__name__)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/users/login")
 
+# Verified token -> AuthenticatedUser. Entries live for at most
+# AUTH_CACHE_TTL_SECONDS and never beyond the token's own expiry.
+USER_CACHE = LRUCache("auth", int(os.getenv("AUTH_CACHE_SIZE", "10000")))
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+@dataclass(frozen=True)
+class AuthenticatedUser:
+    """The verified caller's identity and profile, detached from any session."""
 
+    id: int
+    email: str
+    body_weight: Optional[float]
+    age: Optional[int]
+    gender: Optional[models.GenderEnum]
+    vo2max: Optional[float]
+    created_at: Optional[datetime]
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    @classmethod
+    def from_model(cls, user: models.User) -> "AuthenticatedUser":
+        return cls(
+            id=user.id,
+            email=user.email,
+            body_weight=user.body_weight,
+            age=user.age,
+            gender=user.gender,
+            vo2max=user.vo2max,
+            created_at=user.created_at,
+        )
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
@@ -39,24 +77,146 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
-def get_current_user(
-    token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
-) -> models.User:
-    credentials_exception = HTTPException(
+def hash_refresh_token(token: str) -> str:
+    # Refresh tokens are 256 random bits, so a fast hash is sufficient; no
+    # need to pay for bcrypt on every refresh.
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_refresh_token(db: Session, user_id: int, family_id: Optional[str] = None) -> str:
+    """Issue a refresh token for ``user_id``. The caller commits ``db``."""
+    token = secrets.token_urlsafe(32)
+    db.add(
+        models.RefreshToken(
+            user_id=user_id,
+            token_hash=hash_refresh_token(token),
+            family_id=family_id or secrets.token_hex(16),
+            expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        )
+    )
+    return token
+
+
+def revoke_refresh_token_family(db: Session, family_id: str) -> None:
+    db.query(models.RefreshToken).filter(
+        models.RefreshToken.family_id == family_id,
+        models.RefreshToken.revoked_at.is_(None),
+    ).update({models.RefreshToken.revoked_at: datetime.utcnow()}, synchronize_session=False)
+
+
+def purge_refresh_tokens(db: Session, now: Optional[datetime] = None) -> int:
+    """Delete tokens expired or revoked before the retention period.
+
+    Returns the number deleted. The caller commits ``db``.
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(days=REFRESH_TOKEN_RETENTION_DAYS)
+    result = db.execute(
+        delete(models.RefreshToken).where(
+            or_(models.RefreshToken.expires_at < cutoff, models.RefreshToken.revoked_at < cutoff)
+        )
+    )
+    return result.rowcount
+
+
+class RefreshTokenPurger:
+    """Periodically purges stale refresh tokens on a background thread."""
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session] = SessionLocal,
+        interval: float = REFRESH_TOKEN_PURGE_INTERVAL_SECONDS,
+    ):
+        self.session_factory = session_factory
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="refresh-token-purger", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            db = self.session_factory()
+            try:
+                purge_refresh_tokens(db)
+                db.commit()
+            except Exception:
+                logger.exception("Failed to purge refresh tokens")
+                db.rollback()
+            finally:
+                db.close()
+            self._stopping.wait(self.interval)
+
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+def _decode_token(token: str) -> tuple[schemas.TokenData, dict]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(email=email)
+            raise _credentials_exception()
+        return schemas.TokenData(email=email), payload
     except JWTError:
-        raise credentials_exception
-    
-    user = db.query(models.User).filter(models.User.email == token_data.email).first()
+        raise _credentials_exception()
+
+
+def _remember(token: str, payload: dict, user: Optional[models.User]) -> AuthenticatedUser:
     if user is None:
-        raise credentials_exception
-    return user
+        raise _credentials_exception()
+    identity = AuthenticatedUser.from_model(user)
+    ttl = AUTH_CACHE_TTL_SECONDS
+    if payload.get("exp") is not None:
+        ttl = min(ttl, payload["exp"] - time.time())
+    USER_CACHE.set(token, identity, ttl=ttl)
+    return identity
+
+
+def get_current_user(
+    token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
+) -> AuthenticatedUser:
+    """Resolve the bearer token to a user.
+
+    Tokens that were already verified are answered from ``USER_CACHE``
+    without touching the database.
+    """
+    cached = USER_CACHE.get(token)
+    if cached is not None:
+        return cached
+
+    token_data, payload = _decode_token(token)
+    user = db.query(models.User).filter(models.User.email == token_data.email).first()
+    return _remember(token, payload, user)
+
+
+async def get_current_user_async(
+    token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)
+) -> AuthenticatedUser:
+    """``get_current_user`` for async routes; shares the same cache."""
+    cached = USER_CACHE.get(token)
+    if cached is not None:
+        return cached
+
+    token_data, payload = _decode_token(token)
+    result = await db.execute(select(models.User).where(models.User.email == token_data.email))
+    return _remember(token, payload, result.scalars().first())
+
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _invalidate_cached_user(mapper, connection, target: models.User) -> None:
+    # Only covers changes made through the ORM in this process; other
+    # workers pick them up once their entries expire.
+    USER_CACHE.discard_where(lambda _, user: user.id == target.id)
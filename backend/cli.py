@@ -0,0 +1,172 @@
+"""Administrative commands, run from the backend directory.
+
+    python cli.py export --format csv --from 2024-01-01 > uploads.csv
+    python cli.py rebuild-stats
+    python cli.py migrate
+    python cli.py recompress --compression zstd
+    python cli.py purge-tokens
+"""
+import argparse
+import sys
+import time
+from datetime import datetime
+
+from database import SessionLocal, engine
+
+
+def export_uploads(args: argparse.Namespace) -> int:
+    import export
+
+    if args.format == "parquet" and export.pyarrow is None:
+        print("Parquet export requires pyarrow", file=sys.stderr)
+        return 1
+    query = export.build_query(
+        user_id=args.user_id,
+        start=args.start,
+        end=args.end,
+        session_type=args.session_type,
+    )
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    db = SessionLocal()
+    try:
+        for chunk in export.stream(db, query, args.format):
+            out.write(chunk)
+    finally:
+        db.close()
+        if args.output:
+            out.close()
+    return 0
+
+
+def rebuild_stats(args: argparse.Namespace) -> int:
+    import user_stats
+
+    db = SessionLocal()
+    try:
+        counted = user_stats.rebuild(db, user_id=args.user_id)
+        db.commit()
+    finally:
+        db.close()
+    print(f"Rebuilt statistics from {counted} uploads", file=sys.stderr)
+    return 0
+
+
+def migrate(args: argparse.Namespace) -> int:
+    import migrations
+
+    with engine.connect() as connection:
+        current = migrations.current_version(connection)
+    if args.status:
+        print(f"Schema at version {current}, latest is {migrations.head()}")
+        return 0
+    applied = migrations.upgrade(engine, target=args.to)
+    for version in applied:
+        step = next(m for m in migrations.MIGRATIONS if m.version == version)
+        print(f"Applied {version}: {step.description}", file=sys.stderr)
+    print(f"Schema at version {max(applied, default=current)}", file=sys.stderr)
+    return 0
+
+
+def recompress(args: argparse.Namespace) -> int:
+    import models
+    import storage
+    from routers.uploads import UPLOAD_DIR
+    from sqlalchemy import select
+
+    compression = storage.resolve_compression(args.compression)
+    db = SessionLocal()
+    done = saved = 0
+    try:
+        # Keyset over content_hash, so blobs finished meanwhile aren't revisited.
+        last = ""
+        while args.limit is None or done < args.limit:
+            hashes = db.scalars(
+                select(models.Blob.content_hash)
+                .where(models.Blob.compression != compression, models.Blob.content_hash > last)
+                .order_by(models.Blob.content_hash)
+                .limit(100)
+            ).all()
+            if not hashes:
+                break
+            for last in hashes:
+                change = storage.recompress_blob(db, UPLOAD_DIR, last, compression)
+                if change is not None:
+                    done += 1
+                    saved -= change
+                    if done == args.limit:
+                        break
+                time.sleep(args.pause)
+    finally:
+        db.close()
+    print(f"Recompressed {done} blobs with {compression}, saving {saved / 2**20:.1f} MiB",
+          file=sys.stderr)
+    return 0
+
+
+def purge_tokens(args: argparse.Namespace) -> int:
+    import auth
+
+    db = SessionLocal()
+    try:
+        purged = auth.purge_refresh_tokens(db)
+        db.commit()
+    finally:
+        db.close()
+    print(f"Purged {purged} expired or revoked refresh tokens", file=sys.stderr)
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Trail Log administration")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Export upload metadata of every user")
+    export_parser.add_argument("--format", choices=["ndjson", "csv", "parquet"], default="ndjson")
+    export_parser.add_argument("--user-id", type=int, help="Only this user's uploads")
+    export_parser.add_argument("--from", dest="start", type=datetime.fromisoformat,
+                               help="Uploaded at or after (ISO 8601)")
+    export_parser.add_argument("--to", dest="end", type=datetime.fromisoformat,
+                               help="Uploaded before (ISO 8601)")
+    export_parser.add_argument("--session-type", choices=["race", "training", "recovery"])
+    export_parser.add_argument("--output", "-o", help="Write to a file instead of stdout")
+    export_parser.set_defaults(func=export_uploads)
+
+    stats_parser = commands.add_parser(
+        "rebuild-stats", help="Recompute the per-user summary statistics from scratch"
+    )
+    stats_parser.add_argument("--user-id", type=int, help="Only rebuild this user's statistics")
+    stats_parser.set_defaults(func=rebuild_stats)
+
+    migrate_parser = commands.add_parser(
+        "migrate", help="Bring the database schema up to date"
+    )
+    migrate_parser.add_argument("--to", type=int, help="Stop at this version")
+    migrate_parser.add_argument("--status", action="store_true",
+                                help="Only print the current and latest versions")
+    migrate_parser.set_defaults(func=migrate)
+
+    recompress_parser = commands.add_parser(
+        "recompress", help="Rewrite stored blobs with another compression, while the app runs"
+    )
+    recompress_parser.add_argument("--compression", choices=["none", "zstd", "gzip"],
+                                   default="zstd")
+    recompress_parser.add_argument("--limit", type=int, help="Stop after this many blobs")
+    recompress_parser.add_argument("--pause", type=float, default=0.0,
+                                   help="Seconds to sleep between blobs, to throttle I/O")
+    recompress_parser.set_defaults(func=recompress)
+
+    purge_parser = commands.add_parser(
+        "purge-tokens", help="Delete refresh tokens expired or revoked beyond the retention period"
+    )
+    purge_parser.set_defaults(func=purge_tokens)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
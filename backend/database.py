@@ -1,13 +1,70 @@
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from dbpool import PoolMetrics, TimedAsyncQueuePool, TimedQueuePool
+
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/traillog")
 
-engine = create_engine(DATABASE_URL)
+# Serve the hottest routes (list_uploads, register, login) from async
+# handlers on an asyncio engine instead of the threadpool.
+DB_ASYNC = os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes")
+
+
+def _async_url(url: str) -> str:
+    if url.startswith(("postgresql://", "postgresql+psycopg2://")):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url.split("://", 1)[1]
+    return url
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", _async_url(DATABASE_URL))
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+# Seconds after which connections are replaced; -1 keeps them forever.
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+
+
+def _engine_options(url: str, poolclass) -> dict:
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    # SQLite keeps SQLAlchemy's default pools, which take no sizing.
+    if make_url(url).get_backend_name() != "sqlite":
+        options.update(
+            poolclass=poolclass,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+    return options
+
+
+engine = create_engine(DATABASE_URL, **_engine_options(DATABASE_URL, TimedQueuePool))
+PoolMetrics("sync", engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Only built when enabled, so the async driver stays optional.
+async_engine = (
+    create_async_engine(
+        ASYNC_DATABASE_URL, **_engine_options(ASYNC_DATABASE_URL, TimedAsyncQueuePool)
+    )
+    if DB_ASYNC
+    else None
+)
+if async_engine is not None:
+    PoolMetrics("async", async_engine.sync_engine)
+AsyncSessionLocal = (
+    async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    if DB_ASYNC
+    else None
+)
+
 Base = declarative_base()
 
 
@@ -17,3 +74,13 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def get_session_factory():
+    """For streaming responses, which outlive the request's own session."""
+    return SessionLocal
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
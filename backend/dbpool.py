@@ -0,0 +1,122 @@
+"""Connection pool instrumentation.
+
+Pool events keep running counts of checkouts and connections. Queue pools
+are additionally subclassed to time how long each checkout waited for a
+free connection, which is what reveals an undersized pool.
+"""
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Every instrumented engine, so their statistics can be reported together.
+POOLS: dict[str, "PoolMetrics"] = {}
+
+
+class _TimedCheckout:
+    """Mixin recording how long ``_do_get`` blocks on the pool."""
+
+    metrics: Optional["PoolMetrics"] = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.observe_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        if self.metrics is not None:
+            self.metrics.observe_wait(time.perf_counter() - start)
+        return conn
+
+    def recreate(self):
+        # engine.dispose() swaps in a fresh pool; keep reporting into the
+        # same metrics.
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+class PoolMetrics:
+    """Checkout statistics for one engine's connection pool."""
+
+    def __init__(self, name: str, engine: Engine):
+        self.name = name
+        self.engine = engine
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+        if isinstance(engine.pool, _TimedCheckout):
+            engine.pool.metrics = self
+        POOLS[name] = self
+
+    def _on_connect(self, dbapi_connection, connection_record) -> None:
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def _on_checkin(self, dbapi_connection, connection_record) -> None:
+        with self._lock:
+            self.checked_out = max(0, self.checked_out - 1)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception) -> None:
+        with self._lock:
+            self.invalidations += 1
+
+    def observe_wait(self, seconds: float, timed_out: bool = False) -> None:
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def stats(self) -> dict:
+        pool = self.engine.pool
+        size = pool.size() if isinstance(pool, QueuePool) else None
+        with self._lock:
+            return {
+                "pool": type(pool).__name__,
+                "size": size,
+                "max_overflow": getattr(pool, "_max_overflow", None),
+                "checked_out": self.checked_out,
+                "peak_checked_out": self.peak_checked_out,
+                "overflow": None if size is None else max(0, self.checked_out - size),
+                "peak_overflow": None if size is None else max(0, self.peak_checked_out - size),
+                "checkouts": self.checkouts,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+                "wait_seconds_avg": self.wait_seconds_total / self.waits if self.waits else 0.0,
+            }
@@ -0,0 +1,164 @@
+"""Serving stored upload files with HTTP range requests.
+
+``BlobResponse`` streams a file a chunk at a time, whole or as the byte
+ranges of a ``Range`` header (``multipart/byteranges`` for several). An
+uncompressed blob is read with ``os.pread`` on a worker thread, or handed
+to the server with the ASGI ``http.response.zerocopy`` extension when the
+server offers it, so its bytes never pass through Python. Compressed blobs
+are decompressed as they are sent; ranges are served in one forward pass.
+"""
+import io
+import os
+import re
+import secrets
+from typing import BinaryIO, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from storage import CHUNK_SIZE
+
+# More ranges than this in one request are ignored and the whole file sent.
+MAX_RANGES = int(os.getenv("DOWNLOAD_MAX_RANGES", "16"))
+
+_RANGE = re.compile(r"^(\d*)-(\d*)$")
+
+
+def parse_range(header: str, size: int) -> Optional[list[tuple[int, int]]]:
+    """The satisfiable ``(first, last)`` byte ranges of a ``Range`` header.
+
+    Overlapping and adjacent ranges are merged, in ascending order. Returns
+    None when the header must be ignored (another unit, malformed or too
+    many ranges) and an empty list when no range is satisfiable.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    parts = [part.strip() for part in spec.split(",") if part.strip()]
+    if not parts or len(parts) > MAX_RANGES:
+        return None
+    for part in parts:
+        match = _RANGE.match(part)
+        if match is None or match.group(1) == match.group(2) == "":
+            return None
+        first, last = match.groups()
+        if first == "":
+            # A suffix: the final ``last`` bytes.
+            if int(last) > 0 and size > 0:
+                ranges.append((max(0, size - int(last)), size - 1))
+            continue
+        if last != "" and int(last) < int(first):
+            return None
+        if int(first) < size:
+            ranges.append((int(first), min(int(last), size - 1) if last else size - 1))
+
+    merged: list[tuple[int, int]] = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+class BlobResponse(Response):
+    """A stored file, whole or as byte ranges. Closes ``src`` when done."""
+
+    def __init__(
+        self,
+        src: BinaryIO,
+        size: int,
+        ranges: Optional[list[tuple[int, int]]] = None,
+        headers: Optional[dict] = None,
+        media_type: str = "application/octet-stream",
+    ):
+        super().__init__(status_code=200, headers=headers, media_type=None)
+        self.src = src
+        self.size = size
+        self.media_type = media_type
+        self.headers["accept-ranges"] = "bytes"
+        if ranges is None:
+            self.parts = [(0, size - 1, b"")] if size else []
+            self.headers["content-type"] = media_type
+        elif not ranges:
+            self.status_code = 416
+            self.parts = []
+            self.headers["content-range"] = f"bytes */{size}"
+        elif len(ranges) == 1:
+            self.status_code = 206
+            first, last = ranges[0]
+            self.parts = [(first, last, b"")]
+            self.headers["content-type"] = media_type
+            self.headers["content-range"] = f"bytes {first}-{last}/{size}"
+        else:
+            self.status_code = 206
+            boundary = secrets.token_hex(16)
+            self.parts = [
+                (
+                    first,
+                    last,
+                    f"\r\n--{boundary}\r\nContent-Type: {media_type}\r\n"
+                    f"Content-Range: bytes {first}-{last}/{size}\r\n\r\n".encode(),
+                )
+                for first, last in ranges
+            ]
+            self.trailer = f"\r\n--{boundary}--\r\n".encode()
+            self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        length = sum(last - first + 1 + len(head) for first, last, head in self.parts)
+        if len(self.parts) > 1:
+            length += len(self.trailer)
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            })
+            if scope["method"] != "HEAD":
+                await self._send_parts(scope, send)
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            self.src.close()
+
+    async def _send_parts(self, scope: Scope, send: Send) -> None:
+        # Only a plain file has a descriptor holding the original bytes.
+        raw = isinstance(self.src, io.BufferedReader)
+        zerocopy = raw and "http.response.zerocopy" in scope.get("extensions", {})
+        position = 0
+        for first, last, head in self.parts:
+            if head:
+                await send({"type": "http.response.body", "body": head, "more_body": True})
+            if zerocopy:
+                await send({
+                    "type": "http.response.zerocopy",
+                    "file": self.src,
+                    "offset": first,
+                    "count": last - first + 1,
+                    "more_body": True,
+                })
+                continue
+            if not raw:
+                # Decompressed streams only go forward; ranges are ascending.
+                while position < first:
+                    skipped = await run_in_threadpool(self.src.read, min(CHUNK_SIZE, first - position))
+                    if not skipped:
+                        raise RuntimeError("Blob is shorter than its recorded size")
+                    position += len(skipped)
+            offset = first
+            while offset <= last:
+                count = min(CHUNK_SIZE, last - offset + 1)
+                if raw:
+                    chunk = await run_in_threadpool(os.pread, self.src.fileno(), count, offset)
+                else:
+                    chunk = await run_in_threadpool(self.src.read, count)
+                if not chunk:
+                    raise RuntimeError("Blob is shorter than its recorded size")
+                offset += len(chunk)
+                position = offset
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        if len(self.parts) > 1:
+            await send({"type": "http.response.body", "body": self.trailer, "more_body": True})
@@ -0,0 +1,68 @@
+"""Downsampling of activity series for charting.
+
+Both methods return the indices of the samples to keep rather than new
+values, so callers can gather every channel at the selected positions and
+the chosen points are always real measurements.
+"""
+import numpy as np
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets selection of ``n_out`` samples.
+
+    Keeps the visual shape of the series, including isolated peaks. NaN
+    samples are never selected.
+    """
+    finite = np.flatnonzero(~np.isnan(y))
+    if n_out >= len(finite) or n_out < 3:
+        return finite
+    return finite[_lttb(x[finite].astype(np.float64), y[finite].astype(np.float64), n_out)]
+
+
+def _lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    n = len(x)
+    # The first and last samples are always kept; the rest are split into
+    # n_out - 2 buckets, each contributing the point forming the largest
+    # triangle with the previous pick and the next bucket's average.
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    starts = np.append(edges[:-1], n - 1)
+    counts = np.diff(np.append(starts, n))
+    avg_x = np.add.reduceat(x, starts) / counts
+    avg_y = np.add.reduceat(y, starts) / counts
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        ax, ay = x[a], y[a]
+        area = np.abs(
+            (ax - avg_x[i + 1]) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (avg_y[i + 1] - ay)
+        )
+        a = lo + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def min_max(y: np.ndarray, n_out: int) -> np.ndarray:
+    """Keep the minimum and maximum of each of ``n_out // 2`` equal buckets."""
+    finite = np.flatnonzero(~np.isnan(y))
+    buckets = n_out // 2
+    if n_out >= len(finite) or buckets < 1:
+        return finite
+    values = y[finite]
+    bucket = (np.arange(len(finite)) * buckets) // len(finite)
+    # Sorting by (bucket, value) puts each bucket's minimum first and its
+    # maximum last.
+    order = np.lexsort((values, bucket))
+    bounds = np.flatnonzero(np.diff(bucket[order])) + 1
+    firsts = np.concatenate(([0], bounds))
+    lasts = np.concatenate((bounds - 1, [len(order) - 1]))
+    return np.unique(finite[order[np.concatenate((firsts, lasts))]])
+
+
+METHODS = {
+    "lttb": lambda x, y, n_out: lttb(x, y, n_out),
+    "minmax": lambda x, y, n_out: min_max(y, n_out),
+}
@@ -0,0 +1,179 @@
+"""Streaming export of upload metadata as NDJSON, CSV or Parquet.
+
+Rows are read through a server-side cursor in batches of
+``EXPORT_BATCH_SIZE`` and encoded batch by batch, so memory use does not
+grow with the number of rows exported.
+"""
+import csv
+import enum
+import io
+import json
+import os
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+
+from sqlalchemy import Select, select
+from sqlalchemy.orm import Session
+
+import models
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet export is optional.
+    pyarrow = None
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+COLUMNS = [
+    models.Upload.id,
+    models.Upload.user_id,
+    models.Upload.filename,
+    models.Upload.content_hash,
+    models.Upload.upload_date,
+    models.Upload.session_type,
+    models.Upload.race_name,
+    models.Upload.notes,
+    models.Upload.fatigue_level,
+    models.Upload.general_sensation,
+    models.Upload.sleep_quality,
+    models.Upload.hydration_status,
+    models.Upload.weather_condition,
+    models.Upload.trail_condition,
+]
+FIELDS = [column.key for column in COLUMNS]
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def build_query(
+    user_id: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    session_type: Optional[str] = None,
+) -> Select:
+    """Select the exported columns, optionally filtered, in id order.
+
+    ``start`` is inclusive and ``end`` exclusive.
+    """
+    query = select(*COLUMNS).order_by(models.Upload.id)
+    if user_id is not None:
+        query = query.where(models.Upload.user_id == user_id)
+    if start is not None:
+        query = query.where(models.Upload.upload_date >= start)
+    if end is not None:
+        query = query.where(models.Upload.upload_date < end)
+    if session_type is not None:
+        query = query.where(models.Upload.session_type == session_type)
+    return query
+
+
+def iter_batches(db: Session, query: Select) -> Iterator[list[tuple]]:
+    """Yield the query's rows in lists of at most ``EXPORT_BATCH_SIZE``.
+
+    ``yield_per`` makes PostgreSQL stream the result through a server-side
+    cursor instead of buffering it in the client.
+    """
+    result = db.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for partition in result.partitions():
+        yield [tuple(row) for row in partition]
+
+
+def _plain(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def encode_ndjson(batches: Iterable[list[tuple]]) -> Iterator[bytes]:
+    for batch in batches:
+        yield "".join(
+            json.dumps(dict(zip(FIELDS, map(_plain, row)))) + "\n" for row in batch
+        ).encode()
+
+
+def encode_csv(batches: Iterable[list[tuple]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for batch in batches:
+        writer.writerows([_plain(value) for value in row] for row in batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _Chunks(io.RawIOBase):
+    """Write-only sink that hands back whatever has been written so far."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _parquet_schema():
+    string = pyarrow.string()
+    return pyarrow.schema([
+        ("id", pyarrow.int64()),
+        ("user_id", pyarrow.int64()),
+        ("filename", string),
+        ("content_hash", string),
+        ("upload_date", pyarrow.timestamp("us", tz="UTC")),
+        ("session_type", string),
+        ("race_name", string),
+        ("notes", string),
+        ("fatigue_level", pyarrow.int8()),
+        ("general_sensation", pyarrow.int8()),
+        ("sleep_quality", pyarrow.int8()),
+        ("hydration_status", string),
+        ("weather_condition", string),
+        ("trail_condition", string),
+    ])
+
+
+def encode_parquet(batches: Iterable[list[tuple]]) -> Iterator[bytes]:
+    """Write one Parquet row group per batch. Requires pyarrow."""
+    schema = _parquet_schema()
+    sink = _Chunks()
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for batch in batches:
+            columns = [
+                [value.value if isinstance(value, enum.Enum) else value for value in column]
+                for column in zip(*batch)
+            ]
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema,
+            ))
+            yield sink.drain()
+    yield sink.drain()
+
+
+ENCODERS = {
+    "ndjson": encode_ndjson,
+    "csv": encode_csv,
+    "parquet": encode_parquet,
+}
+
+
+def stream(db: Session, query: Select, fmt: str) -> Iterator[bytes]:
+    return ENCODERS[fmt](iter_batches(db, query))
@@ -0,0 +1,459 @@
+"""Streaming decoder for FIT activity files.
+
+Data messages are decoded straight into one typed ``array.array`` per field
+instead of one dict per record, so a multi-hour activity is held in a
+handful of contiguous buffers rather than tens of thousands of objects.
+Values are kept in their raw FIT representation (semicircles, scaled
+integers, invalid sentinels); ``FieldInfo`` carries the scale, offset and
+units needed to convert them.
+"""
+import array
+import os
+import struct
+from dataclasses import dataclass, field
+from typing import BinaryIO, Optional, Union
+
+# Seconds between the Unix epoch and the FIT epoch (1989-12-31T00:00:00Z).
+FIT_EPOCH_OFFSET = 631065600
+
+# Bytes requested from the source per read.
+READ_SIZE = 64 * 1024
+
+TIMESTAMP_FIELD = 253
+FIELD_DESCRIPTION_MESG = 206
+
+# Base type number -> (struct code, array typecode, invalid value). Strings
+# and byte arrays have no fixed-width representation and are kept as lists.
+_BASE_TYPES = {
+    0x00: ("B", "B", 0xFF),  # enum
+    0x01: ("b", "b", 0x7F),  # sint8
+    0x02: ("B", "B", 0xFF),  # uint8
+    0x03: ("h", "h", 0x7FFF),  # sint16
+    0x04: ("H", "H", 0xFFFF),  # uint16
+    0x05: ("i", "i", 0x7FFFFFFF),  # sint32
+    0x06: ("I", "I", 0xFFFFFFFF),  # uint32
+    0x07: (None, None, None),  # string
+    0x08: ("f", "f", float("nan")),  # float32
+    0x09: ("d", "d", float("nan")),  # float64
+    0x0A: ("B", "B", 0x00),  # uint8z
+    0x0B: ("H", "H", 0x0000),  # uint16z
+    0x0C: ("I", "I", 0x00000000),  # uint32z
+    0x0D: (None, None, None),  # byte
+    0x0E: ("q", "q", 0x7FFFFFFFFFFFFFFF),  # sint64
+    0x0F: ("Q", "Q", 0xFFFFFFFFFFFFFFFF),  # uint64
+    0x10: ("Q", "Q", 0x0000000000000000),  # uint64z
+}
+
+
+class FitError(ValueError):
+    """Raised when a file is not a well-formed FIT file."""
+
+
+@dataclass(frozen=True)
+class FieldInfo:
+    name: str
+    scale: float = 1
+    offset: float = 0
+    units: str = ""
+
+
+# Global message number -> (message name, {field number: FieldInfo}). Only
+# the messages and fields the backend uses are named; everything else is
+# still decoded under a generic ``mesg_<n>`` / ``field_<n>`` name.
+PROFILE: dict[int, tuple[str, dict[int, FieldInfo]]] = {
+    0: ("file_id", {
+        0: FieldInfo("type"),
+        1: FieldInfo("manufacturer"),
+        2: FieldInfo("product"),
+        3: FieldInfo("serial_number"),
+        4: FieldInfo("time_created", units="s"),
+    }),
+    18: ("session", {
+        253: FieldInfo("timestamp", units="s"),
+        2: FieldInfo("start_time", units="s"),
+        5: FieldInfo("sport"),
+        7: FieldInfo("total_elapsed_time", scale=1000, units="s"),
+        8: FieldInfo("total_timer_time", scale=1000, units="s"),
+        9: FieldInfo("total_distance", scale=100, units="m"),
+        11: FieldInfo("total_calories", units="kcal"),
+        16: FieldInfo("avg_heart_rate", units="bpm"),
+        17: FieldInfo("max_heart_rate", units="bpm"),
+        22: FieldInfo("total_ascent", units="m"),
+        23: FieldInfo("total_descent", units="m"),
+    }),
+    19: ("lap", {
+        253: FieldInfo("timestamp", units="s"),
+        2: FieldInfo("start_time", units="s"),
+        7: FieldInfo("total_elapsed_time", scale=1000, units="s"),
+        8: FieldInfo("total_timer_time", scale=1000, units="s"),
+        9: FieldInfo("total_distance", scale=100, units="m"),
+    }),
+    20: ("record", {
+        253: FieldInfo("timestamp", units="s"),
+        0: FieldInfo("position_lat", units="semicircles"),
+        1: FieldInfo("position_long", units="semicircles"),
+        2: FieldInfo("altitude", scale=5, offset=500, units="m"),
+        3: FieldInfo("heart_rate", units="bpm"),
+        4: FieldInfo("cadence", units="rpm"),
+        5: FieldInfo("distance", scale=100, units="m"),
+        6: FieldInfo("speed", scale=1000, units="m/s"),
+        7: FieldInfo("power", units="watts"),
+        13: FieldInfo("temperature", units="C"),
+        73: FieldInfo("enhanced_speed", scale=1000, units="m/s"),
+        78: FieldInfo("enhanced_altitude", scale=5, offset=500, units="m"),
+    }),
+    21: ("event", {
+        253: FieldInfo("timestamp", units="s"),
+        0: FieldInfo("event"),
+        1: FieldInfo("event_type"),
+    }),
+    34: ("activity", {
+        253: FieldInfo("timestamp", units="s"),
+        1: FieldInfo("num_sessions"),
+        2: FieldInfo("type"),
+    }),
+    206: ("field_description", {
+        0: FieldInfo("developer_data_index"),
+        1: FieldInfo("field_definition_number"),
+        2: FieldInfo("fit_base_type_id"),
+        3: FieldInfo("field_name"),
+        8: FieldInfo("units"),
+    }),
+    207: ("developer_data_id", {
+        3: FieldInfo("developer_data_index"),
+    }),
+}
+
+_TIMESTAMP_INFO = PROFILE[20][1][TIMESTAMP_FIELD]
+
+
+@dataclass
+class FileHeader:
+    header_size: int
+    protocol_version: int
+    profile_version: int
+    data_size: int
+
+
+class MessageColumns:
+    """All data messages of one global message type, stored column-wise.
+
+    Every column has one entry per message. Messages whose definition
+    lacks a field get that field's invalid value (``None`` for list
+    columns), so columns always stay aligned.
+    """
+
+    def __init__(self, name: str, global_number: int):
+        self.name = name
+        self.global_number = global_number
+        self.columns: dict[str, Union[array.array, list]] = {}
+        self.fields: dict[str, FieldInfo] = {}
+        self.count = 0
+        self._fill: dict[str, object] = {}
+        # Definitions appending to these columns, rebound when one is replaced.
+        self._definitions: list["_Definition"] = []
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.columns
+
+    def __getitem__(self, name: str) -> Union[array.array, list]:
+        return self.columns[name]
+
+    def invalid_value(self, name: str):
+        return self._fill[name]
+
+    def _column(self, info: FieldInfo, typecode: Optional[str], invalid):
+        column = self.columns.get(info.name)
+        if column is None:
+            if typecode is None:
+                column = [None] * self.count
+                invalid = None
+            else:
+                column = array.array(typecode, [invalid]) * self.count
+            self.columns[info.name] = column
+            self.fields[info.name] = info
+            self._fill[info.name] = invalid
+        elif isinstance(column, array.array) and column.typecode != typecode:
+            # Two definitions disagree on the field's type; fall back to a
+            # plain list rather than risk truncating values.
+            fill = self._fill[info.name]
+            column = [None if value == fill else value for value in column]
+            self.columns[info.name] = column
+            self._fill[info.name] = None
+            for definition in self._definitions:
+                definition.rebind(info.name, column)
+        return column
+
+
+@dataclass
+class FitFile:
+    headers: list[FileHeader] = field(default_factory=list)
+    messages: dict[str, MessageColumns] = field(default_factory=dict)
+
+    def __getitem__(self, name: str) -> MessageColumns:
+        return self.messages[name]
+
+    @property
+    def records(self) -> MessageColumns:
+        return self.messages.get("record") or MessageColumns("record", 20)
+
+
+class _Definition:
+    __slots__ = (
+        "message", "struct", "size", "appenders", "converters", "names",
+        "timestamp_index", "invalids", "_missing",
+    )
+
+    def __init__(self, message: MessageColumns, fields, dev_fields, endian, descriptions):
+        self.message = message
+        self.appenders = []
+        self.converters = []
+        self.names = []
+        self.invalids = []
+        self.timestamp_index = None
+        self._missing = {}
+        message._definitions.append(self)
+        profile = PROFILE.get(message.global_number, ("", {}))[1]
+
+        codes = [endian]
+        entries = [(num, size, base, profile.get(num) or FieldInfo(f"field_{num}"))
+                   for num, size, base in fields]
+        for dev_index, num, size in dev_fields:
+            description = descriptions.get((dev_index, num))
+            if description is None:
+                entries.append((None, size, 0x0D, FieldInfo(f"developer_{dev_index}_{num}")))
+            else:
+                name, base, units = description
+                entries.append((None, size, base, FieldInfo(name, units=units)))
+
+        for i, (num, size, base, info) in enumerate(entries):
+            code, typecode, invalid = _BASE_TYPES.get(base & 0x1F, (None, None, None))
+            if code is not None and struct.calcsize(code) == size:
+                codes.append(code)
+            else:
+                codes.append(f"{size}s")
+                self.converters.append((i, _converter(base & 0x1F, code, size, endian)))
+                typecode = None
+            if num == TIMESTAMP_FIELD:
+                self.timestamp_index = i
+            column = message._column(info, typecode, invalid)
+            self.names.append(info.name)
+            self.invalids.append(invalid if typecode is not None else None)
+            self.appenders.append(_appender(column, self.invalids[i]))
+
+        self.struct = struct.Struct("".join(codes))
+        self.size = self.struct.size
+
+    def rebind(self, name: str, column: list) -> None:
+        """Append ``name`` to ``column``, which replaced its old array."""
+        for i, field_name in enumerate(self.names):
+            if field_name == name:
+                self.appenders[i] = _appender(column, self.invalids[i])
+        self._missing.clear()
+
+    def missing(self, compressed: bool):
+        """Appenders and fill values for message columns this definition lacks."""
+        width = len(self.message.columns)
+        cached = self._missing.get(compressed)
+        if cached is None or cached[0] != width:
+            present = set(self.names)
+            if compressed:
+                present.add(_TIMESTAMP_INFO.name)
+            fills = [
+                (column.append, self.message._fill[name])
+                for name, column in self.message.columns.items()
+                if name not in present
+            ]
+            cached = (width, fills)
+            self._missing[compressed] = cached
+        return cached[1]
+
+
+def _appender(column, invalid):
+    if isinstance(column, list) and invalid is not None:
+        # List columns mark invalid values with None, whatever their width.
+        append = column.append
+        return lambda value: append(None if value == invalid else value)
+    return column.append
+
+
+def _converter(base: int, code: Optional[str], size: int, endian: str):
+    if base == 0x07:
+        return lambda raw: raw.split(b"\0", 1)[0].decode("utf-8", "replace")
+    if code is not None and size % struct.calcsize(code) == 0:
+        unpack = struct.Struct(endian + code * (size // struct.calcsize(code))).unpack
+        return unpack
+    return bytes
+
+
+class _Decoder:
+    def __init__(self, src: BinaryIO):
+        self.src = src
+        self.buf = b""
+        self.pos = 0
+
+    def _ensure(self, n: int) -> None:
+        """Make at least ``n`` unread bytes available in the buffer."""
+        available = len(self.buf) - self.pos
+        if available >= n:
+            return
+        parts = [self.buf[self.pos:]]
+        while available < n:
+            chunk = self.src.read(max(READ_SIZE, n - available))
+            if not chunk:
+                raise FitError("Unexpected end of file")
+            parts.append(chunk)
+            available += len(chunk)
+        self.buf = b"".join(parts)
+        self.pos = 0
+
+    def _at_eof(self) -> bool:
+        if self.pos < len(self.buf):
+            return False
+        chunk = self.src.read(READ_SIZE)
+        if not chunk:
+            return True
+        self.buf, self.pos = chunk, 0
+        return False
+
+    def run(self) -> FitFile:
+        result = FitFile()
+        # A FIT stream may contain several files chained back to back.
+        while not self._at_eof():
+            header = self._read_header()
+            result.headers.append(header)
+            self._read_messages(header.data_size, result)
+            self._ensure(2)  # file CRC
+            self.pos += 2
+        if not result.headers:
+            raise FitError("Empty file")
+        return result
+
+    def _read_header(self) -> FileHeader:
+        self._ensure(12)
+        header_size = self.buf[self.pos]
+        if header_size < 12:
+            raise FitError("Invalid FIT header size")
+        self._ensure(header_size)
+        protocol_version, profile_version, data_size, signature = struct.unpack_from(
+            "<BHI4s", self.buf, self.pos + 1
+        )
+        if signature != b".FIT":
+            raise FitError("Missing .FIT signature")
+        self.pos += header_size
+        return FileHeader(header_size, protocol_version, profile_version, data_size)
+
+    def _read_messages(self, data_size: int, result: FitFile) -> None:
+        definitions: dict[int, _Definition] = {}
+        descriptions: dict[tuple[int, int], tuple[str, int, str]] = {}
+        messages = result.messages
+        last_timestamp = 0
+        remaining = data_size
+
+        while remaining > 0:
+            self._ensure(1)
+            header = self.buf[self.pos]
+            self.pos += 1
+            remaining -= 1
+
+            if header & 0x80:
+                compressed = True
+                local = (header >> 5) & 0x03
+            elif header & 0x40:
+                definition, length = self._read_definition(header, messages, descriptions)
+                definitions[header & 0x0F] = definition
+                remaining -= length
+                continue
+            else:
+                compressed = False
+                local = header & 0x0F
+
+            definition = definitions.get(local)
+            if definition is None:
+                raise FitError(f"Data message for undefined local type {local}")
+
+            self._ensure(definition.size)
+            values = definition.struct.unpack_from(self.buf, self.pos)
+            self.pos += definition.size
+            remaining -= definition.size
+
+            if definition.converters:
+                values = list(values)
+                for i, convert in definition.converters:
+                    values[i] = convert(values[i])
+            for append, value in zip(definition.appenders, values):
+                append(value)
+
+            message = definition.message
+            if compressed:
+                offset = header & 0x1F
+                timestamp = (last_timestamp & ~0x1F) + offset
+                if offset < (last_timestamp & 0x1F):
+                    timestamp += 0x20
+                last_timestamp = timestamp
+                message._column(_TIMESTAMP_INFO, "I", 0xFFFFFFFF).append(timestamp)
+            elif definition.timestamp_index is not None:
+                timestamp = values[definition.timestamp_index]
+                if timestamp != 0xFFFFFFFF:
+                    last_timestamp = timestamp
+
+            for append, fill in definition.missing(compressed):
+                append(fill)
+            message.count += 1
+
+            if message.global_number == FIELD_DESCRIPTION_MESG:
+                self._register_description(dict(zip(definition.names, values)), descriptions)
+
+        if remaining < 0:
+            raise FitError("Message crosses the end of the data section")
+
+    def _read_definition(self, header: int, messages, descriptions):
+        self._ensure(5)
+        _, architecture, num_fields = struct.unpack_from("<BBxxB", self.buf, self.pos)
+        endian = ">" if architecture else "<"
+        global_number = struct.unpack_from(endian + "H", self.buf, self.pos + 2)[0]
+        self.pos += 5
+        length = 5
+
+        self._ensure(num_fields * 3)
+        raw = self.buf[self.pos:self.pos + num_fields * 3]
+        fields = [tuple(raw[i:i + 3]) for i in range(0, len(raw), 3)]
+        self.pos += num_fields * 3
+        length += num_fields * 3
+
+        dev_fields = []
+        if header & 0x20:
+            self._ensure(1)
+            num_dev = self.buf[self.pos]
+            self.pos += 1
+            self._ensure(num_dev * 3)
+            raw = self.buf[self.pos:self.pos + num_dev * 3]
+            # (developer data index, field number, size)
+            dev_fields = [(raw[i + 2], raw[i], raw[i + 1]) for i in range(0, len(raw), 3)]
+            self.pos += num_dev * 3
+            length += 1 + num_dev * 3
+
+        name = PROFILE.get(global_number, (f"mesg_{global_number}",))[0]
+        message = messages.get(name)
+        if message is None:
+            message = messages[name] = MessageColumns(name, global_number)
+        return _Definition(message, fields, dev_fields, endian, descriptions), length
+
+    @staticmethod
+    def _register_description(values: dict, descriptions) -> None:
+        key = (values.get("developer_data_index"), values.get("field_definition_number"))
+        if None in key:
+            return
+        name = values.get("field_name") or f"developer_{key[0]}_{key[1]}"
+        descriptions[key] = (name, values.get("fit_base_type_id", 0x0D), values.get("units") or "")
+
+
+def decode(source: Union[str, os.PathLike, BinaryIO]) -> FitFile:
+    """Decode a FIT file from a path or a binary file object."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return _Decoder(f).run()
+    return _Decoder(source).run()
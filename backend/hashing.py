@@ -0,0 +1,105 @@
+"""Password hashing on a dedicated, bounded process pool.
+
+bcrypt is deliberately slow. Running it on the request threadpool lets a
+burst of logins occupy every worker thread and starve cheap endpoints, so
+hashes are computed in separate processes instead (which also sidesteps
+the GIL). At most ``PASSWORD_HASH_MAX_PENDING`` hashes may be queued or
+running; beyond that ``HashingBusy`` is raised so the route can answer 503
+immediately. The routes await the ``_async`` functions, so a queued hash
+holds no request thread while it waits.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Optional
+
+from passlib.context import CryptContext
+
+# Work factor for new hashes. Hashes made with a different cost are
+# transparently rehashed on the next successful login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_PENDING = int(
+    os.getenv("PASSWORD_HASH_MAX_PENDING", str(4 * max(1, PASSWORD_HASH_WORKERS)))
+)
+RETRY_AFTER_SECONDS = 1
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full."""
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+_executor: Optional[Executor] = None
+_executor_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(max(1, PASSWORD_HASH_MAX_PENDING))
+
+
+def _get_executor() -> Executor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=max(1, PASSWORD_HASH_WORKERS),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def _submit(fn, *args) -> Future:
+    if not _pending.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        future = _get_executor().submit(fn, *args)
+    except BaseException:
+        _pending.release()
+        raise
+    future.add_done_callback(lambda _: _pending.release())
+    return future
+
+
+async def _submit_async(fn, *args):
+    if PASSWORD_HASH_WORKERS <= 0:
+        # Without a pool, hash on a thread rather than the event loop.
+        return await asyncio.to_thread(fn, *args)
+    return await asyncio.wrap_future(_submit(fn, *args))
+
+
+async def hash_password_async(password: str) -> str:
+    return await _submit_async(_hash, password)
+
+
+async def verify_password_async(
+    password: str, hashed_password: str
+) -> tuple[bool, Optional[str]]:
+    """Check a password, returning ``(valid, new_hash)``.
+
+    ``new_hash`` is set when the stored hash uses an outdated cost and
+    should be replaced.
+    """
+    return await _submit_async(_verify_and_update, password, hashed_password)
+
+
+def shutdown() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
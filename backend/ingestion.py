@@ -0,0 +1,285 @@
+"""Background ingestion of uploaded FIT files.
+
+The upload route only records an ``IngestionJob``. ``IngestionWorker``
+polls for queued jobs, claims them and parses the files in a process pool
+so decoding runs on every core without holding up request threads.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import fit
+import models
+import series
+import storage
+
+logger = logging.getLogger(__name__)
+
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", str(os.cpu_count() or 1)))
+MAX_ATTEMPTS = int(os.getenv("INGESTION_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF_SECONDS = float(os.getenv("INGESTION_RETRY_BACKOFF_SECONDS", "5"))
+POLL_INTERVAL_SECONDS = float(os.getenv("INGESTION_POLL_INTERVAL_SECONDS", "1"))
+# Jobs left running this long (e.g. by a worker that died) are requeued.
+STALE_JOB_SECONDS = float(os.getenv("INGESTION_STALE_JOB_SECONDS", "600"))
+# How often the worker looks for such jobs.
+REQUEUE_INTERVAL_SECONDS = float(os.getenv("INGESTION_REQUEUE_INTERVAL_SECONDS", "60"))
+
+
+def enqueue(db: Session, upload: models.Upload) -> models.IngestionJob:
+    """Queue ``upload`` for parsing. The caller commits ``db``."""
+    job = models.IngestionJob(upload=upload, state=models.JobStateEnum.queued)
+    db.add(job)
+    return job
+
+
+def enqueue_many(db: Session, upload_ids: list[int]) -> None:
+    """Queue several uploads with a single bulk insert. The caller commits ``db``."""
+    if upload_ids:
+        db.execute(
+            insert(models.IngestionJob),
+            [{"upload_id": upload_id, "state": models.JobStateEnum.queued} for upload_id in upload_ids],
+        )
+
+
+def claim_next_job(db: Session) -> Optional[tuple[int, str, str]]:
+    """Claim the oldest runnable job, returning its id, file path and compression.
+
+    On PostgreSQL the candidate row is locked with ``FOR UPDATE SKIP
+    LOCKED`` so concurrent workers never wait on each other. SQLite ignores
+    the locking clause; there the conditional ``UPDATE`` is what guarantees
+    a job is only claimed once.
+    """
+    now = datetime.utcnow()
+    job_id = db.execute(
+        select(models.IngestionJob.id)
+        .where(
+            models.IngestionJob.state == models.JobStateEnum.queued,
+            models.IngestionJob.next_attempt_at <= now,
+        )
+        .order_by(models.IngestionJob.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).scalar()
+    if job_id is None:
+        db.rollback()
+        return None
+
+    claimed = db.execute(
+        update(models.IngestionJob)
+        .where(
+            models.IngestionJob.id == job_id,
+            models.IngestionJob.state == models.JobStateEnum.queued,
+        )
+        .values(
+            state=models.JobStateEnum.running,
+            attempts=models.IngestionJob.attempts + 1,
+            started_at=now,
+        )
+    ).rowcount
+    db.commit()
+    if not claimed:
+        return None
+
+    filepath, compression = db.execute(
+        select(models.Upload.filepath, models.Upload.compression)
+        .join(models.IngestionJob, models.IngestionJob.upload_id == models.Upload.id)
+        .where(models.IngestionJob.id == job_id)
+    ).one()
+    return job_id, filepath, compression
+
+
+def complete_job(db: Session, job_id: int, result: dict) -> None:
+    db.execute(
+        update(models.IngestionJob)
+        .where(models.IngestionJob.id == job_id)
+        .values(
+            state=models.JobStateEnum.done,
+            record_count=result["record_count"],
+            error=None,
+            finished_at=datetime.utcnow(),
+        )
+    )
+    db.commit()
+
+
+def fail_job(db: Session, job_id: int, error: str) -> None:
+    """Record a failed attempt, requeueing with exponential backoff."""
+    job = db.get(models.IngestionJob, job_id)
+    if job is None:
+        return
+    job.error = error[:1000]
+    if job.attempts < MAX_ATTEMPTS:
+        job.state = models.JobStateEnum.queued
+        job.next_attempt_at = datetime.utcnow() + timedelta(
+            seconds=RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+        )
+    else:
+        job.state = models.JobStateEnum.failed
+        job.finished_at = datetime.utcnow()
+    db.commit()
+
+
+def requeue_stale_jobs(db: Session) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=STALE_JOB_SECONDS)
+    requeued = db.execute(
+        update(models.IngestionJob)
+        .where(
+            models.IngestionJob.state == models.JobStateEnum.running,
+            models.IngestionJob.started_at < cutoff,
+        )
+        .values(state=models.JobStateEnum.queued, next_attempt_at=datetime.utcnow())
+    ).rowcount
+    db.commit()
+    return requeued
+
+
+def process_file(filepath: str, compression: str = "none") -> dict:
+    """Parse one file and build its series sidecar.
+
+    Runs in a worker process, so it must not touch the DB. Blobs are shared
+    between duplicate uploads, so an existing sidecar is reused as is.
+    Compressed blobs are decoded as they are decompressed.
+    """
+    if series.Series.exists(filepath):
+        return {"record_count": series.Series(filepath).length}
+    with storage.open_blob(filepath, compression) as src:
+        activity = fit.decode(src)
+    return {"record_count": series.write_series(activity, filepath)}
+
+
+def run_pending(session_factory: Callable[[], Session] = SessionLocal) -> int:
+    """Process every runnable job inline. Returns the number of jobs run."""
+    processed = 0
+    db = session_factory()
+    try:
+        while True:
+            claimed = claim_next_job(db)
+            if claimed is None:
+                return processed
+            job_id, filepath, compression = claimed
+            try:
+                result = process_file(filepath, compression)
+            except Exception as exc:
+                fail_job(db, job_id, f"{type(exc).__name__}: {exc}")
+            else:
+                complete_job(db, job_id, result)
+            processed += 1
+    finally:
+        db.close()
+
+
+class IngestionWorker:
+    """Polls for queued jobs and runs them on a process pool."""
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session] = SessionLocal,
+        max_workers: int = INGESTION_WORKERS,
+        executor: Optional[Executor] = None,
+    ):
+        self.session_factory = session_factory
+        self.max_workers = max_workers
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._executor is None:
+            self._executor = self._new_executor()
+        db = self.session_factory()
+        try:
+            requeue_stale_jobs(db)
+        finally:
+            db.close()
+        self._thread = threading.Thread(target=self._run, name="ingestion-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _new_executor(self) -> Executor:
+        # Spawn rather than fork: the API process is multi-threaded.
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def _run(self) -> None:
+        db = self.session_factory()
+        next_requeue = time.monotonic() + REQUEUE_INTERVAL_SECONDS
+        try:
+            while not self._stopping.is_set():
+                if time.monotonic() >= next_requeue:
+                    next_requeue = time.monotonic() + REQUEUE_INTERVAL_SECONDS
+                    try:
+                        requeue_stale_jobs(db)
+                    except Exception:
+                        logger.exception("Failed to requeue stale ingestion jobs")
+                        db.rollback()
+                if not self._slots.acquire(timeout=POLL_INTERVAL_SECONDS):
+                    continue
+                try:
+                    claimed = claim_next_job(db)
+                except Exception:
+                    logger.exception("Failed to claim ingestion job")
+                    db.rollback()
+                    claimed = None
+                if claimed is None:
+                    self._slots.release()
+                    self._stopping.wait(POLL_INTERVAL_SECONDS)
+                    continue
+                job_id, filepath, compression = claimed
+                try:
+                    future = self._executor.submit(process_file, filepath, compression)
+                except Exception as exc:
+                    self._submit_failed(db, job_id, exc)
+                    continue
+                future.add_done_callback(lambda f, job_id=job_id: self._finish(job_id, f))
+        finally:
+            db.close()
+
+    def _submit_failed(self, db: Session, job_id: int, exc: Exception) -> None:
+        """Give back a claimed job that never reached the pool, and its slot."""
+        logger.exception("Failed to submit ingestion job %s", job_id)
+        try:
+            fail_job(db, job_id, f"{type(exc).__name__}: {exc}")
+        except Exception:
+            logger.exception("Failed to record failure of ingestion job %s", job_id)
+            db.rollback()
+        finally:
+            self._slots.release()
+        if isinstance(exc, BrokenProcessPool) and self._owns_executor:
+            # A worker process died (e.g. OOM-killed); the pool is unusable.
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._new_executor()
+
+    def _finish(self, job_id: int, future: Future) -> None:
+        db = self.session_factory()
+        try:
+            try:
+                result = future.result()
+            except Exception as exc:
+                fail_job(db, job_id, f"{type(exc).__name__}: {exc}")
+            else:
+                complete_job(db, job_id, result)
+        except Exception:
+            logger.exception("Failed to record result of ingestion job %s", job_id)
+        finally:
+            db.close()
+            self._slots.release()
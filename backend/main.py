@@ -1,29 +1,53 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import text
-
-from database import engine, Base
-from routers import users, uploads
-
-# Create database tables
-Base.metadata.create_all(bind=engine)
-
-# create_all() skips tables that already exist, so it won't add new
-# indexes to a database that was provisioned before they were introduced.
-# Ensure they exist explicitly.
-with engine.connect() as connection:
-    connection.execute(
-        text("CREATE INDEX IF NOT EXISTS ix_uploads_user_id ON uploads (user_id)")
-    )
-    connection.execute(
-        text("CREATE INDEX IF NOT EXISTS ix_uploads_upload_date ON uploads (upload_date)")
-    )
-    connection.commit()
+
+import auth
+from database import engine
+import hashing
+import ingestion
+import migrations
+import resumable
+from responses import TimedJSONResponse
+from routers import metrics, users, uploads
+from telemetry import MetricsMiddleware
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Normally a single query; DDL only runs when the schema is behind.
+    migrations.ensure_current(engine)
+    # Parse uploaded files in the background unless disabled with
+    # INGESTION_WORKERS=0 (e.g. when a separate process runs the workers).
+    worker = None
+    if ingestion.INGESTION_WORKERS > 0:
+        worker = ingestion.IngestionWorker()
+        worker.start()
+    reaper = None
+    if resumable.REAP_INTERVAL_SECONDS > 0:
+        reaper = resumable.SessionReaper(uploads.UPLOAD_DIR)
+        reaper.start()
+    purger = None
+    if auth.REFRESH_TOKEN_PURGE_INTERVAL_SECONDS > 0:
+        purger = auth.RefreshTokenPurger()
+        purger.start()
+    yield
+    if purger is not None:
+        purger.stop()
+    if reaper is not None:
+        reaper.stop()
+    if worker is not None:
+        worker.stop()
+    hashing.shutdown()
+
 
 app = FastAPI(
     title="Trail Fit Uploader API",
     description="API for uploading and managing .fit files",
     version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=TimedJSONResponse,
 )
 
 # CORS middleware for frontend
@@ -33,11 +57,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "X-Next-Cursor", "ETag", "Location", "Upload-Offset", "Upload-Length", "Server-Timing",
+        "Accept-Ranges", "Content-Range", "Content-Disposition", "Last-Modified",
+    ],
 )
+# Outermost, so its timings include the other middleware.
+app.add_middleware(MetricsMiddleware)
 
 # Include routers
 app.include_router(users.router)
 app.include_router(uploads.router)
+app.include_router(metrics.router)
 
 
 @app.get("/")
@@ -0,0 +1,246 @@
+"""Versioned schema migrations.
+
+``MIGRATIONS`` is applied in order by ``upgrade``, which records each
+version in ``schema_version``. Run it with ``python cli.py migrate``, or
+let app startup do it: ``ensure_current`` reads the version with a single
+query and, when the schema is behind and ``MIGRATE_ON_STARTUP`` is set,
+migrates. On PostgreSQL ``upgrade`` holds an advisory lock, so when
+several workers start at once one of them migrates and the others wait,
+then find nothing to do. SQLite has no such lock: migrate with the CLI
+before starting several workers on one database file.
+
+Migration 1 creates every table of the current models and the later ones
+only bring databases provisioned before them up to date, so each must be
+idempotent. New columns or indexes on existing tables need a migration of
+their own; new tables need one that creates them.
+"""
+import logging
+import os
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from sqlalchemy import (
+    Column, DateTime, Integer, MetaData, String, Table, exc, func, inspect, select, text,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from database import Base
+import models  # noqa: F401  (registers the tables on Base.metadata)
+import search
+import user_stats
+
+logger = logging.getLogger(__name__)
+
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+# pg_advisory_lock key shared by every process migrating the database.
+ADVISORY_LOCK_KEY = 72_617_169
+
+_version_metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    _version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block.
+    transactional: bool = True
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, description: str, transactional: bool = True):
+    def register(fn):
+        assert not MIGRATIONS or MIGRATIONS[-1].version < version, "migrations must be in order"
+        MIGRATIONS.append(Migration(version, description, fn, transactional))
+        return fn
+    return register
+
+
+def add_column(connection: Connection, table: str, column: str, ddl: str) -> None:
+    if column not in {c["name"] for c in inspect(connection).get_columns(table)}:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def create_index(
+    connection: Connection, name: str, table: str, columns: str, where: Optional[str] = None
+) -> None:
+    """Create an index unless it exists, without blocking writes on PostgreSQL.
+
+    Run from a non-transactional migration. A concurrent build that failed
+    leaves an invalid index behind, which is dropped and rebuilt. ``where``
+    makes it a partial index.
+    """
+    predicate = f" WHERE {where}" if where else ""
+    if connection.dialect.name != "postgresql":
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns}){predicate}"))
+        return
+    invalid = connection.scalar(text(
+        "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+    ), {"name": name})
+    if invalid:
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    connection.execute(text(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns}){predicate}"
+    ))
+
+
+@migration(1, "Create tables")
+def _create_tables(connection: Connection) -> None:
+    Base.metadata.create_all(bind=connection)
+
+
+@migration(2, "Add uploads.content_hash")
+def _add_content_hash(connection: Connection) -> None:
+    add_column(connection, "uploads", "content_hash", "VARCHAR(64)")
+
+
+@migration(3, "Add user_stats.uploads_version")
+def _add_uploads_version(connection: Connection) -> None:
+    add_column(connection, "user_stats", "uploads_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(4, "Index uploads for listing and deduplication", transactional=False)
+def _index_uploads(connection: Connection) -> None:
+    create_index(connection, "ix_uploads_user_id", "uploads", "user_id")
+    create_index(connection, "ix_uploads_upload_date", "uploads", "upload_date")
+    create_index(connection, "ix_uploads_content_hash", "uploads", "content_hash")
+    create_index(
+        connection, "ix_uploads_user_id_upload_date_id", "uploads", "user_id, upload_date DESC, id DESC"
+    )
+
+
+@migration(5, "Record blob compression")
+def _add_compression(connection: Connection) -> None:
+    for table in ("blobs", "uploads"):
+        add_column(connection, table, "compression", "VARCHAR(8) NOT NULL DEFAULT 'none'")
+    add_column(connection, "blobs", "stored_size", "BIGINT")
+    add_column(connection, "uploads", "original_size", "BIGINT")
+    connection.execute(text(
+        "UPDATE uploads SET original_size = "
+        "(SELECT size FROM blobs WHERE blobs.content_hash = uploads.content_hash) "
+        "WHERE original_size IS NULL"
+    ))
+
+
+@migration(6, "Full-text search over race names and notes", transactional=False)
+def _add_search(connection: Connection) -> None:
+    # On PostgreSQL adding the generated column rewrites uploads once.
+    search.install(connection, concurrently=True)
+
+
+@migration(7, "Index uploads for filtered listing", transactional=False)
+def _index_upload_filters(connection: Connection) -> None:
+    create_index(
+        connection,
+        "ix_uploads_user_id_session_type_upload_date_id",
+        "uploads",
+        "user_id, session_type, upload_date DESC, id DESC",
+    )
+    for name, column in (("weather", "weather_condition"), ("trail", "trail_condition")):
+        create_index(
+            connection,
+            f"ix_uploads_user_id_{name}_upload_date_id",
+            "uploads",
+            f"user_id, {column}, upload_date DESC, id DESC",
+            where=f"{column} IS NOT NULL",
+        )
+
+
+@migration(8, "Backfill upload statistics")
+def _backfill_user_stats(connection: Connection) -> None:
+    # The statistics tables were created empty beside existing uploads;
+    # count those once so totals are right and deleting them can't
+    # drive the counts negative.
+    db = Session(bind=connection)
+    try:
+        user_stats.rebuild(db)
+        db.flush()
+    finally:
+        db.close()
+
+
+def head() -> int:
+    return MIGRATIONS[-1].version
+
+
+def current_version(connection: Connection) -> int:
+    """The applied version, 0 for a database that predates ``schema_version``."""
+    if not inspect(connection).has_table("schema_version"):
+        return 0
+    return connection.scalar(select(func.max(schema_version.c.version))) or 0
+
+
+def upgrade(engine: Engine, target: Optional[int] = None) -> list[int]:
+    """Apply the migrations after the current version, up to ``target``.
+
+    Returns the versions applied.
+    """
+    target = head() if target is None else target
+    with engine.connect() as lock:
+        postgres = engine.dialect.name == "postgresql"
+        if postgres:
+            lock.execute(select(func.pg_advisory_lock(ADVISORY_LOCK_KEY)))
+            lock.commit()
+        try:
+            _version_metadata.create_all(bind=lock)
+            lock.commit()
+            current = current_version(lock)
+            lock.rollback()
+            applied = []
+            for step in MIGRATIONS:
+                if current < step.version <= target:
+                    _apply(engine, step)
+                    applied.append(step.version)
+            return applied
+        finally:
+            if postgres:
+                lock.execute(select(func.pg_advisory_unlock(ADVISORY_LOCK_KEY)))
+                lock.commit()
+
+
+def _apply(engine: Engine, step: Migration) -> None:
+    logger.info("Applying migration %d: %s", step.version, step.description)
+    record = schema_version.insert().values(version=step.version, description=step.description)
+    if step.transactional:
+        with engine.begin() as connection:
+            step.upgrade(connection)
+            connection.execute(record)
+        return
+    with engine.connect() as connection:
+        step.upgrade(connection.execution_options(isolation_level="AUTOCOMMIT"))
+    with engine.begin() as connection:
+        connection.execute(record)
+
+
+def ensure_current(engine: Engine, migrate: bool = MIGRATE_ON_STARTUP) -> None:
+    """Check the schema at startup, migrating it only when it is behind."""
+    with engine.connect() as connection:
+        try:
+            version = connection.scalar(select(func.max(schema_version.c.version))) or 0
+        except exc.DBAPIError:
+            # No schema_version table yet.
+            connection.rollback()
+            version = 0
+    if version >= head():
+        return
+    if not migrate:
+        raise SchemaOutOfDate(
+            f"Database schema is at version {version}, expected {head()}; "
+            "run `python cli.py migrate`"
+        )
+    upgrade(engine)
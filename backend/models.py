@@ -1,10 +1,20 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum as SQLEnum
+from sqlalchemy import BigInteger, Column, Date, Index, Integer, JSON, String, Float, DateTime, ForeignKey, Enum as SQLEnum
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
 from database import Base
+from datetime import datetime
 import enum
 
 
+# SQLite fills CURRENT_TIMESTAMP defaults without fractional seconds, but
+# bound datetimes are stored with them, so string comparisons on the two
+# disagree (e.g. keyset pagination on upload_date). Store both alike.
+_SQLiteSecondsDateTime = sqlite.DATETIME(
+    storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"
+)
+
+
 class GenderEnum(str, enum.Enum):
     male = "male"
     female = "female"
@@ -41,6 +51,13 @@ class TrailConditionEnum(str, enum.Enum):
     mixed = "mixed"
 
 
+class JobStateEnum(str, enum.Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -58,12 +75,59 @@ class User(Base):
 
 class Upload(Base):
     __tablename__ = "uploads"
+    __table_args__ = (
+        # Serves list_uploads' keyset pagination in index order.
+        Index(
+            "ix_uploads_user_id_upload_date_id",
+            "user_id",
+            text("upload_date DESC"),
+            text("id DESC"),
+        ),
+        # The filtered lists, again in keyset order. Most uploads have no
+        # weather or trail condition, so those indexes leave them out.
+        Index(
+            "ix_uploads_user_id_session_type_upload_date_id",
+            "user_id",
+            "session_type",
+            text("upload_date DESC"),
+            text("id DESC"),
+        ),
+        Index(
+            "ix_uploads_user_id_weather_upload_date_id",
+            "user_id",
+            "weather_condition",
+            text("upload_date DESC"),
+            text("id DESC"),
+            postgresql_where=text("weather_condition IS NOT NULL"),
+            sqlite_where=text("weather_condition IS NOT NULL"),
+        ),
+        Index(
+            "ix_uploads_user_id_trail_upload_date_id",
+            "user_id",
+            "trail_condition",
+            text("upload_date DESC"),
+            text("id DESC"),
+            postgresql_where=text("trail_condition IS NOT NULL"),
+            sqlite_where=text("trail_condition IS NOT NULL"),
+        ),
+    )
+    # Load server defaults (upload_date) with RETURNING on insert, so the
+    # summary statistics can bucket new uploads without a refresh.
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     filename = Column(String, nullable=False)
     filepath = Column(String, nullable=False)
-    upload_date = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    content_hash = Column(String(64), nullable=True, index=True)
+    # How the file at filepath is compressed, and its uncompressed size.
+    compression = Column(String(8), nullable=False, default="none", server_default="none")
+    original_size = Column(BigInteger, nullable=True)
+    upload_date = Column(
+        DateTime(timezone=True).with_variant(_SQLiteSecondsDateTime, "sqlite"),
+        server_default=func.now(),
+        index=True,
+    )
 
     # Session metadata
     session_type = Column(SQLEnum(SessionTypeEnum), nullable=True)
@@ -81,3 +145,111 @@ class Upload(Base):
     trail_condition = Column(SQLEnum(TrailConditionEnum), nullable=True)
 
     owner = relationship("User", back_populates="uploads")
+    ingestion_jobs = relationship(
+        "IngestionJob", back_populates="upload", cascade="all, delete-orphan"
+    )
+
+
+class _UploadAggregates:
+    """Running totals over a set of uploads, maintained by ``user_stats``."""
+
+    upload_count = Column(Integer, nullable=False, default=0)
+    race_count = Column(Integer, nullable=False, default=0)
+    training_count = Column(Integer, nullable=False, default=0)
+    recovery_count = Column(Integer, nullable=False, default=0)
+    fatigue_sum = Column(Integer, nullable=False, default=0)
+    fatigue_count = Column(Integer, nullable=False, default=0)
+    sensation_sum = Column(Integer, nullable=False, default=0)
+    sensation_count = Column(Integer, nullable=False, default=0)
+    sleep_sum = Column(Integer, nullable=False, default=0)
+    sleep_count = Column(Integer, nullable=False, default=0)
+
+
+class UserStats(_UploadAggregates, Base):
+    """Summary of all of a user's uploads."""
+
+    __tablename__ = "user_stats"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    # Bumped on every change to the user's uploads; list_uploads derives
+    # its ETag from it.
+    uploads_version = Column(Integer, nullable=False, default=0)
+
+
+class UserWeeklyStats(_UploadAggregates, Base):
+    """Summary of a user's uploads in one week, starting on Monday (UTC)."""
+
+    __tablename__ = "user_weekly_stats"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    week_start = Column(Date, primary_key=True)
+
+
+class Blob(Base):
+    """A stored file body, shared by every upload with the same contents."""
+
+    __tablename__ = "blobs"
+
+    content_hash = Column(String(64), primary_key=True)  # SHA-256 hex digest
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=1)
+    # storage.SUFFIXES key; stored_size is the size on disk.
+    compression = Column(String(8), nullable=False, default="none", server_default="none")
+    stored_size = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class IngestionJob(Base):
+    """Background parsing of an uploaded file, claimed by ``ingestion`` workers."""
+
+    __tablename__ = "ingestion_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    upload_id = Column(Integer, ForeignKey("uploads.id"), nullable=False, index=True)
+    state = Column(SQLEnum(JobStateEnum), nullable=False, default=JobStateEnum.queued, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    error = Column(String, nullable=True)
+    record_count = Column(Integer, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    upload = relationship("Upload", back_populates="ingestion_jobs")
+
+
+class UploadSession(Base):
+    """A resumable upload in progress.
+
+    Bytes are appended to a partial file on disk; the ``Upload`` row is only
+    created once the client commits the finished file.
+    """
+
+    __tablename__ = "upload_sessions"
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    filename = Column(String, nullable=False)
+    length = Column(BigInteger, nullable=False)  # Declared total size in bytes
+    upload_metadata = Column(JSON, nullable=False, default=dict)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class RefreshToken(Base):
+    """A long-lived, single-use token that can be exchanged for a new access token.
+
+    Only a SHA-256 of the token is stored. Each refresh revokes the presented
+    token and issues a successor in the same family; presenting a revoked
+    token revokes the whole family.
+    """
+
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    token_hash = Column(String(64), nullable=False, unique=True, index=True)
+    family_id = Column(String(32), nullable=False, index=True)
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
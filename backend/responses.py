@@ -0,0 +1,32 @@
+"""Response classes for hot read paths."""
+import time
+
+import orjson
+from fastapi.responses import JSONResponse
+
+import telemetry
+
+
+class TimedJSONResponse(JSONResponse):
+    """The app's default JSON response, reporting render time to ``telemetry``."""
+
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = self.encode(content)
+        telemetry.record_serialize(time.perf_counter() - start)
+        return body
+
+    def encode(self, content) -> bytes:
+        return super().render(content)
+
+
+class FastJSONResponse(TimedJSONResponse):
+    """JSON rendered by orjson.
+
+    Content is encoded as given: routes returning it skip ``response_model``
+    validation, so they must already produce the documented shape. Aware
+    UTC datetimes end in ``Z``, as Pydantic renders them.
+    """
+
+    def encode(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z)
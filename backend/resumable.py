@@ -0,0 +1,111 @@
+"""Storage and expiry of resumable upload sessions.
+
+Each ``UploadSession`` owns a partial file that PATCH requests append to;
+its size on disk is the session's offset, so a dropped connection loses
+nothing that was already written. Sessions that are not committed within
+``UPLOAD_SESSION_TTL_SECONDS`` of their last write are removed by
+``SessionReaper``.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import models
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_SESSION_TTL_SECONDS = float(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(24 * 3600)))
+REAP_INTERVAL_SECONDS = float(os.getenv("UPLOAD_SESSION_REAP_INTERVAL_SECONDS", "600"))
+
+
+def partial_dir(root: str) -> str:
+    return os.path.join(root, "partial")
+
+
+def partial_path(root: str, session_id: str) -> str:
+    return os.path.join(partial_dir(root), session_id)
+
+
+def expiry() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=UPLOAD_SESSION_TTL_SECONDS)
+
+
+def remove_partial(root: str, session_id: str) -> None:
+    path = partial_path(root, session_id)
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+def purge_expired_sessions(db: Session, root: str) -> int:
+    """Delete expired sessions and their partial files. Returns the number removed."""
+    expired = db.scalars(
+        select(models.UploadSession.id).where(models.UploadSession.expires_at < datetime.utcnow())
+    ).all()
+    if expired:
+        db.execute(delete(models.UploadSession).where(models.UploadSession.id.in_(expired)))
+        db.commit()
+    for session_id in expired:
+        remove_partial(root, session_id)
+
+    # Partial files whose session row is gone (e.g. after a crash between
+    # deleting the row and the file) are removed once they are stale.
+    directory = partial_dir(root)
+    if os.path.isdir(directory):
+        cutoff = time.time() - UPLOAD_SESSION_TTL_SECONDS
+        stale = [
+            entry.name
+            for entry in os.scandir(directory)
+            if entry.is_file() and entry.stat().st_mtime < cutoff
+        ]
+        if stale:
+            live = set(
+                db.scalars(
+                    select(models.UploadSession.id).where(models.UploadSession.id.in_(stale))
+                ).all()
+            )
+            for session_id in set(stale) - live:
+                remove_partial(root, session_id)
+    return len(expired)
+
+
+class SessionReaper:
+    """Periodically purges expired upload sessions on a background thread."""
+
+    def __init__(
+        self,
+        root: str,
+        session_factory: Callable[[], Session] = SessionLocal,
+        interval: float = REAP_INTERVAL_SECONDS,
+    ):
+        self.root = root
+        self.session_factory = session_factory
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="upload-session-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            db = self.session_factory()
+            try:
+                purge_expired_sessions(db, self.root)
+            except Exception:
+                logger.exception("Failed to purge expired upload sessions")
+            finally:
+                db.close()
+            self._stopping.wait(self.interval)
@@ -0,0 +1,72 @@
+import os
+import secrets
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
+
+from cache import CACHES
+from dbpool import POOLS
+import telemetry
+
+# Shared token Prometheus (or an operator) must send as
+# ``Authorization: Bearer <token>``. Without it the endpoints are open, so
+# they must then only be reachable from the internal network.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+def require_metrics_token(authorization: Optional[str] = Header(None)) -> None:
+    if not METRICS_TOKEN:
+        return
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid metrics token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+router = APIRouter(prefix="/metrics", tags=["metrics"], dependencies=[Depends(require_metrics_token)])
+
+
+@router.get("/cache")
+def cache_metrics():
+    """Hit/miss statistics for the in-process caches."""
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+@router.get("/db")
+def db_metrics():
+    """Connection pool usage and checkout wait times per engine."""
+    return {name: pool.stats() for name, pool in POOLS.items()}
+
+
+@router.get("", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Request, database, cache and pool metrics in the Prometheus text format."""
+    extra = []
+    for stat, type_ in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                        ("expirations", "counter"), ("size", "gauge")):
+        name = f"cache_{stat}_total" if type_ == "counter" else f"cache_{stat}"
+        extra += telemetry.samples(
+            name, type_, f"In-process cache {stat}.",
+            (({"cache": cache_name}, cache.stats()[stat]) for cache_name, cache in CACHES.items()),
+        )
+    pool_stats = {name: pool.stats() for name, pool in POOLS.items()}
+    for stat, type_, help_ in (
+        ("checked_out", "gauge", "Connections currently checked out."),
+        ("overflow", "gauge", "Connections currently open beyond the pool size."),
+        ("checkouts", "counter", "Connection checkouts."),
+        ("timeouts", "counter", "Checkouts that timed out waiting for a connection."),
+        ("wait_seconds_total", "counter", "Time spent waiting for a connection."),
+    ):
+        name = f"db_pool_{stat}" + ("_total" if type_ == "counter" and not stat.endswith("_total") else "")
+        extra += telemetry.samples(
+            name, type_, help_,
+            (({"engine": engine}, stats[stat]) for engine, stats in pool_stats.items()
+             if stats[stat] is not None),
+        )
+    return PlainTextResponse(
+        telemetry.render(extra), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
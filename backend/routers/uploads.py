@@ -1,18 +1,57 @@
+import base64
+import fcntl
+import hashlib
+import json
 import os
-from datetime import datetime
+import secrets
+import zipfile
+import zlib
+from contextlib import ExitStack, contextmanager, nullcontext
+from dataclasses import astuple, dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import quote
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, status, Query
+import numpy as np
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Header, Request, Response, status, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import insert, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import Optional
+from starlette.requests import ClientDisconnect
+from typing import BinaryIO, Callable, Iterator, Optional
 
-from database import get_db
+from database import DB_ASYNC, get_async_db, get_db, get_session_factory
 import models
 import schemas
-from auth import get_current_user
+from auth import AuthenticatedUser, get_current_user, get_current_user_async
+from cache import LRUCache
+import download
+import downsample as downsampling
+import export
+import ingestion
+import resumable
+from responses import FastJSONResponse
+import search
+import series
+import user_stats
+from storage import (
+    CHUNK_SIZE, StoredFile, UploadTooLarge, acquire_blob, adopt_blob, open_blob, release_blob,
+)
 
 router = APIRouter(prefix="/api/upload", tags=["uploads"])
 
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/data/uploads")
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(200 * 1024 * 1024)))
+# Files per batch upload, counting each member of a zip archive.
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "1000"))
+
+# Downsampled sample indices keyed by
+# (upload_id, channel, window, max_points, method).
+SERIES_CACHE = LRUCache("series", int(os.getenv("SERIES_CACHE_SIZE", "2048")))
 
 
 @router.post("/", response_model=schemas.UploadResponse, status_code=status.HTTP_201_CREATED)
@@ -27,7 +66,7 @@ def upload_fit_file(
     hydration_status: Optional[str] = Form(None),
     weather_condition: Optional[str] = Form(None),
     trail_condition: Optional[str] = Form(None),
-    current_user: models.User = Depends(get_current_user),
+    current_user: AuthenticatedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """Upload a .fit file with metadata.
@@ -36,73 +75,1001 @@ def upload_fit_file(
     and synchronous database commits run in a worker thread instead of on the
     event loop.
     """
+    stored = _store_upload(db, file.filename, file.file, file.size)
+
+    # Create database record.
+    db_upload = models.Upload(
+        user_id=current_user.id,
+        filename=file.filename,
+        filepath=stored.path,
+        content_hash=stored.sha256,
+        compression=stored.compression,
+        original_size=stored.size,
+        session_type=session_type,
+        race_name=race_name,
+        notes=notes,
+        fatigue_level=fatigue_level,
+        general_sensation=general_sensation,
+        sleep_quality=sleep_quality,
+        hydration_status=hydration_status,
+        weather_condition=weather_condition,
+        trail_condition=trail_condition,
+    )
+
+    db.add(db_upload)
+    # Parsing happens in the background ingestion workers, so the request
+    # only pays for storing the file and writing a few rows.
+    ingestion.enqueue(db, db_upload)
+    db.flush()
+    user_stats.record(db, [db_upload])
+    db.commit()
+    db.refresh(db_upload)
+
+    return db_upload
+
+
+@router.post("/batch", response_model=schemas.BatchUploadResponse)
+def upload_fit_files(
+    files: list[UploadFile] = File(...),
+    metadata: Optional[str] = Form(None),
+    session_type: Optional[str] = Form(None),
+    race_name: Optional[str] = Form(None),
+    notes: Optional[str] = Form(None),
+    fatigue_level: Optional[int] = Form(None),
+    general_sensation: Optional[int] = Form(None),
+    sleep_quality: Optional[int] = Form(None),
+    hydration_status: Optional[str] = Form(None),
+    weather_condition: Optional[str] = Form(None),
+    trail_condition: Optional[str] = Form(None),
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Upload many .fit files, or zip archives of them, in one request.
+
+    The metadata form fields apply to every file. ``metadata`` may hold a
+    JSON object mapping file names to per-file overrides. Each file is
+    validated and stored on its own and reported in ``results``; the rows
+    for every stored file are then bulk-inserted in a single transaction.
+    """
+    shared = _validate_metadata(dict(
+        session_type=session_type,
+        race_name=race_name,
+        notes=notes,
+        fatigue_level=fatigue_level,
+        general_sensation=general_sensation,
+        sleep_quality=sleep_quality,
+        hydration_status=hydration_status,
+        weather_condition=weather_condition,
+        trail_condition=trail_condition,
+    ))
+    overrides = _parse_batch_overrides(metadata)
+
+    results = []
+    rows = []
+    stored_files = []
+    try:
+        with ExitStack() as archives:
+            entries = _batch_entries(files, archives)
+            if len(entries) > MAX_BATCH_FILES:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Batch exceeds maximum of {MAX_BATCH_FILES} files",
+                )
+
+            for filename, open_file, size in entries:
+                if open_file is None:
+                    results.append(schemas.BatchUploadResult(filename=filename, error="Invalid zip archive"))
+                    continue
+                try:
+                    with open_file() as src:
+                        stored = _store_upload(db, filename, src, size)
+                except HTTPException as exc:
+                    results.append(schemas.BatchUploadResult(filename=filename, error=exc.detail))
+                    continue
+                except _ARCHIVE_ERRORS:
+                    # Only zip members raise these: a failed CRC, encryption
+                    # or an unsupported compression method.
+                    results.append(schemas.BatchUploadResult(
+                        filename=filename, error="Damaged or unreadable zip member"
+                    ))
+                    continue
+                stored_files.append(stored)
+                values = shared.model_copy(update=overrides.get(filename, {})).model_dump(mode="json")
+                rows.append(dict(
+                    values,
+                    user_id=current_user.id,
+                    filename=filename,
+                    filepath=stored.path,
+                    content_hash=stored.sha256,
+                    compression=stored.compression,
+                    original_size=stored.size,
+                ))
+                results.append(schemas.BatchUploadResult(filename=filename))
+
+        if rows:
+            created = db.scalars(
+                insert(models.Upload).returning(models.Upload, sort_by_parameter_order=True),
+                rows,
+            ).all()
+            ingestion.enqueue_many(db, [upload.id for upload in created])
+            user_stats.record(db, created)
+            # Serialize before committing, which would expire the rows.
+            stored_results = (result for result in results if result.error is None)
+            for result, upload in zip(stored_results, created):
+                result.upload = schemas.UploadResponse.model_validate(upload)
+            db.commit()
+    except BaseException:
+        # The new Blob rows are rolled back; don't leave their files behind.
+        db.rollback()
+        for stored in stored_files:
+            stored.discard()
+        raise
+
+    return schemas.BatchUploadResponse(
+        created=len(rows),
+        failed=len(results) - len(rows),
+        results=results,
+    )
+
+
+def _store_upload(db: Session, filename: Optional[str], src: BinaryIO, size: Optional[int]) -> StoredFile:
+    """Validate one uploaded file and add it to the blob store."""
+    _check_filename(filename)
+
+    # Reject early when the multipart parser already knows the size.
+    if size is not None and size > MAX_UPLOAD_SIZE:
+        raise _too_large()
+
+    # Store the contents in the content-addressed blob store. Re-synced
+    # activities hash to an existing blob, so only its reference count is
+    # bumped and nothing is written to disk.
+    try:
+        return acquire_blob(db, UPLOAD_DIR, src, max_size=MAX_UPLOAD_SIZE)
+    except UploadTooLarge as exc:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File exceeds maximum size of {exc.max_size} bytes",
+        )
+
+
+def _check_filename(filename: Optional[str]) -> None:
     # Validate file extension
-    if not file.filename or not file.filename.lower().endswith(".fit"):
+    if not filename or not filename.lower().endswith(".fit"):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Only .fit files are allowed",
         )
 
     # Sanitize filename to prevent path traversal
-    safe_filename = os.path.basename(file.filename)
+    safe_filename = os.path.basename(filename)
     if not safe_filename:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid filename",
         )
 
-    # Read the upload contents from the underlying synchronous file object.
-    contents = file.file.read()
 
-    # Generate unique filename.
-    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    saved_filename = f"{timestamp}_{safe_filename}"
+def _too_large() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File exceeds maximum size of {MAX_UPLOAD_SIZE} bytes",
+    )
 
-    # Write the file to the user's upload directory.
-    user_upload_dir = os.path.join(UPLOAD_DIR, str(current_user.id))
-    filepath = os.path.join(user_upload_dir, saved_filename)
 
-    os.makedirs(user_upload_dir, exist_ok=True)
-    with open(filepath, "wb") as f:
-        f.write(contents)
+def _validate_metadata(values: dict) -> schemas.UploadMetadata:
+    try:
+        return schemas.UploadMetadata(**values)
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors())
 
-    # Create database record.
-    db_upload = models.Upload(
+
+def _parse_batch_overrides(metadata: Optional[str]) -> dict[str, dict]:
+    """Parse per-file metadata into validated, explicitly set fields by file name."""
+    if not metadata:
+        return {}
+    try:
+        raw = json.loads(metadata)
+    except ValueError:
+        raw = None
+    if not isinstance(raw, dict) or not all(isinstance(v, dict) for v in raw.values()):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="metadata must be a JSON object mapping file names to metadata objects",
+        )
+    return {
+        filename: _validate_metadata(values).model_dump(exclude_unset=True)
+        for filename, values in raw.items()
+    }
+
+
+# Raised while reading a zip member rather than opening the archive.
+_ARCHIVE_ERRORS = (zipfile.BadZipFile, RuntimeError, NotImplementedError, EOFError, zlib.error)
+
+
+def _batch_entries(
+    files: list[UploadFile], archives: ExitStack
+) -> list[tuple[str, Optional[Callable[[], BinaryIO]], Optional[int]]]:
+    """Expand a batch into ``(filename, opener, size)`` per file.
+
+    Zip archives contribute one entry per member, opened lazily so members
+    are streamed out of the archive one at a time. ``opener`` is None for
+    archives that cannot be read.
+    """
+    entries = []
+    for file in files:
+        filename = file.filename or ""
+        if not filename.lower().endswith(".zip"):
+            entries.append((filename, lambda file=file: nullcontext(file.file), file.size))
+            continue
+        try:
+            archive = archives.enter_context(zipfile.ZipFile(file.file))
+        except zipfile.BadZipFile:
+            entries.append((filename, None, file.size))
+            continue
+        for info in archive.infolist():
+            # Skip folders and the resource forks macOS adds to archives.
+            if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                continue
+            entries.append((
+                os.path.basename(info.filename),
+                lambda archive=archive, info=info: archive.open(info),
+                info.file_size,
+            ))
+    return entries
+
+
+@router.post(
+    "/sessions",
+    response_model=schemas.UploadSessionResponse,
+    status_code=status.HTTP_201_CREATED,
+)
+def create_upload_session(
+    session_in: schemas.UploadSessionCreate,
+    response: Response,
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Start a resumable upload of ``length`` bytes.
+
+    The client then PATCHes byte ranges to the returned session and commits
+    it once every byte has arrived.
+    """
+    _check_filename(session_in.filename)
+    if session_in.length > MAX_UPLOAD_SIZE:
+        raise _too_large()
+
+    upload_session = models.UploadSession(
+        id=secrets.token_hex(16),
         user_id=current_user.id,
-        filename=file.filename,
-        filepath=filepath,
-        session_type=session_type,
-        race_name=race_name,
-        notes=notes,
-        fatigue_level=fatigue_level,
-        general_sensation=general_sensation,
-        sleep_quality=sleep_quality,
-        hydration_status=hydration_status,
-        weather_condition=weather_condition,
-        trail_condition=trail_condition,
+        filename=session_in.filename,
+        length=session_in.length,
+        upload_metadata=session_in.model_dump(
+            mode="json", exclude={"filename", "length"}, exclude_none=True
+        ),
+        expires_at=resumable.expiry(),
     )
+    path = resumable.partial_path(UPLOAD_DIR, upload_session.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "xb").close()
+    db.add(upload_session)
+    db.commit()
 
+    response.headers["Location"] = f"{router.prefix}/sessions/{upload_session.id}"
+    return schemas.UploadSessionResponse(
+        id=upload_session.id,
+        filename=upload_session.filename,
+        length=upload_session.length,
+        offset=0,
+        expires_at=upload_session.expires_at,
+    )
+
+
+@router.head("/sessions/{session_id}")
+def get_upload_session_offset(
+    session_id: str,
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Report how many bytes have been received, i.e. where to resume."""
+    upload_session = _get_upload_session(db, session_id, current_user.id)
+    return Response(headers={
+        "Upload-Offset": str(os.path.getsize(resumable.partial_path(UPLOAD_DIR, session_id))),
+        "Upload-Length": str(upload_session.length),
+        "Cache-Control": "no-store",
+    })
+
+
+@router.patch("/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def append_upload_session(
+    session_id: str,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset"),
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Append the request body to a resumable upload.
+
+    ``Upload-Offset`` must match the bytes already received. An ``async``
+    route so the body is consumed as it arrives; opening, locking and
+    writing the partial file run on the threadpool. If the connection drops, everything received so far
+    is kept and the client resumes from the offset reported by HEAD.
+    """
+    upload_session = await run_in_threadpool(_get_upload_session, db, session_id, current_user.id)
+    out = await run_in_threadpool(_open_locked_partial, session_id)
+    with out:
+        offset = out.seek(0, os.SEEK_END)
+        if upload_offset != offset:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Upload-Offset does not match the bytes received",
+                headers={"Upload-Offset": str(offset)},
+            )
+
+        buffer = bytearray()
+        try:
+            async for chunk in request.stream():
+                if offset + len(buffer) + len(chunk) > upload_session.length:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail="Data exceeds the declared Upload-Length",
+                    )
+                buffer += chunk
+                if len(buffer) >= CHUNK_SIZE:
+                    await run_in_threadpool(out.write, buffer)
+                    offset += len(buffer)
+                    buffer = bytearray()
+        except ClientDisconnect:
+            pass
+        finally:
+            await run_in_threadpool(_flush_partial, out, buffer)
+        offset += len(buffer)
+
+    await run_in_threadpool(_extend_upload_session, db, upload_session)
+    return Response(
+        status_code=status.HTTP_204_NO_CONTENT,
+        headers={"Upload-Offset": str(offset)},
+    )
+
+
+@router.post(
+    "/sessions/{session_id}/commit",
+    response_model=schemas.UploadResponse,
+    status_code=status.HTTP_201_CREATED,
+)
+def commit_upload_session(
+    session_id: str,
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Turn a fully received session into an upload."""
+    upload_session = _get_upload_session(db, session_id, current_user.id)
+    with _locked_partial(session_id) as partial:
+        received = partial.seek(0, os.SEEK_END)
+        if received != upload_session.length:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Upload is incomplete",
+                headers={"Upload-Offset": str(received)},
+            )
+        # The partial file is renamed into the blob store rather than copied.
+        stored = adopt_blob(db, UPLOAD_DIR, partial.name)
+
+    db_upload = models.Upload(
+        user_id=current_user.id,
+        filename=upload_session.filename,
+        filepath=stored.path,
+        content_hash=stored.sha256,
+        compression=stored.compression,
+        original_size=stored.size,
+        **upload_session.upload_metadata,
+    )
     db.add(db_upload)
+    ingestion.enqueue(db, db_upload)
+    db.delete(upload_session)
+    db.flush()
+    user_stats.record(db, [db_upload])
     db.commit()
     db.refresh(db_upload)
-
     return db_upload
 
 
-@router.get("/", response_model=list[schemas.UploadResponse])
+@router.delete("/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_upload_session(
+    session_id: str,
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Abandon a resumable upload and discard the bytes received so far."""
+    upload_session = _get_upload_session(db, session_id, current_user.id)
+    db.delete(upload_session)
+    db.commit()
+    resumable.remove_partial(UPLOAD_DIR, session_id)
+
+
+def _get_upload_session(db: Session, session_id: str, user_id: int) -> models.UploadSession:
+    upload_session = db.get(models.UploadSession, session_id)
+    if (
+        upload_session is None
+        or upload_session.user_id != user_id
+        or upload_session.expires_at < datetime.utcnow()
+    ):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found")
+    return upload_session
+
+
+def _extend_upload_session(db: Session, upload_session: models.UploadSession) -> None:
+    upload_session.expires_at = resumable.expiry()
+    db.commit()
+
+
+@contextmanager
+def _locked_partial(session_id: str) -> Iterator[BinaryIO]:
+    """Open a session's partial file, holding an exclusive lock on it."""
+    with _open_locked_partial(session_id) as partial:
+        yield partial
+
+
+def _open_locked_partial(session_id: str) -> BinaryIO:
+    """Open a session's partial file and take an exclusive lock on it.
+
+    Serializes concurrent requests for the same session; a second writer
+    gets 423 instead of interleaving its bytes. The lock is released when
+    the returned file is closed.
+    """
+    try:
+        partial = open(resumable.partial_path(UPLOAD_DIR, session_id), "r+b")
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found")
+    try:
+        fcntl.flock(partial, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        partial.close()
+        raise HTTPException(
+            status_code=status.HTTP_423_LOCKED,
+            detail="Upload session is being written by another request",
+        )
+    return partial
+
+
+def _flush_partial(out: BinaryIO, buffer: bytes) -> None:
+    out.write(buffer)
+    out.flush()
+    os.fsync(out.fileno())
+
+
+@dataclass(frozen=True)
+class UploadFilters:
+    session_type: Optional[str] = None
+    weather_condition: Optional[str] = None
+    trail_condition: Optional[str] = None
+    hydration_status: Optional[str] = None
+    min_fatigue: Optional[int] = None
+    max_fatigue: Optional[int] = None
+    min_sleep: Optional[int] = None
+    max_sleep: Optional[int] = None
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+
+
+def upload_filters(
+    session_type: Optional[schemas.SessionTypeEnum] = None,
+    weather_condition: Optional[schemas.WeatherConditionEnum] = None,
+    trail_condition: Optional[schemas.TrailConditionEnum] = None,
+    hydration_status: Optional[schemas.HydrationStatusEnum] = None,
+    min_fatigue: Optional[int] = Query(None, ge=1, le=5),
+    max_fatigue: Optional[int] = Query(None, ge=1, le=5),
+    min_sleep: Optional[int] = Query(None, ge=1, le=5, description="Lowest sleep quality"),
+    max_sleep: Optional[int] = Query(None, ge=1, le=5, description="Highest sleep quality"),
+    start: Optional[datetime] = Query(None, alias="from", description="Uploaded at or after"),
+    end: Optional[datetime] = Query(None, alias="to", description="Uploaded before"),
+) -> UploadFilters:
+    def value(choice):
+        return choice.value if choice is not None else None
+
+    return UploadFilters(
+        value(session_type), value(weather_condition), value(trail_condition), value(hydration_status),
+        min_fatigue, max_fatigue, min_sleep, max_sleep, start, end,
+    )
+
+
+# OpenAPI for the cursor-paged lists.
+_PAGED_RESPONSES = {
+    200: {
+        "headers": {
+            "X-Next-Cursor": {
+                "description": "Present when more rows follow; pass it back as `cursor` for the next page.",
+                "schema": {"type": "string"},
+            }
+        }
+    },
+    400: {"description": "Invalid cursor"},
+}
+
+
 def list_uploads(
     skip: int = 0,
     limit: int = Query(20, le=100),
-    current_user: models.User = Depends(get_current_user),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    if_none_match: Optional[str] = Header(None),
+    current_user: AuthenticatedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
+    filters: UploadFilters = Depends(upload_filters),
 ):
-    """List all uploads for the current user."""
-    uploads = (
-        db.query(models.Upload)
-        .filter(models.Upload.user_id == current_user.id)
-        .order_by(models.Upload.upload_date.desc(), models.Upload.id.desc())
+    """List all uploads for the current user.
+
+    Pages are returned newest first. When more rows follow, the
+    ``X-Next-Cursor`` response header holds an opaque cursor to pass back as
+    ``cursor``; unlike ``skip``, seeking to it costs the same on every page
+    because it is served straight from the
+    ``(user_id, upload_date DESC, id DESC)`` index.
+
+    The optional filters narrow the list in SQL. Session type, weather and
+    trail condition each have a ``(user_id, <column>, upload_date DESC,
+    id DESC)`` index that serves them, and their cursors, in index order;
+    the remaining filters are checked against the rows those indexes
+    yield. Pass the same filters with ``cursor`` to continue a list.
+
+    Responses carry a weak ``ETag`` derived from the user's upload version.
+    A matching ``If-None-Match`` is answered with 304 after reading only
+    that version, without querying ``uploads``.
+    """
+    # Read the version before the rows: a concurrent change then yields a
+    # newer body under an older tag, costing one extra fetch, never a
+    # stale 304.
+    etag = _list_etag(
+        current_user.id, user_stats.uploads_version(db, current_user.id), skip, limit, cursor, filters
+    )
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    query = _list_uploads_query(current_user.id, skip, limit, cursor, filters)
+    return _list_response(db.execute(query).all(), limit, etag)
+
+
+async def list_uploads_async(
+    skip: int = 0,
+    limit: int = Query(20, le=100),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    if_none_match: Optional[str] = Header(None),
+    current_user: AuthenticatedUser = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
+    filters: UploadFilters = Depends(upload_filters),
+):
+    """List all uploads for the current user.
+
+    Same as ``list_uploads``, on the asyncio engine.
+    """
+    version = await user_stats.uploads_version_async(db, current_user.id)
+    etag = _list_etag(current_user.id, version, skip, limit, cursor, filters)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    query = _list_uploads_query(current_user.id, skip, limit, cursor, filters)
+    result = await db.execute(query)
+    return _list_response(result.all(), limit, etag)
+
+
+router.get(
+    "/",
+    response_model=list[schemas.UploadResponse],
+    response_class=FastJSONResponse,
+    responses=_PAGED_RESPONSES,
+)(list_uploads_async if DB_ASYNC else list_uploads)
+
+# list_uploads selects exactly the response fields, as plain rows.
+_LIST_COLUMNS = [getattr(models.Upload, name) for name in schemas.UploadResponse.model_fields]
+
+
+@router.get(
+    "/search",
+    response_model=list[schemas.UploadSearchResult],
+    response_class=FastJSONResponse,
+    responses=_PAGED_RESPONSES,
+)
+def search_uploads(
+    q: str = Query(..., min_length=1, max_length=200, description="Words to find in race names and notes"),
+    limit: int = Query(20, le=100),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Search the current user's race names and notes, best matches first.
+
+    Pages continue from ``X-Next-Cursor`` as in ``list_uploads``, keyed on
+    rank and id.
+    """
+    after = _decode_cursor(cursor, float, int) if cursor is not None else None
+    query = search.build_query(
+        db.get_bind().dialect.name, _LIST_COLUMNS, current_user.id, q, limit, after
+    )
+    rows = db.execute(query).all() if query is not None else []
+    response = FastJSONResponse([row._asdict() for row in rows[:limit]])
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        response.headers["X-Next-Cursor"] = _encode_cursor(last.rank, last.id)
+    return response
+
+
+def _list_uploads_query(
+    user_id: int, skip: int, limit: int, cursor: Optional[str], filters: UploadFilters = UploadFilters()
+):
+    upload = models.Upload
+    query = select(*_LIST_COLUMNS).where(upload.user_id == user_id)
+    for column, value in (
+        (upload.session_type, filters.session_type),
+        (upload.weather_condition, filters.weather_condition),
+        (upload.trail_condition, filters.trail_condition),
+        (upload.hydration_status, filters.hydration_status),
+    ):
+        if value is not None:
+            query = query.where(column == value)
+    for column, low, high in (
+        (upload.fatigue_level, filters.min_fatigue, filters.max_fatigue),
+        (upload.sleep_quality, filters.min_sleep, filters.max_sleep),
+    ):
+        if low is not None:
+            query = query.where(column >= low)
+        if high is not None:
+            query = query.where(column <= high)
+    if filters.start is not None:
+        query = query.where(upload.upload_date >= filters.start)
+    if filters.end is not None:
+        query = query.where(upload.upload_date < filters.end)
+    if cursor is not None:
+        upload_date, upload_id = _decode_cursor(cursor, datetime.fromisoformat, int)
+        query = query.where(
+            tuple_(models.Upload.upload_date, models.Upload.id) < (upload_date, upload_id)
+        )
+    # One extra row tells us whether another page follows.
+    return (
+        query.order_by(models.Upload.upload_date.desc(), models.Upload.id.desc())
         .offset(skip)
-        .limit(limit)
-        .all()
+        .limit(limit + 1)
     )
-    return uploads
+
+
+def _list_etag(
+    user_id: int,
+    version: int,
+    skip: int,
+    limit: int,
+    cursor: Optional[str],
+    filters: UploadFilters = UploadFilters(),
+) -> str:
+    # Distinct per user, page and filters, so switching accounts, pages or
+    # filters never revalidates against another list's cached body.
+    key = f"{skip}:{limit}:{cursor}:{astuple(filters)}"
+    page = hashlib.sha256(key.encode()).hexdigest()[:12]
+    return f'W/"{user_id}.{version}.{page}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of ``etag`` against an ``If-None-Match`` header."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def _set_etag(response: Response, etag: str) -> None:
+    response.headers["ETag"] = etag
+    # Let clients keep the list but revalidate it on every use.
+    response.headers["Cache-Control"] = "private, no-cache"
+
+
+def _not_modified(etag: str) -> Response:
+    response = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    _set_etag(response, etag)
+    return response
+
+
+def _list_response(rows: list, limit: int, etag: str) -> FastJSONResponse:
+    """Encode a page of ``_LIST_COLUMNS`` rows straight to JSON.
+
+    The rows already have the ``UploadResponse`` fields and types, so they
+    are neither hydrated as ORM objects nor re-validated by Pydantic.
+    """
+    response = FastJSONResponse([row._asdict() for row in rows[:limit]])
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        response.headers["X-Next-Cursor"] = _encode_cursor(last.upload_date.isoformat(), last.id)
+    _set_etag(response, etag)
+    return response
+
+
+def _encode_cursor(*key) -> str:
+    """Encode a page's last sort key as an opaque ``X-Next-Cursor``."""
+    raw = json.dumps(key)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str, *types: Callable) -> tuple:
+    """Decode a ``_encode_cursor`` key, converting each part with ``types``.
+
+    Any malformed cursor is answered with 400.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key = json.loads(raw)
+        if not isinstance(key, list) or len(key) != len(types):
+            raise ValueError(cursor)
+        return tuple(convert(part) for convert, part in zip(types, key))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+@router.get("/export")
+def export_uploads(
+    fmt: schemas.ExportFormat = Query(schemas.ExportFormat.ndjson, alias="format"),
+    start: Optional[datetime] = Query(None, alias="from", description="Uploaded at or after"),
+    end: Optional[datetime] = Query(None, alias="to", description="Uploaded before"),
+    session_type: Optional[schemas.SessionTypeEnum] = None,
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    session_factory=Depends(get_session_factory),
+):
+    """Stream the metadata of all of the caller's uploads.
+
+    Rows are fetched in batches with a server-side cursor and encoded as
+    they are sent, so the export runs in constant memory.
+    """
+    if fmt == schemas.ExportFormat.parquet and export.pyarrow is None:
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="Parquet export requires pyarrow",
+        )
+    query = export.build_query(
+        user_id=current_user.id,
+        start=start,
+        end=end,
+        session_type=session_type.value if session_type else None,
+    )
+
+    def body():
+        # The request's session is closed before the body is streamed.
+        db = session_factory()
+        try:
+            yield from export.stream(db, query, fmt.value)
+        finally:
+            db.close()
+
+    return StreamingResponse(
+        body(),
+        media_type=export.MEDIA_TYPES[fmt.value],
+        headers={"Content-Disposition": f'attachment; filename="uploads.{fmt.value}"'},
+    )
+
+
+@router.delete("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_upload(
+    upload_id: int,
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Delete an upload, removing its file once no other upload shares it."""
+    db_upload = (
+        db.query(models.Upload)
+        .filter(models.Upload.id == upload_id, models.Upload.user_id == current_user.id)
+        .first()
+    )
+    if db_upload is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+
+    released = legacy_path = None
+    if db_upload.content_hash is not None:
+        released = release_blob(db, UPLOAD_DIR, db_upload.content_hash)
+    else:
+        # Uploads stored before the blob store own their file outright.
+        legacy_path = db_upload.filepath
+
+    user_stats.record(db, [db_upload], sign=-1)
+    db.delete(db_upload)
+    try:
+        db.commit()
+    except Exception:
+        if released is not None:
+            released.restore()
+        raise
+
+    SERIES_CACHE.discard_where(lambda key, _: key[0] == upload_id)
+    if released is not None:
+        released.remove()
+        series.remove_series(released.path)
+    elif legacy_path is not None:
+        if os.path.exists(legacy_path):
+            os.unlink(legacy_path)
+        series.remove_series(legacy_path)
+
+
+@router.get("/{upload_id}/status", response_model=schemas.IngestionStatus)
+def get_upload_status(
+    upload_id: int,
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Report the progress of background ingestion for an upload."""
+    job = (
+        db.query(models.IngestionJob)
+        .join(models.Upload, models.IngestionJob.upload_id == models.Upload.id)
+        .filter(models.Upload.id == upload_id, models.Upload.user_id == current_user.id)
+        .order_by(models.IngestionJob.id.desc())
+        .first()
+    )
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+    return job
+
+
+@router.api_route("/{upload_id}/file", methods=["GET", "HEAD"], response_class=Response)
+def download_upload(
+    upload_id: int,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_range: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Download the original .fit file.
+
+    Honours ``Range`` (several ranges come back as ``multipart/byteranges``)
+    so interrupted downloads can resume, and ``If-None-Match`` /
+    ``If-Modified-Since`` so unchanged files cost a single query. ``HEAD``
+    returns the headers only.
+    """
+    upload = db.execute(
+        select(
+            models.Upload.filename,
+            models.Upload.filepath,
+            models.Upload.compression,
+            models.Upload.original_size,
+            models.Upload.content_hash,
+            models.Upload.upload_date,
+        ).where(models.Upload.id == upload_id, models.Upload.user_id == current_user.id)
+    ).first()
+    if upload is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+
+    try:
+        if upload.content_hash is not None:
+            # Blobs are content-addressed, so the hash is a strong validator.
+            etag = f'"{upload.content_hash}"'
+        else:
+            stat = os.stat(upload.filepath)
+            etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = upload.upload_date
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        last_modified = last_modified.replace(microsecond=0)
+
+        if if_none_match is not None:
+            unchanged = _etag_matches(if_none_match, etag)
+        else:
+            unchanged = _unmodified_since(if_modified_since, last_modified)
+        if unchanged:
+            response = _not_modified(etag)
+            response.headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+            return response
+
+        src = open_blob(upload.filepath, upload.compression)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    size = upload.original_size
+    if size is None:
+        size = os.fstat(src.fileno()).st_size
+
+    ranges = None
+    if range_header is not None and _if_range_matches(if_range, etag, last_modified):
+        ranges = download.parse_range(range_header, size)
+    response = download.BlobResponse(
+        src,
+        size,
+        ranges,
+        headers={
+            "Content-Disposition": f"attachment; filename*=utf-8''{quote(upload.filename)}",
+            "Last-Modified": format_datetime(last_modified, usegmt=True),
+        },
+    )
+    _set_etag(response, etag)
+    return response
+
+
+def _parse_http_date(value: Optional[str]) -> Optional[datetime]:
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return moment if moment.tzinfo is not None else moment.replace(tzinfo=timezone.utc)
+
+
+def _unmodified_since(if_modified_since: Optional[str], last_modified: datetime) -> bool:
+    since = _parse_http_date(if_modified_since)
+    return since is not None and last_modified <= since
+
+
+def _if_range_matches(if_range: Optional[str], etag: str, last_modified: datetime) -> bool:
+    """Whether a ``Range`` may be honoured under ``If-Range`` (strong comparison)."""
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    if if_range.startswith("W/"):
+        return False
+    return _parse_http_date(if_range) == last_modified
+
+
+@router.get("/{upload_id}/series", response_model=schemas.SeriesResponse)
+def get_upload_series(
+    upload_id: int,
+    channels: str = Query("hr,alt,pace", description="Comma-separated channel names"),
+    start: Optional[float] = Query(None, alias="from", description="Elapsed seconds"),
+    end: Optional[float] = Query(None, alias="to", description="Elapsed seconds"),
+    max_points: Optional[int] = Query(None, ge=10, le=100_000),
+    downsample: schemas.DownsampleMethod = schemas.DownsampleMethod.lttb,
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Return time-series channels for an upload, optionally limited to a window.
+
+    Channels are read from the memory-mapped sidecar built during ingestion,
+    so only the pages covering the requested window are touched. With
+    ``max_points`` the window is downsampled server-side and the selected
+    sample indices are cached; ``max_points`` bounds the whole response,
+    not each channel.
+    """
+    requested = [c.strip() for c in channels.split(",") if c.strip()]
+    unknown = [c for c in requested if c not in series.CHANNELS]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown channels: {', '.join(unknown)}",
+        )
+
+    db_upload = (
+        db.query(models.Upload)
+        .filter(models.Upload.id == upload_id, models.Upload.user_id == current_user.id)
+        .first()
+    )
+    if db_upload is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+    if not series.Series.exists(db_upload.filepath):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Series not available until ingestion has finished",
+        )
+
+    data = series.Series(db_upload.filepath)
+    window = data.window(start, end)
+    available = [name for name in requested if name in data.channels]
+
+    if max_points is not None and window.stop - window.start > max_points:
+        # Each channel picks its own points so none of their peaks are lost;
+        # the union is returned on a shared time axis.
+        budget = max(3, max_points // max(1, len(available)))
+        t = data["t"][window]
+        picks = [np.array([0, len(t) - 1])]
+        for name in available:
+            key = (upload_id, name, (window.start, window.stop), max_points, downsample.value)
+            indices = SERIES_CACHE.get(key)
+            if indices is None:
+                indices = downsampling.METHODS[downsample.value](t, data[name][window], budget)
+                SERIES_CACHE.set(key, indices)
+            picks.append(indices)
+        selected = np.unique(np.concatenate(picks))
+        if len(selected) > max_points:
+            # Per-channel minimums and the endpoints can overshoot; thin
+            # the union evenly, keeping the first and last samples.
+            selected = selected[np.linspace(0, len(selected) - 1, max_points).round().astype(int)]
+        selected = selected + window.start
+    else:
+        selected = window
+
+    return {
+        "upload_id": upload_id,
+        "start_time": data.start_time,
+        "t": data["t"][selected].tolist(),
+        "channels": {
+            name: series.to_json_list(data[name][selected], name) if name in data.channels else None
+            for name in requested
+        },
+    }
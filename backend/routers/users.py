@@ -1,31 +1,138 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from database import get_db
+from database import DB_ASYNC, get_async_db, get_db
 import models
 import schemas
 from auth import (
-    verify_password,
-    get_password_hash,
+    AuthenticatedUser,
     create_access_token,
+    create_refresh_token,
+    hash_refresh_token,
+    revoke_refresh_token_family,
+    get_current_user,
     ACCESS_TOKEN_EXPIRE_MINUTES,
 )
+import hashing
+import user_stats
 
 router = APIRouter(prefix="/api/users", tags=["users"])
 
 
-@router.post("/register", response_model=schemas.UserResponse, status_code=status.HTTP_201_CREATED)
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
+def _hashing_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many authentication requests, please retry shortly",
+        headers={"Retry-After": str(hashing.RETRY_AFTER_SECONDS)},
+    )
+
+
+async def _run_hashing_async(fn, *args):
+    try:
+        return await fn(*args)
+    except hashing.HashingBusy:
+        raise _hashing_busy()
+
+
+async def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    """Register a new user.
+
+    A coroutine even on the synchronous engine: only the database calls
+    borrow a threadpool worker, so sign-ups waiting on the hashing pool
+    cannot starve other requests of threads.
+    """
+    existing = await run_in_threadpool(
+        lambda: db.query(models.User).filter(models.User.email == user.email).first()
+    )
+    if existing:
+        raise HTTPException(status_code=400, detail="Email already registered")
+
+    hashed_password = await _run_hashing_async(hashing.hash_password_async, user.password)
+    db_user = _new_user(user, hashed_password)
+
+    def save():
+        db.add(db_user)
+        db.commit()
+        db.refresh(db_user)
+
+    await run_in_threadpool(save)
+    return db_user
+
+
+async def register_async(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Register a new user."""
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
-    if db_user:
+    result = await db.execute(select(models.User).where(models.User.email == user.email))
+    if result.scalars().first():
         raise HTTPException(status_code=400, detail="Email already registered")
-    
-    hashed_password = get_password_hash(user.password)
-    db_user = models.User(
+
+    hashed_password = await _run_hashing_async(hashing.hash_password_async, user.password)
+    db_user = _new_user(user, hashed_password)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    """Authenticate and return a JWT token.
+
+    Like ``register``, awaits the password check on the event loop.
+    """
+    user = await run_in_threadpool(
+        lambda: db.query(models.User).filter(models.User.email == form_data.username).first()
+    )
+    valid, new_hash = False, None
+    if user:
+        valid, new_hash = await _run_hashing_async(
+            hashing.verify_password_async, form_data.password, user.hashed_password
+        )
+    _check_login(user, valid, new_hash)
+
+    def issue():
+        email = user.email
+        refresh_token = create_refresh_token(db, user.id)
+        db.commit()
+        return email, refresh_token
+
+    email, refresh_token = await run_in_threadpool(issue)
+    return _issue_tokens(email, refresh_token)
+
+
+async def login_async(
+    form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)
+):
+    """Authenticate and return a JWT token."""
+    result = await db.execute(select(models.User).where(models.User.email == form_data.username))
+    user = result.scalars().first()
+    valid, new_hash = False, None
+    if user:
+        valid, new_hash = await _run_hashing_async(
+            hashing.verify_password_async, form_data.password, user.hashed_password
+        )
+    _check_login(user, valid, new_hash)
+
+    refresh_token = create_refresh_token(db, user.id)
+    await db.commit()
+    return _issue_tokens(user.email, refresh_token)
+
+
+# With DB_ASYNC enabled these routes are served by the handlers on the
+# asyncio engine; otherwise by the ones on the synchronous engine.
+router.post(
+    "/register", response_model=schemas.UserResponse, status_code=status.HTTP_201_CREATED
+)(register_async if DB_ASYNC else register)
+router.post("/login", response_model=schemas.Token)(login_async if DB_ASYNC else login)
+
+
+def _new_user(user: schemas.UserCreate, hashed_password: str) -> models.User:
+    return models.User(
         email=user.email,
         hashed_password=hashed_password,
         body_weight=user.body_weight,
@@ -33,25 +140,95 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
         gender=user.gender,
         vo2max=user.vo2max,
     )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
 
 
-@router.post("/login", response_model=schemas.Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    """Authenticate and return a JWT token."""
-    user = db.query(models.User).filter(models.User.email == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+def _check_login(user: Optional[models.User], valid: bool, new_hash: Optional[str]) -> None:
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    
+
+    # The stored hash was made with a different bcrypt cost; upgrade it
+    # while we have the plaintext. The caller's commit persists it.
+    if new_hash:
+        user.hashed_password = new_hash
+
+
+@router.post("/refresh", response_model=schemas.Token)
+def refresh(body: schemas.RefreshRequest, db: Session = Depends(get_db)):
+    """Exchange a refresh token for a new access token and refresh token.
+
+    No password check is involved, so keeping a session alive does not cost
+    a bcrypt verification every time the access token expires.
+    """
+    invalid_token = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    stored = (
+        db.query(models.RefreshToken)
+        .filter(models.RefreshToken.token_hash == hash_refresh_token(body.refresh_token))
+        .with_for_update()
+        .first()
+    )
+    if stored is None:
+        raise invalid_token
+    if stored.revoked_at is not None:
+        # A rotated-out token was presented again, so it may have been
+        # stolen; end every session descended from the same login.
+        revoke_refresh_token_family(db, stored.family_id)
+        db.commit()
+        raise invalid_token
+    if stored.expires_at <= datetime.utcnow():
+        raise invalid_token
+
+    user = db.query(models.User).filter(models.User.id == stored.user_id).first()
+    if user is None:
+        raise invalid_token
+
+    stored.revoked_at = datetime.utcnow()
+    refresh_token = create_refresh_token(db, user.id, family_id=stored.family_id)
+    db.commit()
+    return _issue_tokens(user.email, refresh_token)
+
+
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout(body: schemas.RefreshRequest, db: Session = Depends(get_db)):
+    """Revoke a refresh token and every token rotated from the same login."""
+    stored = (
+        db.query(models.RefreshToken)
+        .filter(models.RefreshToken.token_hash == hash_refresh_token(body.refresh_token))
+        .first()
+    )
+    if stored is not None:
+        revoke_refresh_token_family(db, stored.family_id)
+        db.commit()
+
+
+@router.get("/me/stats", response_model=schemas.UserStatsResponse)
+def get_my_stats(
+    weeks: int = Query(12, ge=1, le=104),
+    current_user: AuthenticatedUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Session counts and average scores, overall, for the last 30 days and per week.
+
+    Served from aggregates kept up to date on every upload and delete, so
+    the cost does not depend on how many uploads the user has.
+    """
+    return user_stats.summary(db, current_user.id, weeks=weeks)
+
+
+def _issue_tokens(email: str, refresh_token: str) -> dict:
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": email}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+    }
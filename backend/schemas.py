@@ -1,6 +1,6 @@
 from pydantic import BaseModel, EmailStr, Field
 from typing import Optional
-from datetime import datetime
+from datetime import date, datetime
 from enum import Enum
 
 
@@ -40,6 +40,24 @@ class TrailConditionEnum(str, Enum):
     mixed = "mixed"
 
 
+class DownsampleMethod(str, Enum):
+    lttb = "lttb"
+    minmax = "minmax"
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+    parquet = "parquet"
+
+
+class JobStateEnum(str, Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
 # User schemas
 class UserCreate(BaseModel):
     email: EmailStr
@@ -66,6 +84,11 @@ class UserResponse(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 class TokenData(BaseModel):
@@ -94,6 +117,7 @@ class UploadResponse(BaseModel):
     id: int
     filename: str
     filepath: str
+    content_hash: Optional[str] = None
     upload_date: datetime
     session_type: Optional[SessionTypeEnum] = None
     race_name: Optional[str] = None
@@ -107,3 +131,71 @@ class UploadResponse(BaseModel):
 
     class Config:
         from_attributes = True
+
+
+class UploadSearchResult(UploadResponse):
+    rank: float
+
+
+class BatchUploadResult(BaseModel):
+    filename: str
+    upload: Optional[UploadResponse] = None
+    error: Optional[str] = None
+
+
+class BatchUploadResponse(BaseModel):
+    created: int
+    failed: int
+    results: list[BatchUploadResult]
+
+
+class UploadSessionCreate(UploadMetadata):
+    filename: str
+    length: int = Field(..., ge=1)
+
+
+class UploadSessionResponse(BaseModel):
+    id: str
+    filename: str
+    length: int
+    offset: int
+    expires_at: datetime
+
+
+class IngestionStatus(BaseModel):
+    upload_id: int
+    state: JobStateEnum
+    attempts: int
+    record_count: Optional[int] = None
+    error: Optional[str] = None
+    next_attempt_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class SeriesResponse(BaseModel):
+    upload_id: int
+    start_time: int  # Unix time of the first sample
+    t: list[int]  # Seconds since start_time
+    channels: dict[str, Optional[list[Optional[float]]]]
+
+
+class StatsSummary(BaseModel):
+    uploads: int
+    by_session_type: dict[str, int]
+    avg_fatigue: Optional[float] = None
+    avg_sensation: Optional[float] = None
+    avg_sleep_quality: Optional[float] = None
+
+
+class WeeklyStats(StatsSummary):
+    week_start: date
+
+
+class UserStatsResponse(BaseModel):
+    total: StatsSummary
+    last_30_days: StatsSummary
+    weeks: list[WeeklyStats]
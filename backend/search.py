@@ -0,0 +1,148 @@
+"""Full-text search over upload race names and notes.
+
+On PostgreSQL ``uploads.search_vector`` is a generated ``tsvector``, with
+race names weighted above notes, behind a GIN index; race names also have
+a trigram index so misspelt names ("UTBM") still match. Results are
+ranked by the better of ``ts_rank_cd`` and trigram word similarity.
+
+SQLite falls back to an external-content FTS5 table, ``uploads_fts``,
+kept in sync by triggers and ranked by ``bm25``. Words match by prefix
+there; fuzzy matching is PostgreSQL only.
+
+Both are created along with the ``uploads`` table, and by a migration for
+databases that predate search.
+"""
+import os
+import re
+from typing import Optional
+
+from sqlalchemy import DDL, Select, column, event, func, literal, literal_column, or_, select, table, tuple_
+from sqlalchemy.engine import Connection
+
+import models
+
+# The text search configuration (stemming and stop words) for PostgreSQL.
+SEARCH_CONFIG = os.getenv("SEARCH_TEXT_CONFIG", "english")
+
+_WORD = re.compile(r"\w+")
+
+_POSTGRES_COLUMN = (
+    "ALTER TABLE uploads ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    "GENERATED ALWAYS AS ("
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(race_name, '')), 'A') || "
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(notes, '')), 'B')"
+    ") STORED"
+)
+_POSTGRES_INDEXES = {
+    "ix_uploads_search_vector": "USING gin (search_vector)",
+    "ix_uploads_race_name_trgm": "USING gin (race_name gin_trgm_ops)",
+}
+
+_SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS uploads_fts USING fts5("
+    "race_name, notes, content='uploads', content_rowid='id', "
+    "tokenize='porter unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS uploads_fts_insert AFTER INSERT ON uploads BEGIN "
+    "INSERT INTO uploads_fts (rowid, race_name, notes) VALUES (new.id, new.race_name, new.notes); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS uploads_fts_delete AFTER DELETE ON uploads BEGIN "
+    "INSERT INTO uploads_fts (uploads_fts, rowid, race_name, notes) "
+    "VALUES ('delete', old.id, old.race_name, old.notes); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS uploads_fts_update AFTER UPDATE OF race_name, notes ON uploads BEGIN "
+    "INSERT INTO uploads_fts (uploads_fts, rowid, race_name, notes) "
+    "VALUES ('delete', old.id, old.race_name, old.notes); "
+    "INSERT INTO uploads_fts (rowid, race_name, notes) VALUES (new.id, new.race_name, new.notes); "
+    "END",
+]
+
+
+def install(connection: Connection, concurrently: bool = False) -> None:
+    """Create the search column, indexes or FTS table for ``uploads``.
+
+    Idempotent. ``concurrently`` builds the PostgreSQL indexes without
+    blocking writes, which needs a connection outside a transaction.
+    """
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        connection.exec_driver_sql(_POSTGRES_COLUMN)
+        for name, definition in _POSTGRES_INDEXES.items():
+            connection.exec_driver_sql(
+                f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS "
+                f"{name} ON uploads {definition}"
+            )
+    elif connection.dialect.name == "sqlite":
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'uploads_fts'"
+        ).first()
+        for statement in _SQLITE_DDL:
+            connection.exec_driver_sql(statement)
+        if not exists:
+            # Index the rows that were there before the table.
+            connection.exec_driver_sql("INSERT INTO uploads_fts (uploads_fts) VALUES ('rebuild')")
+
+
+@event.listens_for(models.Upload.__table__, "after_create")
+def _after_create(target, connection, **kw):
+    install(connection)
+
+
+# The FTS table isn't part of the metadata, so drop it with uploads.
+event.listen(
+    models.Upload.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS uploads_fts").execute_if(dialect="sqlite"),
+)
+
+
+def _fts_query(words: list[str]) -> str:
+    # Every word must match, each as a quoted prefix so no FTS5 syntax leaks.
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def build_query(
+    dialect: str,
+    columns: list,
+    user_id: int,
+    q: str,
+    limit: int,
+    after: Optional[tuple[float, int]] = None,
+) -> Optional[Select]:
+    """The user's uploads matching ``q``, best first, with a ``rank`` column.
+
+    Selects ``limit + 1`` rows after the ``(rank, id)`` keyset ``after``.
+    Returns None when ``q`` has no words to search for.
+    """
+    words = _WORD.findall(q)
+    if not words:
+        return None
+    upload = models.Upload
+    if dialect == "postgresql":
+        tsquery = func.websearch_to_tsquery(literal_column(f"'{SEARCH_CONFIG}'::regconfig"), q)
+        vector = literal_column("uploads.search_vector")
+        phrase = literal(q)
+        rank = func.greatest(
+            func.ts_rank_cd(vector, tsquery),
+            func.word_similarity(phrase, func.coalesce(upload.race_name, "")),
+        )
+        matches = select(*columns, rank.label("rank")).where(
+            upload.user_id == user_id,
+            or_(vector.op("@@")(tsquery), phrase.op("<%")(upload.race_name)),
+        )
+    else:
+        fts = table("uploads_fts", column("rowid"))
+        # bm25 is lower for better matches; race names count ten times notes.
+        rank = -func.bm25(literal_column("uploads_fts"), 10.0, 1.0)
+        matches = (
+            select(*columns, rank.label("rank"))
+            .select_from(upload.__table__.join(fts, fts.c.rowid == upload.id))
+            .where(
+                literal_column("uploads_fts").op("MATCH")(_fts_query(words)),
+                upload.user_id == user_id,
+            )
+        )
+    matches = matches.subquery()
+    query = select(matches)
+    if after is not None:
+        query = query.where(tuple_(matches.c.rank, matches.c.id) < after)
+    return query.order_by(matches.c.rank.desc(), matches.c.id.desc()).limit(limit + 1)
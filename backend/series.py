@@ -0,0 +1,199 @@
+"""Per-upload columnar time-series sidecars.
+
+Decoded record streams are written next to their blob as one contiguous,
+fixed-dtype file per channel plus a small JSON header::
+
+    <blob>.series/
+        header.json
+        t.bin  hr.bin  alt.bin  ...
+
+Readers map the channel files with ``numpy.memmap``, so serving a time
+window only touches the pages that hold it and never re-parses the FIT
+file.
+"""
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+import fit
+import storage
+
+FORMAT_VERSION = 1
+HEADER_NAME = "header.json"
+
+
+@dataclass(frozen=True)
+class ChannelSpec:
+    sources: tuple[str, ...]  # record fields, in order of preference
+    dtype: str
+    units: str
+    decimals: int
+
+
+# Channel name -> how it is derived from decoded ``record`` messages. The
+# time axis ``t`` (seconds since the first record) is always present.
+CHANNELS = {
+    "hr": ChannelSpec(("heart_rate",), "float32", "bpm", 0),
+    "cad": ChannelSpec(("cadence",), "float32", "rpm", 0),
+    "alt": ChannelSpec(("enhanced_altitude", "altitude"), "float32", "m", 1),
+    "speed": ChannelSpec(("enhanced_speed", "speed"), "float32", "m/s", 3),
+    "pace": ChannelSpec(("enhanced_speed", "speed"), "float32", "s/km", 1),
+    "dist": ChannelSpec(("distance",), "float64", "m", 1),
+    "lat": ChannelSpec(("position_lat",), "float64", "deg", 6),
+    "lon": ChannelSpec(("position_long",), "float64", "deg", 6),
+    "power": ChannelSpec(("power",), "float32", "W", 0),
+    "temp": ChannelSpec(("temperature",), "float32", "C", 0),
+}
+
+_SEMICIRCLES_TO_DEGREES = 180.0 / 2**31
+
+
+def series_dir(blob_path: str) -> str:
+    # Keyed without the compression suffix, so recompressing keeps the sidecar.
+    return storage.uncompressed_path(blob_path) + ".series"
+
+
+def remove_series(blob_path: str) -> None:
+    shutil.rmtree(series_dir(blob_path), ignore_errors=True)
+
+
+def _raw_column(records: fit.MessageColumns, name: str) -> np.ndarray:
+    """A record field as float64 with invalid values replaced by NaN."""
+    column = records[name]
+    invalid = records.invalid_value(name)
+    if isinstance(column, list):
+        values = np.array([np.nan if v is None else v for v in column], dtype=np.float64)
+    else:
+        raw = np.frombuffer(column, dtype=np.dtype(column.typecode))
+        values = raw.astype(np.float64)
+        if invalid is not None and invalid == invalid:
+            values[raw == invalid] = np.nan
+    info = records.fields[name]
+    if info.scale != 1 or info.offset:
+        values = values / info.scale - info.offset
+    return values
+
+
+def _build_channel(records: fit.MessageColumns, name: str, spec: ChannelSpec) -> Optional[np.ndarray]:
+    source = next((s for s in spec.sources if s in records), None)
+    if source is None:
+        return None
+    values = _raw_column(records, source)
+    if name == "pace":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.where(values > 0, 1000.0 / values, np.nan)
+    elif name in ("lat", "lon"):
+        values = values * _SEMICIRCLES_TO_DEGREES
+    return values.astype(spec.dtype)
+
+
+def write_series(activity: fit.FitFile, blob_path: str) -> int:
+    """Write the sidecar for ``activity`` next to ``blob_path``.
+
+    The files are assembled in a temporary directory that is renamed into
+    place, so a half-written sidecar is never visible. Returns the number
+    of samples stored.
+    """
+    directory = series_dir(blob_path)
+    records = activity.records
+    if "timestamp" not in records:
+        raise fit.FitError("Activity has no timestamped records")
+
+    timestamps = np.frombuffer(records["timestamp"], dtype=np.uint32)
+    # Samples are sorted by time so windows can be found by binary search;
+    # records without a valid timestamp cannot be placed and are dropped.
+    order = np.argsort(timestamps, kind="stable")
+    order = order[timestamps[order] != records.invalid_value("timestamp")]
+    start = int(timestamps[order[0]]) if len(order) else 0
+
+    channels = {}
+    for name, spec in CHANNELS.items():
+        values = _build_channel(records, name, spec)
+        if values is not None:
+            channels[name] = values[order]
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(blob_path), prefix=".series-")
+    try:
+        (timestamps[order] - start).astype(np.uint32).tofile(os.path.join(tmp_dir, "t.bin"))
+        for name, values in channels.items():
+            values.tofile(os.path.join(tmp_dir, f"{name}.bin"))
+        header = {
+            "version": FORMAT_VERSION,
+            "length": int(len(order)),
+            "start_time": start + fit.FIT_EPOCH_OFFSET,
+            "channels": {
+                "t": {"dtype": "uint32", "units": "s"},
+                **{
+                    name: {"dtype": CHANNELS[name].dtype, "units": CHANNELS[name].units}
+                    for name in channels
+                },
+            },
+        }
+        with open(os.path.join(tmp_dir, HEADER_NAME), "w") as f:
+            json.dump(header, f)
+        try:
+            os.rename(tmp_dir, directory)
+        except OSError:
+            # Another worker already built the sidecar for this blob.
+            if not os.path.exists(os.path.join(directory, HEADER_NAME)):
+                raise
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return header["length"]
+
+
+class Series:
+    """Read-only, memory-mapped view of an upload's sidecar."""
+
+    def __init__(self, blob_path: str):
+        self.directory = series_dir(blob_path)
+        with open(os.path.join(self.directory, HEADER_NAME)) as f:
+            header = json.load(f)
+        self.length: int = header["length"]
+        self.start_time: int = header["start_time"]
+        self.channels: dict[str, dict] = header["channels"]
+        self._maps: dict[str, np.ndarray] = {}
+
+    @staticmethod
+    def exists(blob_path: str) -> bool:
+        return os.path.exists(os.path.join(series_dir(blob_path), HEADER_NAME))
+
+    def __getitem__(self, channel: str) -> np.ndarray:
+        values = self._maps.get(channel)
+        if values is None:
+            dtype = self.channels[channel]["dtype"]
+            if self.length == 0:
+                # mmap cannot map an empty file.
+                values = np.empty(0, dtype=dtype)
+            else:
+                values = np.memmap(
+                    os.path.join(self.directory, f"{channel}.bin"),
+                    dtype=dtype,
+                    mode="r",
+                    shape=(self.length,),
+                )
+            self._maps[channel] = values
+        return values
+
+    def window(self, start: Optional[float] = None, end: Optional[float] = None) -> slice:
+        """Index range of samples with ``start <= t <= end`` (elapsed seconds)."""
+        t = self["t"]
+        lo = 0 if start is None else int(np.searchsorted(t, start, side="left"))
+        hi = self.length if end is None else int(np.searchsorted(t, end, side="right"))
+        return slice(lo, max(lo, hi))
+
+
+def to_json_list(values: np.ndarray, channel: str) -> list:
+    """Convert a channel slice to JSON-friendly floats, NaN becoming ``None``."""
+    spec = CHANNELS.get(channel)
+    if spec is None:
+        return values.tolist()
+    rounded = np.round(values.astype(np.float64), spec.decimals)
+    return [None if v != v else v for v in rounded.tolist()]
@@ -0,0 +1,409 @@
+import gzip
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+import user_stats
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional.
+    zstandard = None
+
+# Size of each read from the spooled upload. Peak memory per upload is
+# bounded by this, independent of the size of the file being stored.
+CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+# How new blobs are stored: "none", "zstd" or "gzip". Without the
+# zstandard package "zstd" falls back to gzip.
+BLOB_COMPRESSION = os.getenv("BLOB_COMPRESSION", "none")
+ZSTD_LEVEL = int(os.getenv("BLOB_ZSTD_LEVEL", "3"))
+GZIP_LEVEL = int(os.getenv("BLOB_GZIP_LEVEL", "6"))
+
+SUFFIXES = {"none": "", "zstd": ".zst", "gzip": ".gz"}
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the configured maximum size."""
+
+    def __init__(self, max_size: int):
+        super().__init__(f"Upload exceeds maximum size of {max_size} bytes")
+        self.max_size = max_size
+
+
+@dataclass
+class StoredFile:
+    path: str
+    size: int
+    sha256: str
+    compression: str = "none"
+    stored_size: Optional[int] = None
+    # (st_dev, st_ino) of the file this call wrote along with a new Blob
+    # row; None when an existing blob was reused.
+    written: Optional[tuple[int, int]] = None
+
+    def discard(self) -> None:
+        """Remove the file written for a new blob whose row was rolled back.
+
+        Only the file this call wrote is removed, not one a concurrent
+        upload of the same contents has put in its place since.
+        """
+        if self.written is None:
+            return
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (st.st_dev, st.st_ino) == self.written:
+            os.unlink(self.path)
+
+
+@dataclass
+class ReleasedBlob:
+    """A blob file moved aside by ``release_blob`` until its deletion commits."""
+
+    path: str
+    moved_path: Optional[str]
+
+    def remove(self) -> None:
+        if self.moved_path is not None and os.path.exists(self.moved_path):
+            os.unlink(self.moved_path)
+
+    def restore(self) -> None:
+        """Put the file back after the deleting transaction rolled back."""
+        if self.moved_path is not None and os.path.exists(self.moved_path):
+            os.replace(self.moved_path, self.path)
+
+
+def resolve_compression(compression: Optional[str] = None) -> str:
+    """The codec to store with, defaulting to ``BLOB_COMPRESSION``."""
+    compression = compression or BLOB_COMPRESSION
+    if compression not in SUFFIXES:
+        raise ValueError(f"Unknown blob compression {compression!r}")
+    if compression == "zstd" and zstandard is None:
+        return "gzip"
+    return compression
+
+
+@contextmanager
+def _encoder(out: BinaryIO, compression: str) -> Iterator[BinaryIO]:
+    """Wrap ``out`` so writes are compressed; the stream is finished on exit."""
+    if compression == "none":
+        yield out
+        return
+    if compression == "zstd":
+        writer = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(out, closefd=False)
+    else:
+        writer = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=GZIP_LEVEL, mtime=0)
+    with writer:
+        yield writer
+
+
+def open_blob(path: str, compression: str = "none") -> BinaryIO:
+    """Open a stored file for reading its original bytes.
+
+    Compressed blobs are decompressed as they are read, a chunk at a time.
+    If the file was recompressed since ``compression`` was read, the
+    current one is opened instead.
+    """
+    if not os.path.exists(path):
+        base = uncompressed_path(path)
+        for candidate, suffix in SUFFIXES.items():
+            if os.path.exists(base + suffix):
+                path, compression = base + suffix, candidate
+                break
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Reading zstd blobs requires the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_size=CHUNK_SIZE)
+    return open(path, "rb")
+
+
+def uncompressed_path(path: str) -> str:
+    """``path`` without its compression suffix."""
+    for suffix in SUFFIXES.values():
+        if suffix and path.endswith(suffix):
+            return path[: -len(suffix)]
+    return path
+
+
+def hash_stream(src: BinaryIO, max_size: Optional[int] = None) -> tuple[str, int]:
+    """Return the SHA-256 hex digest and size of ``src`` without storing it."""
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise UploadTooLarge(max_size)
+        digest.update(chunk)
+    return digest.hexdigest(), size
+
+
+def stream_to_file(
+    src: BinaryIO, dest_path: str, max_size: Optional[int] = None, compression: str = "none"
+) -> StoredFile:
+    """Copy ``src`` to ``dest_path`` in fixed-size chunks.
+
+    The data is written to a temporary file in the destination directory
+    while its SHA-256 and byte count are computed, then renamed into place
+    so readers never observe a partially written file. If more than
+    ``max_size`` bytes are read the copy stops immediately, the temporary
+    file is removed and ``UploadTooLarge`` is raised. With ``compression``
+    the chunks are compressed on their way to disk; the digest and size
+    are those of the original bytes.
+    """
+    directory = os.path.dirname(dest_path)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            with _encoder(out, compression) as writer:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise UploadTooLarge(max_size)
+                    digest.update(chunk)
+                    writer.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+            stored_size = out.tell()
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    return StoredFile(
+        path=dest_path,
+        size=size,
+        sha256=digest.hexdigest(),
+        compression=compression,
+        stored_size=stored_size,
+    )
+
+
+def blob_path(root: str, content_hash: str, compression: str = "none") -> str:
+    """Location of a blob, sharded by the first two bytes of its hash."""
+    return os.path.join(
+        root, "blobs", content_hash[:2], content_hash[2:4], content_hash + SUFFIXES[compression]
+    )
+
+
+def acquire_blob(
+    db: Session,
+    root: str,
+    src: BinaryIO,
+    max_size: Optional[int] = None,
+    compression: Optional[str] = None,
+) -> StoredFile:
+    """Store ``src`` in the content-addressed blob store under ``root``.
+
+    The upload is hashed first. If a blob with the same contents already
+    exists its reference count is incremented and nothing is written to
+    disk; otherwise the data is streamed into place, compressed with
+    ``compression``, and a new ``Blob`` row is added. A file left at the
+    blob's path without a row is never trusted, only replaced. The caller
+    is responsible for committing ``db``.
+    """
+    compression = resolve_compression(compression)
+    content_hash, size = hash_stream(src, max_size=max_size)
+
+    existing = _increment_ref_count(db, content_hash)
+    if existing is not None:
+        return StoredFile(
+            path=blob_path(root, content_hash, existing), size=size, sha256=content_hash,
+            compression=existing,
+        )
+
+    path = blob_path(root, content_hash, compression)
+    src.seek(0)
+    stored = stream_to_file(src, path, max_size=max_size, compression=compression)
+    if stored.sha256 != content_hash:
+        # The spooled upload changed between the two passes.
+        os.unlink(path)
+        raise ValueError("Upload contents changed while being stored")
+    stored_size = stored.stored_size
+    written = _file_id(path)
+
+    compression, created = _add_blob(db, content_hash, size, compression, stored_size)
+    return StoredFile(
+        path=blob_path(root, content_hash, compression), size=size, sha256=content_hash,
+        compression=compression, stored_size=stored_size, written=written if created else None,
+    )
+
+
+def adopt_blob(
+    db: Session, root: str, src_path: str, compression: Optional[str] = None
+) -> StoredFile:
+    """Move the complete file at ``src_path`` into the blob store.
+
+    Like ``acquire_blob``, but for a file already on disk under ``root``
+    (e.g. a finished resumable upload): it is renamed into place instead of
+    copied (or compressed into place), or removed when a blob with the
+    same contents already exists. The caller is responsible for committing
+    ``db``.
+    """
+    compression = resolve_compression(compression)
+    with open(src_path, "rb") as src:
+        content_hash, size = hash_stream(src)
+
+    existing = _increment_ref_count(db, content_hash)
+    if existing is not None:
+        os.unlink(src_path)
+        return StoredFile(
+            path=blob_path(root, content_hash, existing), size=size, sha256=content_hash,
+            compression=existing,
+        )
+
+    path = blob_path(root, content_hash, compression)
+    if compression == "none":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+    else:
+        with open(src_path, "rb") as src:
+            stream_to_file(src, path, compression=compression)
+        os.unlink(src_path)
+    stored_size = os.path.getsize(path)
+    written = _file_id(path)
+    compression, created = _add_blob(db, content_hash, size, compression, stored_size)
+    return StoredFile(
+        path=blob_path(root, content_hash, compression), size=size, sha256=content_hash,
+        compression=compression, stored_size=stored_size, written=written if created else None,
+    )
+
+
+def release_blob(db: Session, root: str, content_hash: str) -> Optional[ReleasedBlob]:
+    """Drop one reference to a blob.
+
+    When the last reference goes, the row's deletion is flushed and the
+    file moved aside while the row is still locked, so an upload of the
+    same contents, which waits for that lock, writes a file of its own
+    rather than one about to be removed. The caller removes the returned
+    ``ReleasedBlob`` once the transaction has committed, or restores it if
+    the commit fails.
+    """
+    blob = (
+        db.query(models.Blob)
+        .filter(models.Blob.content_hash == content_hash)
+        .with_for_update()
+        .first()
+    )
+    if blob is None:
+        return None
+    if blob.ref_count > 1:
+        blob.ref_count -= 1
+        return None
+    db.delete(blob)
+    db.flush()
+    path = blob_path(root, content_hash, blob.compression)
+    moved_path = f"{path}.deleted"
+    try:
+        os.replace(path, moved_path)
+    except FileNotFoundError:
+        moved_path = None
+    return ReleasedBlob(path, moved_path)
+
+
+def recompress_blob(db: Session, root: str, content_hash: str, compression: str) -> Optional[int]:
+    """Rewrite one blob with ``compression`` and point its uploads at it.
+
+    The new file is written alongside the old one without holding any
+    lock; the rows are then switched over in one transaction, which this
+    commits, and the old file removed. Returns the change in bytes on disk,
+    or None if the blob was deleted or recompressed meanwhile.
+    """
+    compression = resolve_compression(compression)
+    blob = db.get(models.Blob, content_hash)
+    if blob is None or blob.compression == compression:
+        return None
+    previous = blob.compression
+    old_path = blob_path(root, content_hash, previous)
+    new_path = blob_path(root, content_hash, compression)
+    db.rollback()
+
+    with open_blob(old_path, previous) as src:
+        stored = stream_to_file(src, new_path, compression=compression)
+    if stored.sha256 != content_hash:
+        os.unlink(new_path)
+        raise ValueError(f"Blob {content_hash} does not match its hash")
+
+    blob = db.scalars(
+        select(models.Blob).where(models.Blob.content_hash == content_hash).with_for_update()
+    ).first()
+    if blob is None or blob.compression != previous:
+        db.rollback()
+        os.unlink(new_path)
+        return None
+    old_size = blob.stored_size if blob.stored_size is not None else os.path.getsize(old_path)
+    blob.compression = compression
+    blob.stored_size = stored.stored_size
+    user_ids = db.scalars(
+        update(models.Upload)
+        .where(models.Upload.content_hash == content_hash)
+        .values(filepath=new_path, compression=compression)
+        .returning(models.Upload.user_id)
+    ).all()
+    # The listed filepath changed, so cached upload lists are stale.
+    user_stats.bump_uploads_version(db, user_ids)
+    db.commit()
+    # Readers still holding the old path find the new file via open_blob.
+    os.unlink(old_path)
+    return stored.stored_size - old_size
+
+
+def _file_id(path: str) -> tuple[int, int]:
+    st = os.stat(path)
+    return st.st_dev, st.st_ino
+
+
+def _add_blob(
+    db: Session, content_hash: str, size: int, compression: str, stored_size: Optional[int]
+) -> tuple[str, bool]:
+    """Add the row for a new blob.
+
+    Returns the compression it is stored with, and whether this call
+    added the row rather than referencing one added concurrently.
+    """
+    # Another request may insert the same blob between our check and flush;
+    # fall back to bumping its reference count in that case.
+    try:
+        with db.begin_nested():
+            db.add(models.Blob(
+                content_hash=content_hash,
+                size=size,
+                ref_count=1,
+                compression=compression,
+                stored_size=stored_size,
+            ))
+    except IntegrityError:
+        return _increment_ref_count(db, content_hash) or compression, False
+    return compression, True
+
+
+def _increment_ref_count(db: Session, content_hash: str) -> Optional[str]:
+    """Take a reference to an existing blob; returns its compression, or None if missing."""
+    return db.execute(
+        update(models.Blob)
+        .where(models.Blob.content_hash == content_hash)
+        .values(ref_count=models.Blob.ref_count + 1)
+        .returning(models.Blob.compression)
+    ).scalar()
@@ -0,0 +1,265 @@
+"""Per-request performance metrics in the Prometheus text format.
+
+``MetricsMiddleware`` times every request and records its status, response
+size and request body size, labelled by the matched route template.
+SQLAlchemy cursor events attribute statement counts and database time to
+the request that issued them, through a context variable that follows
+the request onto threadpool workers. ``render`` produces the exposition
+served at ``/metrics``.
+
+With ``SERVER_TIMING`` enabled each response also carries a
+``Server-Timing`` header with ``db``, ``serialize`` (JSON rendering) and
+``total`` durations in milliseconds.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))  # 256 B .. 64 MiB
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per-bucket counts (plus +Inf), then the sum.
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = self.header()
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                labels = _format_labels(self.labels, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+REQUESTS = Counter("http_requests_total", "HTTP requests served.", ("method", "route", "status"))
+LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to serve HTTP requests.", ("method", "route")
+)
+IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being served.", ("method",))
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes", "Size of HTTP response bodies.", ("method", "route"), SIZE_BUCKETS
+)
+REQUEST_BYTES = Counter(
+    "http_request_body_bytes_total", "Request body bytes received, e.g. uploads.", ("method", "route")
+)
+DB_STATEMENTS = Histogram(
+    "http_request_db_statements", "SQL statements executed per HTTP request.", ("method", "route"),
+    COUNT_BUCKETS,
+)
+DB_TIME = Histogram(
+    "http_request_db_seconds", "Time spent in SQL statements per HTTP request.", ("method", "route")
+)
+BACKGROUND_DB_STATEMENTS = Counter(
+    "db_background_statements_total", "SQL statements executed outside HTTP requests."
+)
+
+
+@dataclass
+class RequestTimings:
+    db_statements: int = 0
+    db_seconds: float = 0.0
+    serialize_seconds: float = 0.0
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def record_serialize(seconds: float) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.serialize_seconds += seconds
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("telemetry_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_statement(conn)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # after_cursor_execute doesn't run for a statement that raised.
+    if context.connection is not None:
+        _record_statement(context.connection)
+
+
+def _record_statement(conn) -> None:
+    started = conn.info.get("telemetry_start")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    timings = _current.get()
+    if timings is None:
+        BACKGROUND_DB_STATEMENTS.inc()
+        return
+    timings.db_statements += 1
+    timings.db_seconds += elapsed
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording ``REGISTRY`` metrics for every HTTP request."""
+
+    def __init__(self, app, server_timing: bool = SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        status_code = 500
+        received = 0
+        sent = 0
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def instrumented_send(message):
+            nonlocal status_code, sent
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.server_timing:
+                    message = dict(message)
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", _server_timing(timings, time.perf_counter() - start))
+                    ]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        IN_FLIGHT.inc(method)
+        try:
+            await self.app(scope, counting_receive, instrumented_send)
+        finally:
+            IN_FLIGHT.dec(method)
+            _current.reset(token)
+            route = getattr(scope.get("route"), "path", "<unmatched>")
+            REQUESTS.inc(method, route, str(status_code))
+            LATENCY.observe(time.perf_counter() - start, method, route)
+            RESPONSE_SIZE.observe(sent, method, route)
+            if received:
+                REQUEST_BYTES.inc(method, route, amount=received)
+            DB_STATEMENTS.observe(timings.db_statements, method, route)
+            DB_TIME.observe(timings.db_seconds, method, route)
+
+
+def _server_timing(timings: RequestTimings, total: float) -> bytes:
+    # Measured when the response starts; for streamed bodies that excludes
+    # the time spent producing the body.
+    return (
+        f"db;dur={timings.db_seconds * 1000:.1f}, "
+        f"serialize;dur={timings.serialize_seconds * 1000:.1f}, "
+        f"total;dur={total * 1000:.1f}"
+    ).encode()
+
+
+def render(extra: Iterable[str] = ()) -> str:
+    lines = [line for metric in REGISTRY for line in metric.render()]
+    lines.extend(extra)
+    return "\n".join(lines) + "\n"
+
+
+def samples(name: str, type: str, help: str, values: Iterable[tuple[dict, float]]) -> list[str]:
+    """Exposition lines for a metric computed at scrape time."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for labels, value in values:
+        lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+    return lines
@@ -1,82 +1,612 @@
+"""Benchmark suite for the upload API.
+
+    python tests/benchmark_uploads.py                        # full run
+    python tests/benchmark_uploads.py --quick --cases list,auth
+    python tests/benchmark_uploads.py --output baseline.json
+    python tests/benchmark_uploads.py --baseline baseline.json --threshold 0.2
+
+Every case runs against a file-backed SQLite database and, when
+``--postgres`` or ``BENCH_POSTGRES_URL`` names a scratch database, against
+PostgreSQL too; the benchmark creates and drops its tables there. Each case
+runs a few warm-up iterations, then reports p50/p95/p99 latencies. With
+``--baseline`` the run exits non-zero when a case's ``--metric`` got slower
+than the baseline by more than ``--threshold``.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import platform
+import statistics
+import subprocess
+import tempfile
 import time
 import sys
 import os
+from datetime import datetime, timedelta, timezone
+
+import httpx
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, insert, select
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
 
-# Set DATABASE_URL to sqlite in-memory BEFORE importing main or database
-os.environ["DATABASE_URL"] = "sqlite:///:memory:"
+# Set DATABASE_URL to sqlite in-memory BEFORE importing main or database.
+# The load benchmark runs this script in subprocesses against a file DB.
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
 
 # Add backend directory to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from main import app
-from database import Base, get_db
+import database
+from database import Base, get_db, get_session_factory
+import fit
+import hashing
+import migrations
 import models
-from auth import get_current_user
-
-# Setup in-memory DB - we can reuse the engine from database.py if it picked up the env var,
-# or create a new one to be safe and ensure check_same_thread=False for sqlite
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
-)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-def override_get_db():
+from auth import USER_CACHE, AuthenticatedUser, get_current_user, get_current_user_async
+from fit_builder import build_activity
+from routers import uploads as uploads_router
+
+client = TestClient(app)
+
+RESULTS: dict[str, dict] = {}
+
+
+class Backend:
+    """A database the cases run against, wired into the app's dependencies."""
+
+    def __init__(self, name: str, url: str, **engine_options):
+        self.name = name
+        self.engine = create_engine(url, **engine_options)
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+
+    def __enter__(self):
+        migrations.upgrade(self.engine)
+
+        def override_get_db():
+            db = self.SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app.dependency_overrides[get_db] = override_get_db
+        app.dependency_overrides[get_session_factory] = lambda: self.SessionLocal
+        return self
+
+    def __exit__(self, *exc_info):
+        app.dependency_overrides.clear()
+        USER_CACHE.clear()
+        Base.metadata.drop_all(bind=self.engine)
+        migrations.schema_version.drop(bind=self.engine, checkfirst=True)
+        self.engine.dispose()
+
+    def create_user(self, email: str) -> AuthenticatedUser:
+        db = self.SessionLocal()
+        try:
+            user = models.User(email=email, hashed_password="hashedpassword")
+            db.add(user)
+            db.commit()
+            return AuthenticatedUser.from_model(user)
+        finally:
+            db.close()
+
+
+def authenticate_as(user: AuthenticatedUser) -> None:
+    async def authenticated():
+        return user
+
+    app.dependency_overrides[get_current_user] = lambda: user
+    app.dependency_overrides[get_current_user_async] = authenticated
+
+
+def measure(fn, iterations: int, warmup: int = 2) -> list[float]:
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start_time)
+    return timings
+
+
+def summarize(timings: list[float], **extra) -> dict:
+    ordered = sorted(timings)
+
+    def percentile(p: float) -> float:
+        # Nearest-rank, so p99 of 100 samples is the 99th slowest.
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] * 1000
+
+    return {
+        "iterations": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000,
+        **extra,
+    }
+
+
+def report(key: str, timings: list[float], **extra) -> dict:
+    result = RESULTS[key] = summarize(timings, **extra)
+    notes = "".join(f"  {name} {value:.1f}" for name, value in extra.items())
+    print(f"  {key:<48} p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  "
+          f"p99 {result['p99_ms']:9.2f} ms  (n={result['iterations']}){notes}")
+    return result
+
+
+def _upload_rows(user_id: int, start: int, count: int) -> list[dict]:
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        {
+            "user_id": user_id,
+            "filename": f"file_{i}.fit",
+            "filepath": f"/tmp/file_{i}.fit",
+            "upload_date": base + timedelta(minutes=i),
+            "session_type": "training",
+            "notes": "Felt strong on the climbs",
+            "fatigue_level": i % 5 + 1,
+            "sleep_quality": 4,
+            "weather_condition": "sunny",
+            "trail_condition": "dry",
+        }
+        for i in range(start, start + count)
+    ]
+
+
+def seed_uploads(backend: Backend, user_id: int, start: int, count: int, chunk: int = 10000) -> None:
+    db = backend.SessionLocal()
     try:
-        db = TestingSessionLocal()
-        yield db
+        for offset in range(start, start + count, chunk):
+            db.execute(
+                insert(models.Upload),
+                _upload_rows(user_id, offset, min(chunk, start + count - offset)),
+            )
+        db.commit()
     finally:
         db.close()
 
-app.dependency_overrides[get_db] = override_get_db
-client = TestClient(app)
 
-def benchmark():
-    # Setup DB
-    Base.metadata.create_all(bind=engine)
+def bench_list(backend: Backend, config) -> None:
+    """First and deep pages of GET /api/upload/ as the user's history grows."""
+    user = backend.create_user("list@example.com")
+    authenticate_as(user)
+    limit = 20
+    seeded = 0
+    for size in config.sizes:
+        start_time = time.perf_counter()
+        seed_uploads(backend, user.id, seeded, size - seeded)
+        seeded = size
+        print(f"  seeded {size} uploads in {time.perf_counter() - start_time:.1f} s")
+
+        db = backend.SessionLocal()
+        # The cursor a client would hold on reaching the last page.
+        last_page = db.execute(
+            select(models.Upload.upload_date, models.Upload.id)
+            .where(models.Upload.user_id == user.id)
+            .order_by(models.Upload.upload_date.desc(), models.Upload.id.desc())
+            .offset(size - limit - 1)
+            .limit(1)
+        ).one()
+        db.close()
+        cursor = uploads_router._encode_cursor(last_page.upload_date.isoformat(), last_page.id)
+
+        def get(**params):
+            def request():
+                response = client.get("/api/upload/", params={"limit": limit, **params})
+                assert response.status_code == 200, response.text
+            return request
+
+        prefix = f"{backend.name}/list/{size}"
+        report(f"{prefix}/first_page", measure(get(), config.iterations(200)))
+        report(f"{prefix}/deep_page_offset", measure(get(skip=size - limit), config.iterations(50)))
+        report(f"{prefix}/deep_page_cursor", measure(get(cursor=cursor), config.iterations(200)))
+
+
+def bench_upload(backend: Backend, config) -> None:
+    """Single-file upload latency and throughput for small and large files."""
+    user = backend.create_user("upload@example.com")
+    authenticate_as(user)
+    small = build_activity(3600)
+    large = os.urandom(config.large_upload_mb * 2**20)
+    with tempfile.TemporaryDirectory() as tmp:
+        uploads_router.UPLOAD_DIR = tmp
+        for label, data, iterations in (
+            ("small", small, config.iterations(50)),
+            (f"{config.large_upload_mb}mb", large, config.iterations(5, minimum=2)),
+        ):
+            counter = iter(range(10**9))
+
+            def upload():
+                # A unique tail, so the blob store never deduplicates.
+                body = data + next(counter).to_bytes(8, "little")
+                response = client.post("/api/upload/", files={"file": ("ride.fit", body)})
+                assert response.status_code == 201, response.text
+
+            timings = measure(upload, iterations, warmup=1)
+            report(
+                f"{backend.name}/upload/{label}",
+                timings,
+                mb_per_s=len(data) / 2**20 / statistics.median(timings),
+            )
+
+
+def bench_download(backend: Backend, config) -> None:
+    """Fetching an uploaded file whole, by range, and revalidating it."""
+    user = backend.create_user("download@example.com")
+    authenticate_as(user)
+    data = os.urandom(config.large_upload_mb * 2**20)
+    with tempfile.TemporaryDirectory() as tmp:
+        uploads_router.UPLOAD_DIR = tmp
+        response = client.post("/api/upload/", files={"file": ("ride.fit", data)})
+        url = f"/api/upload/{response.json()['id']}/file"
+        etag = client.head(url).headers["etag"]
+
+        def fetch(expected, **headers):
+            def request():
+                response = client.get(url, headers=headers)
+                assert response.status_code == expected, response.status_code
+            return request
+
+        iterations = config.iterations(20, minimum=3)
+        timings = measure(fetch(200), iterations, 1)
+        report(f"{backend.name}/download/{config.large_upload_mb}mb", timings,
+               mb_per_s=len(data) / 2**20 / statistics.median(timings))
+        report(f"{backend.name}/download/range_64kb",
+               measure(fetch(206, Range="bytes=1048576-1114111"), config.iterations(200)))
+        report(f"{backend.name}/download/not_modified",
+               measure(fetch(304, **{"If-None-Match": etag}), config.iterations(200)))
+
+
+def bench_batch_upload(backend: Backend, config) -> None:
+    """One request per file vs. a single batch request for the same files."""
+    user = backend.create_user("batch@example.com")
+    authenticate_as(user)
+    count = 100
+    rounds = iter(range(10**9))
+
+    def files():
+        round_ = next(rounds).to_bytes(4, "little")
+        return [build_activity(600) + round_ + i.to_bytes(4, "little") for i in range(count)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uploads_router.UPLOAD_DIR = tmp
 
-    # Create user
-    db = TestingSessionLocal()
-    user = models.User(email="bench@example.com", hashed_password="hashedpassword")
+        def one_by_one():
+            for i, data in enumerate(files()):
+                response = client.post("/api/upload/", files={"file": (f"{i}.fit", data)})
+                assert response.status_code == 201
+
+        def batch():
+            response = client.post(
+                "/api/upload/batch",
+                files=[("files", (f"{i}.fit", data)) for i, data in enumerate(files())],
+            )
+            assert response.json()["created"] == count
+
+        iterations = config.iterations(5, minimum=2)
+        report(f"{backend.name}/upload/{count}_files_one_by_one", measure(one_by_one, iterations, 1))
+        report(f"{backend.name}/upload/{count}_files_batch", measure(batch, iterations, 1))
+
+
+def bench_auth(backend: Backend, config) -> None:
+    """Register and login cost, and what authenticating adds to a request."""
+    app.dependency_overrides.pop(get_current_user, None)
+    emails = (f"register{i}@example.com" for i in range(10**9))
+    password = "securepassword123"
+
+    def register():
+        response = client.post(
+            "/api/users/register", json={"email": next(emails), "password": password}
+        )
+        assert response.status_code == 201, response.text
+
+    def login():
+        response = client.post(
+            "/api/users/login", data={"username": "register0@example.com", "password": password}
+        )
+        assert response.status_code == 200, response.text
+
+    iterations = config.iterations(20, minimum=3)
+    report(f"{backend.name}/auth/register", measure(register, iterations, 1))
+    report(f"{backend.name}/auth/login", measure(login, iterations, 1))
+
+    token = client.post(
+        "/api/users/login", data={"username": "register0@example.com", "password": password}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def list_page(**kwargs):
+        response = client.get("/api/upload/", params={"limit": 1}, **kwargs)
+        assert response.status_code == 200, response.text
+
+    def uncached():
+        USER_CACHE.clear()
+        list_page(headers=headers)
+
+    iterations = config.iterations(300)
+    authenticated = report(
+        f"{backend.name}/auth/request_token_cached",
+        measure(lambda: list_page(headers=headers), iterations),
+    )
+    cold = report(f"{backend.name}/auth/request_token_uncached", measure(uncached, iterations))
+    db = backend.SessionLocal()
+    user = db.scalar(select(models.User).where(models.User.email == "register0@example.com"))
+    identity = AuthenticatedUser.from_model(user)
+    db.close()
+    authenticate_as(identity)
+    baseline = report(f"{backend.name}/auth/request_no_auth", measure(list_page, iterations))
+    print(f"  auth overhead per request: p50 {authenticated['p50_ms'] - baseline['p50_ms']:.2f} ms "
+          f"cached, {cold['p50_ms'] - baseline['p50_ms']:.2f} ms uncached")
+
+
+def bench_list_serialization(backend: Backend, config) -> None:
+    """Previous ORM + response_model pipeline vs. the projected orjson path, 100 rows."""
+    from fastapi.responses import JSONResponse
+    from fastapi.encoders import jsonable_encoder
+    from pydantic import TypeAdapter
+    import schemas
+
+    user = backend.create_user("serialize@example.com")
+    seed_uploads(backend, user.id, 0, 1000)
+    adapter = TypeAdapter(list[schemas.UploadResponse])
+    db = backend.SessionLocal()
+
+    def orm_page():
+        rows = db.execute(
+            select(models.Upload).where(models.Upload.user_id == user.id)
+            .order_by(models.Upload.upload_date.desc(), models.Upload.id.desc()).limit(100)
+        ).scalars().all()
+        db.expunge_all()
+        return JSONResponse(jsonable_encoder(adapter.validate_python(rows, from_attributes=True))).body
+
+    def projected_page():
+        rows = db.execute(uploads_router._list_uploads_query(user.id, 0, 100, None)).all()
+        return uploads_router._list_response(rows, 100, "etag").body
+
+    assert json.loads(orm_page()) == json.loads(projected_page())
+    iterations = config.iterations(500)
+    report(f"{backend.name}/serialize/orm_response_model", measure(orm_page, iterations))
+    report(f"{backend.name}/serialize/projection_orjson", measure(projected_page, iterations))
+    db.close()
+
+
+def bench_fit_decode(config) -> None:
+    # A 10-hour activity recorded at 1 Hz.
+    data = build_activity(36000, compressed_every=10)
+    print(f"  decoding a {len(data) / 1024:.0f} KiB FIT file with 36000 records")
+    report("fit/decode_36000_records", measure(lambda: fit.decode(io.BytesIO(data)),
+                                               config.iterations(10, minimum=3), 1))
+
+
+def bench_blob_compression(config) -> None:
+    """Disk saved and CPU spent per MB by each blob codec, on a 10-hour activity."""
+    import storage
+
+    data = build_activity(36000, compressed_every=10)
+    megabytes = len(data) / 2**20
+    iterations = config.iterations(20, minimum=3)
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec in ("none", "gzip", "zstd"):
+            if storage.resolve_compression(codec) != codec:
+                print(f"  skipping {codec}: zstandard is not installed")
+                continue
+            path = os.path.join(tmp, "blob" + storage.SUFFIXES[codec])
+            cpu = time.process_time()
+            timings = measure(
+                lambda: storage.stream_to_file(io.BytesIO(data), path, compression=codec),
+                iterations, 0,
+            )
+            write_cpu = (time.process_time() - cpu) / iterations / megabytes
+            saved = 1 - os.path.getsize(path) / len(data)
+
+            def read():
+                with storage.open_blob(path, codec) as src:
+                    while src.read(storage.CHUNK_SIZE):
+                        pass
+
+            cpu = time.process_time()
+            read_timings = measure(read, iterations, 0)
+            read_cpu = (time.process_time() - cpu) / iterations / megabytes
+            report(f"storage/{codec}/write", timings,
+                   saved_pct=saved * 100, cpu_ms_per_mb=write_cpu * 1000)
+            report(f"storage/{codec}/read", read_timings, cpu_ms_per_mb=read_cpu * 1000)
+
+
+LOAD_REQUESTS = 2000
+# Kept within the default pool (5 + 10 overflow): beyond it the sync mode
+# starves, with every thread waiting on a connection that can only be
+# returned by a dependency teardown queued for a thread.
+LOAD_CONCURRENCY = 15
+
+async def _load():
+    # Hit the real engine for the configured mode rather than the override.
+    app.dependency_overrides.clear()
+    migrations.upgrade(database.engine)
+    db = database.SessionLocal()
+    user = models.User(email="load@example.com", hashed_password="hashedpassword")
     db.add(user)
     db.commit()
-    db.refresh(user)
+    db.execute(insert(models.Upload), _upload_rows(user.id, 0, 1000))
+    db.commit()
+    current = AuthenticatedUser.from_model(user)
+    db.close()
+    authenticate_as(current)
 
-    # Override auth to return our test user
-    app.dependency_overrides[get_current_user] = lambda: user
+    latencies = []
+    gate = asyncio.Semaphore(LOAD_CONCURRENCY)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        async def one():
+            async with gate:
+                start_time = time.perf_counter()
+                response = await client.get("/api/upload/", params={"limit": 20})
+                latencies.append(time.perf_counter() - start_time)
+                assert response.status_code == 200, response.text
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(LOAD_REQUESTS)))
+        elapsed = time.perf_counter() - start_time
+
+    # The parent reads the last line.
+    print(json.dumps(summarize(latencies, requests_per_s=LOAD_REQUESTS / elapsed)))
+
+def bench_db_modes(config) -> None:
+    # Each mode runs in its own process since DB_ASYNC is read at import.
+    print(f"  GET /api/upload/ x{LOAD_REQUESTS}, {LOAD_CONCURRENCY} concurrent")
+    for db_async, mode in (("0", "sync"), ("1", "async")):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                DB_ASYNC=db_async,
+                DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'load.db')}",
+                INGESTION_WORKERS="0",
+            )
+            output = subprocess.run(
+                [sys.executable, __file__, "--load"], env=env, check=True,
+                capture_output=True, text=True,
+            ).stdout
+        result = RESULTS[f"sqlite/load/{mode}"] = json.loads(output.strip().splitlines()[-1])
+        print(f"  {'sqlite/load/' + mode:<48} p50 {result['p50_ms']:9.2f} ms  "
+              f"p95 {result['p95_ms']:9.2f} ms  {result['requests_per_s']:7.0f} req/s")
+
+
+# Cases run once per backend, in this order.
+BACKEND_CASES = {
+    "list": bench_list,
+    "upload": bench_upload,
+    "download": bench_download,
+    "batch": bench_batch_upload,
+    "auth": bench_auth,
+    "serialization": bench_list_serialization,
+}
+# Cases independent of the backend.
+LOCAL_CASES = {
+    "fit": bench_fit_decode,
+    "compression": bench_blob_compression,
+    "load": bench_db_modes,
+}
 
-    # Insert 1000 uploads
-    print("Seeding database with 1000 uploads...")
-    uploads = []
-    for i in range(1000):
-        uploads.append(models.Upload(
-            user_id=user.id,
-            filename=f"file_{i}.fit",
-            filepath=f"/tmp/file_{i}.fit",
-            session_type="training",
-            fatigue_level=3
-        ))
-    db.add_all(uploads)
-    db.commit()
 
-    # Benchmark
-    print("Starting benchmark...")
-    start_time = time.time()
-    response = client.get("/api/upload/")
-    end_time = time.time()
+def backends(config):
+    with tempfile.TemporaryDirectory() as tmp:
+        yield lambda: Backend(
+            "sqlite",
+            f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+            connect_args={"check_same_thread": False},
+        )
+    if config.postgres:
+        try:
+            probe = create_engine(config.postgres)
+            probe.connect().close()
+            probe.dispose()
+        except Exception as exc:
+            print(f"Skipping PostgreSQL: {exc}")
+            return
+        yield lambda: Backend("postgresql", config.postgres)
 
-    print(f"Status Code: {response.status_code}")
-    print(f"Items returned: {len(response.json())}")
-    print(f"Time taken: {end_time - start_time:.4f} seconds")
 
-    # Clean up
-    Base.metadata.drop_all(bind=engine)
+def compare(results: dict, baseline: dict, threshold: float, metric: str) -> list[str]:
+    """Print each case against the baseline; return the keys that regressed."""
+    regressions = []
+    field = f"{metric}_ms"
+    print(f"\nCompared with baseline ({metric}, threshold {threshold:.0%}):")
+    for key, current in results.items():
+        previous = baseline.get("results", {}).get(key)
+        if previous is None or field not in previous:
+            continue
+        change = current[field] / previous[field] - 1 if previous[field] else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(key)
+        print(f"  {key:<48} {previous[field]:9.2f} -> {current[field]:9.2f} ms  "
+              f"{change:+7.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def _metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    cases = list(BACKEND_CASES) + list(LOCAL_CASES)
+    parser.add_argument("--cases", default=",".join(cases),
+                        help=f"Comma-separated subset of: {', '.join(cases)}")
+    parser.add_argument("--sizes", default="1000,100000,1000000",
+                        help="Upload counts the list benchmark grows through")
+    parser.add_argument("--quick", action="store_true",
+                        help="Smaller sizes and a tenth of the iterations, for a smoke run")
+    parser.add_argument("--large-upload-mb", type=int, default=50)
+    parser.add_argument("--postgres", default=os.getenv("BENCH_POSTGRES_URL"),
+                        help="Scratch PostgreSQL database to benchmark too (tables are dropped)")
+    parser.add_argument("--output", "-o", help="Write results as JSON, e.g. to save a baseline")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed slowdown against the baseline, as a fraction")
+    parser.add_argument("--metric", choices=["p50", "p95", "p99"], default="p50")
+    return parser
+
+
+def main(argv=None) -> int:
+    config = build_parser().parse_args(argv)
+    selected = config.cases.split(",")
+    unknown = set(selected) - set(BACKEND_CASES) - set(LOCAL_CASES)
+    if unknown:
+        print(f"Unknown cases: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+    config.sizes = [int(size) for size in config.sizes.split(",")]
+    if config.quick:
+        config.sizes = [size for size in config.sizes if size <= 10000] or [1000]
+        config.large_upload_mb = min(config.large_upload_mb, 5)
+    scale = 0.1 if config.quick else 1.0
+    config.iterations = lambda n, minimum=10: max(minimum, int(n * scale))
+
+    try:
+        for make_backend in backends(config):
+            for name, case in BACKEND_CASES.items():
+                if name in selected:
+                    with make_backend() as backend:
+                        print(f"[{backend.name}] {name}")
+                        case(backend, config)
+        for name, case in LOCAL_CASES.items():
+            if name in selected:
+                print(f"[local] {name}")
+                case(config)
+    finally:
+        hashing.shutdown()
+
+    if config.output:
+        with open(config.output, "w") as out:
+            json.dump({"meta": _metadata(), "results": RESULTS}, out, indent=2)
+        print(f"\nWrote {len(RESULTS)} results to {config.output}")
+    if config.baseline:
+        with open(config.baseline) as f:
+            regressions = compare(RESULTS, json.load(f), config.threshold, config.metric)
+        if regressions:
+            print(f"{len(regressions)} case(s) regressed beyond {config.threshold:.0%}")
+            return 1
+    return 0
 
 if __name__ == "__main__":
-    benchmark()
+    if "--load" in sys.argv:
+        asyncio.run(_load())
+    else:
+        sys.exit(main())
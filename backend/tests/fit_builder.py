@@ -0,0 +1,114 @@
+"""Build synthetic FIT activity files for tests and benchmarks."""
+import struct
+
+_CRC_TABLE = [
+    0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+    0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400,
+]
+
+# Start of the synthetic activity, in seconds since the FIT epoch.
+START_TIME = 1_000_000_000
+
+
+def crc16(data: bytes, crc: int = 0) -> int:
+    for byte in data:
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ _CRC_TABLE[byte & 0xF]
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ _CRC_TABLE[(byte >> 4) & 0xF]
+    return crc
+
+
+def definition(local, global_number, fields, dev_fields=(), big_endian=False):
+    header = 0x40 | local | (0x20 if dev_fields else 0)
+    endian = ">" if big_endian else "<"
+    out = bytes([header, 0, 1 if big_endian else 0]) + struct.pack(endian + "H", global_number)
+    out += bytes([len(fields)])
+    for num, size, base in fields:
+        out += bytes([num, size, base])
+    if dev_fields:
+        out += bytes([len(dev_fields)])
+        for num, size, dev_index in dev_fields:
+            out += bytes([num, size, dev_index])
+    return out
+
+
+def record_values(i):
+    """Field values of the ``i``-th synthetic record."""
+    return {
+        "timestamp": START_TIME + i,
+        "position_lat": 546_000_000 + i * 10,
+        "position_long": -1_000_000_000 - i * 7,
+        "altitude": (1000 + (i % 600)) * 5 + 2500,
+        "heart_rate": 120 + (i % 60),
+        "cadence": 80 + (i % 10),
+        "distance": i * 250,
+        "speed": 2500 + (i % 500),
+        "core_temperature": 370 + (i % 5),
+    }
+
+
+def build_activity(num_records, compressed_every=0, big_endian=False):
+    """Return the bytes of an activity with ``num_records`` 1 Hz records.
+
+    Records carry a developer ``core_temperature`` field. When
+    ``compressed_every`` is set, every n-th record uses a
+    compressed-timestamp header instead of an explicit timestamp.
+    """
+    endian = ">" if big_endian else "<"
+    body = bytearray()
+
+    body += definition(0, 0, [(0, 1, 0x00), (1, 2, 0x84), (4, 4, 0x86)], big_endian=big_endian)
+    body += bytes([0x00]) + struct.pack(endian + "BHI", 4, 1, START_TIME)
+
+    body += definition(1, 207, [(3, 1, 0x02)])
+    body += bytes([0x01, 0])
+    body += definition(
+        1, 206,
+        [(0, 1, 0x02), (1, 1, 0x02), (2, 1, 0x02), (3, 16, 0x07), (8, 8, 0x07)],
+    )
+    body += bytes([0x01, 0, 0, 0x84]) + b"core_temperature".ljust(16, b"\0")
+    body += b"C".ljust(8, b"\0")
+
+    record_fields = [
+        (253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84),
+        (3, 1, 0x02), (4, 1, 0x02), (5, 4, 0x86), (6, 2, 0x84),
+    ]
+    body += definition(2, 20, record_fields, dev_fields=[(0, 2, 0)], big_endian=big_endian)
+    record = struct.Struct(endian + "IiiHBBIHH")
+    if compressed_every:
+        body += definition(3, 20, record_fields[1:], dev_fields=[(0, 2, 0)], big_endian=big_endian)
+        compressed = struct.Struct(endian + "iiHBBIHH")
+
+    for i in range(num_records):
+        v = record_values(i)
+        if compressed_every and i % compressed_every == compressed_every - 1:
+            body.append(0x80 | (3 << 5) | (v["timestamp"] & 0x1F))
+            body += compressed.pack(
+                v["position_lat"], v["position_long"], v["altitude"], v["heart_rate"],
+                v["cadence"], v["distance"], v["speed"], v["core_temperature"],
+            )
+        else:
+            body.append(0x02)
+            body += record.pack(
+                v["timestamp"], v["position_lat"], v["position_long"], v["altitude"],
+                v["heart_rate"], v["cadence"], v["distance"], v["speed"],
+                v["core_temperature"],
+            )
+
+    body += definition(4, 18, [(253, 4, 0x86), (2, 4, 0x86), (7, 4, 0x86), (9, 4, 0x86)])
+    body += bytes([0x04]) + struct.pack(
+        "<IIII", START_TIME + num_records, START_TIME, num_records * 1000, num_records * 250
+    )
+
+    return build_file(body)
+
+
+def build_file(body: bytes) -> bytes:
+    """Wrap definition and data messages in a FIT header and CRC."""
+    header = struct.pack("<BBHI4s", 14, 0x20, 2132, len(body), b".FIT")
+    header += struct.pack("<H", crc16(header))
+    data = header + bytes(body)
+    return data + struct.pack("<H", crc16(data))
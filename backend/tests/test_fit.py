@@ -0,0 +1,117 @@
+import io
+import struct
+
+import pytest
+
+import fit
+from fit_builder import START_TIME, build_activity, build_file, definition, record_values
+
+
+class TestFitDecoder:
+    def test_decodes_records_into_typed_columns(self):
+        activity = fit.decode(io.BytesIO(build_activity(100)))
+        records = activity.records
+
+        assert len(records) == 100
+        assert records["heart_rate"].typecode == "B"
+        assert records["position_lat"].typecode == "i"
+        for name in ("timestamp", "position_lat", "altitude", "heart_rate", "speed"):
+            assert list(records[name]) == [record_values(i)[name] for i in range(100)]
+        assert records.fields["altitude"].scale == 5
+        assert activity["file_id"]["type"][0] == 4
+        assert activity["session"]["total_distance"][0] == 100 * 250
+
+    def test_compressed_timestamp_headers(self):
+        records = fit.decode(io.BytesIO(build_activity(200, compressed_every=3))).records
+        assert list(records["timestamp"]) == [record_values(i)["timestamp"] for i in range(200)]
+
+    def test_developer_fields_use_field_description(self):
+        records = fit.decode(io.BytesIO(build_activity(50))).records
+        assert records.fields["core_temperature"].units == "C"
+        assert list(records["core_temperature"]) == [
+            record_values(i)["core_temperature"] for i in range(50)
+        ]
+
+    def test_big_endian_and_chained_files(self, tmp_path):
+        path = tmp_path / "chained.fit"
+        path.write_bytes(build_activity(10, big_endian=True) + build_activity(5))
+        activity = fit.decode(str(path))
+        assert len(activity.headers) == 2
+        assert len(activity.records) == 15
+        assert activity.records["position_long"][9] == record_values(9)["position_long"]
+
+    def test_field_with_mixed_widths_stays_aligned(self):
+        # heart_rate as uint8 on local 0 and uint16 on local 1, alternating.
+        body = definition(0, 20, [(253, 4, 0x86), (3, 1, 0x02)])
+        body += definition(1, 20, [(253, 4, 0x86), (3, 2, 0x84), (4, 1, 0x02)])
+        body += bytes([0x00]) + struct.pack("<IB", START_TIME, 150)
+        body += bytes([0x01]) + struct.pack("<IHB", START_TIME + 1, 300, 80)
+        body += bytes([0x00]) + struct.pack("<IB", START_TIME + 2, 0xFF)
+        body += bytes([0x01]) + struct.pack("<IHB", START_TIME + 3, 303, 81)
+        records = fit.decode(io.BytesIO(build_file(body))).records
+
+        assert len(records) == 4
+        assert records["heart_rate"] == [150, 300, None, 303]
+        assert list(records["cadence"]) == [0xFF, 80, 0xFF, 81]
+        assert records.invalid_value("heart_rate") is None
+
+    def test_rejects_truncated_and_foreign_files(self):
+        with pytest.raises(fit.FitError):
+            fit.decode(io.BytesIO(build_activity(10)[:-40]))
+        with pytest.raises(fit.FitError):
+            fit.decode(io.BytesIO(b"\x0e" + b"not a fit file at all"))
+
+
+class TestSeriesSidecar:
+    def test_write_and_memory_map(self, tmp_path):
+        import numpy as np
+        import series
+
+        blob = tmp_path / "blob"
+        blob.write_bytes(build_activity(3600, compressed_every=5))
+        activity = fit.decode(str(blob))
+        assert series.write_series(activity, str(blob)) == 3600
+
+        data = series.Series(str(blob))
+        assert isinstance(data["hr"], np.memmap)
+        window = data.window(1800, 1859)
+        assert window == slice(1800, 1860)
+        assert data["t"][window][0] == 1800
+        speed = record_values(1800)["speed"] / 1000
+        assert data["pace"][1800] == pytest.approx(1000 / speed, rel=1e-5)
+        assert data["lat"][0] == pytest.approx(record_values(0)["position_lat"] * 180 / 2**31)
+
+        series.remove_series(str(blob))
+        assert not series.Series.exists(str(blob))
+
+
+class TestDownsample:
+    def series_with_spike(self):
+        import numpy as np
+        x = np.arange(10_000, dtype=np.float64)
+        y = np.sin(x / 500)
+        y[4321] = 25.0
+        y[100:200] = np.nan
+        return x, y
+
+    def test_lttb_keeps_endpoints_and_peaks(self):
+        import numpy as np
+        import downsample
+
+        x, y = self.series_with_spike()
+        indices = downsample.lttb(x, y, 200)
+        assert len(indices) == 200
+        assert indices[0] == 0 and indices[-1] == len(x) - 1
+        assert 4321 in indices
+        assert np.all(np.diff(indices) > 0)
+        assert not np.isnan(y[indices]).any()
+
+    def test_min_max_keeps_extremes(self):
+        import numpy as np
+        import downsample
+
+        x, y = self.series_with_spike()
+        indices = downsample.min_max(y, 100)
+        assert len(indices) <= 100
+        assert 4321 in indices
+        assert int(np.nanargmin(y)) in indices
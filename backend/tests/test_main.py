@@ -1,11 +1,15 @@
+import json
+
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, select, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
 from main import app
-from database import Base, get_db
+from auth import USER_CACHE
+from database import Base, get_db, get_session_factory
+import models
 
 
 # Test database setup
@@ -27,6 +31,7 @@ def override_get_db():
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_session_factory] = lambda: TestingSessionLocal
 
 
 @pytest.fixture(autouse=True)
@@ -34,11 +39,25 @@ def setup_database():
     Base.metadata.create_all(bind=engine)
     yield
     Base.metadata.drop_all(bind=engine)
+    USER_CACHE.clear()
 
 
 client = TestClient(app)
 
 
+def get_auth_header(email="uploader@example.com"):
+    client.post(
+        "/api/users/register",
+        json={"email": email, "password": "securepassword123"},
+    )
+    response = client.post(
+        "/api/users/login",
+        data={"username": email, "password": "securepassword123"},
+    )
+    token = response.json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
 class TestUserRegistration:
     def test_register_success(self):
         response = client.post(
@@ -193,3 +212,1825 @@ class TestFileUpload:
         data = response.json()
         assert len(data) == 1
         assert data[0]["filename"] == "test.fit"
+
+
+class TestStreamingUpload:
+    def test_upload_larger_than_chunk_size(self, tmp_path, monkeypatch):
+        import hashlib
+        import os
+        import routers.uploads
+        import storage
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        monkeypatch.setattr(storage, "CHUNK_SIZE", 4096)
+
+        payload = os.urandom(1024 * 1024)
+        headers = get_auth_header()
+        response = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("big.fit", payload, "application/octet-stream")},
+        )
+        assert response.status_code == 201
+        with open(response.json()["filepath"], "rb") as f:
+            assert hashlib.sha256(f.read()).digest() == hashlib.sha256(payload).digest()
+        assert not [p for p in tmp_path.rglob("*.part")]
+
+    def test_upload_too_large(self, tmp_path, monkeypatch):
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        monkeypatch.setattr(routers.uploads, "MAX_UPLOAD_SIZE", 1024)
+
+        headers = get_auth_header()
+        response = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("big.fit", b"x" * 4096, "application/octet-stream")},
+        )
+        assert response.status_code == 413
+        assert not [p for p in tmp_path.rglob("*") if p.is_file()]
+
+    def test_stream_to_file_memory_is_constant(self, tmp_path, monkeypatch):
+        import tracemalloc
+        import storage
+        monkeypatch.setattr(storage, "CHUNK_SIZE", 64 * 1024)
+
+        src_path = tmp_path / "src.bin"
+        with open(src_path, "wb") as f:
+            for _ in range(256):
+                f.write(b"\x5a" * 64 * 1024)
+
+        with open(src_path, "rb") as src:
+            tracemalloc.start()
+            stored = storage.stream_to_file(src, str(tmp_path / "out" / "dst.fit"))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        assert stored.size == 16 * 1024 * 1024
+        assert peak < 4 * storage.CHUNK_SIZE
+
+
+class TestBatchUpload:
+    def test_batch_of_files_and_zip(self, tmp_path, monkeypatch):
+        import io
+        import zipfile
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as zf:
+            zf.writestr("history/2023-01-01.fit", b"zipped one")
+            zf.writestr("history/2023-01-02.fit", b"zipped two")
+            zf.writestr("__MACOSX/history/._2023-01-01.fit", b"resource fork")
+
+        headers = get_auth_header()
+        response = client.post(
+            "/api/upload/batch",
+            headers=headers,
+            files=[
+                ("files", ("a.fit", b"plain one", "application/octet-stream")),
+                ("files", ("notes.txt", b"not a fit file", "text/plain")),
+                ("files", ("history.zip", archive.getvalue(), "application/zip")),
+            ],
+            data={
+                "session_type": "training",
+                "fatigue_level": "2",
+                "metadata": json.dumps({"2023-01-02.fit": {"session_type": "race", "race_name": "UTMB"}}),
+            },
+        )
+        assert response.status_code == 200
+        body = response.json()
+        assert (body["created"], body["failed"]) == (3, 1)
+        results = {r["filename"]: r for r in body["results"]}
+        assert set(results) == {"a.fit", "notes.txt", "2023-01-01.fit", "2023-01-02.fit"}
+        assert "Only .fit files" in results["notes.txt"]["error"]
+        assert results["a.fit"]["upload"]["session_type"] == "training"
+        assert results["2023-01-01.fit"]["upload"]["fatigue_level"] == 2
+        race = results["2023-01-02.fit"]["upload"]
+        assert (race["session_type"], race["race_name"], race["fatigue_level"]) == ("race", "UTMB", 2)
+
+        listed = client.get("/api/upload/", headers=headers).json()
+        assert len(listed) == 3
+        status = client.get(f"/api/upload/{race['id']}/status", headers=headers).json()
+        assert status["state"] == "queued"
+
+    def test_batch_rejects_invalid_metadata(self):
+        headers = get_auth_header()
+        response = client.post(
+            "/api/upload/batch",
+            headers=headers,
+            files=[("files", ("a.fit", b"content", "application/octet-stream"))],
+            data={"metadata": json.dumps({"a.fit": {"fatigue_level": 9}})},
+        )
+        assert response.status_code == 422
+        db = TestingSessionLocal()
+        assert db.query(models.Upload).count() == 0
+        db.close()
+
+    def test_damaged_zip_member_fails_alone(self, tmp_path, monkeypatch):
+        import io
+        import zipfile
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zf:
+            zf.writestr("good.fit", b"intact member")
+            zf.writestr("bad.fit", b"damaged member")
+        data = archive.getvalue().replace(b"damaged member", b"damaged membeR")
+
+        headers = get_auth_header()
+        response = client.post(
+            "/api/upload/batch",
+            headers=headers,
+            files=[
+                ("files", ("a.fit", b"plain one", "application/octet-stream")),
+                ("files", ("history.zip", data, "application/zip")),
+            ],
+        )
+        assert response.status_code == 200
+        body = response.json()
+        assert (body["created"], body["failed"]) == (2, 1)
+        results = {r["filename"]: r for r in body["results"]}
+        assert "Damaged" in results["bad.fit"]["error"]
+
+    def test_failed_batch_removes_new_blob_files(self, tmp_path, monkeypatch):
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        headers = get_auth_header()
+        client.post(
+            "/api/upload/", headers=headers,
+            files={"file": ("old.fit", b"already stored", "application/octet-stream")},
+        )
+        before = sorted(p for p in tmp_path.rglob("*") if p.is_file())
+
+        def fail(*args):
+            raise RuntimeError("database went away")
+
+        monkeypatch.setattr(routers.uploads.ingestion, "enqueue_many", fail)
+        with pytest.raises(RuntimeError):
+            client.post(
+                "/api/upload/batch",
+                headers=headers,
+                files=[
+                    ("files", ("new.fit", b"brand new", "application/octet-stream")),
+                    ("files", ("again.fit", b"already stored", "application/octet-stream")),
+                ],
+            )
+        assert sorted(p for p in tmp_path.rglob("*") if p.is_file()) == before
+        db = TestingSessionLocal()
+        assert db.query(models.Blob).one().ref_count == 1
+        db.close()
+
+    def test_batch_file_limit(self, monkeypatch):
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "MAX_BATCH_FILES", 1)
+
+        headers = get_auth_header()
+        response = client.post(
+            "/api/upload/batch",
+            headers=headers,
+            files=[("files", (f"{i}.fit", b"content", "application/octet-stream")) for i in range(2)],
+        )
+        assert response.status_code == 400
+
+
+class TestResumableUpload:
+    def create_session(self, headers, length, **metadata):
+        response = client.post(
+            "/api/upload/sessions",
+            headers=headers,
+            json={"filename": "race.fit", "length": length, **metadata},
+        )
+        assert response.status_code == 201
+        return response.headers["Location"]
+
+    def patch(self, headers, location, offset, data):
+        return client.patch(
+            location,
+            headers={
+                **headers,
+                "Upload-Offset": str(offset),
+                "Content-Type": "application/offset+octet-stream",
+            },
+            content=data,
+        )
+
+    def test_resume_and_commit(self, tmp_path, monkeypatch):
+        import os
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        payload = os.urandom(300_000)
+        headers = get_auth_header()
+        location = self.create_session(headers, len(payload), session_type="race", race_name="UTMB")
+
+        assert self.patch(headers, location, 0, payload[:100_000]).headers["Upload-Offset"] == "100000"
+        # The connection dropped; ask where to resume.
+        head = client.head(location, headers=headers)
+        assert head.headers["Upload-Offset"] == "100000"
+        assert head.headers["Upload-Length"] == str(len(payload))
+
+        stale = self.patch(headers, location, 0, payload[:100_000])
+        assert stale.status_code == 409
+        assert stale.headers["Upload-Offset"] == "100000"
+        assert client.post(f"{location}/commit", headers=headers).status_code == 409
+
+        response = self.patch(headers, location, 100_000, payload[100_000:])
+        assert response.status_code == 204
+        assert response.headers["Upload-Offset"] == str(len(payload))
+        db = TestingSessionLocal()
+        assert db.query(models.Upload).count() == 0
+        db.close()
+
+        response = client.post(f"{location}/commit", headers=headers)
+        assert response.status_code == 201
+        data = response.json()
+        assert (data["filename"], data["session_type"], data["race_name"]) == ("race.fit", "race", "UTMB")
+        with open(data["filepath"], "rb") as f:
+            assert f.read() == payload
+        assert not list((tmp_path / "partial").iterdir())
+        assert client.head(location, headers=headers).status_code == 404
+
+    def test_data_beyond_declared_length(self, tmp_path, monkeypatch):
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        location = self.create_session(headers, 10)
+        assert self.patch(headers, location, 0, b"x" * 11).status_code == 413
+        assert client.head(location, headers=headers).headers["Upload-Offset"] == "0"
+
+    def test_concurrent_writer_is_locked_out(self, tmp_path, monkeypatch):
+        import fcntl
+        import resumable
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        location = self.create_session(headers, 10)
+        session_id = location.rstrip("/").rsplit("/", 1)[-1]
+        with open(resumable.partial_path(str(tmp_path), session_id), "r+b") as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            assert self.patch(headers, location, 0, b"x").status_code == 423
+            assert client.post(f"{location}/commit", headers=headers).status_code == 423
+        assert self.patch(headers, location, 0, b"x").status_code == 204
+
+    def test_session_is_private(self, tmp_path, monkeypatch):
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        location = self.create_session(get_auth_header(), 10)
+        other = get_auth_header("other@example.com")
+        assert self.patch(other, location, 0, b"x").status_code == 404
+        assert client.delete(location, headers=other).status_code == 404
+
+    def test_expired_sessions_are_purged(self, tmp_path, monkeypatch):
+        from datetime import datetime, timedelta
+        import resumable
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        location = self.create_session(headers, 10)
+        self.patch(headers, location, 0, b"12345")
+        kept = self.create_session(headers, 10)
+
+        db = TestingSessionLocal()
+        expired = db.get(models.UploadSession, location.rsplit("/", 1)[1])
+        expired.expires_at = datetime.utcnow() - timedelta(seconds=1)
+        db.commit()
+        assert resumable.purge_expired_sessions(db, str(tmp_path)) == 1
+        assert db.query(models.UploadSession).count() == 1
+        db.close()
+
+        assert [p.name for p in (tmp_path / "partial").iterdir()] == [kept.rsplit("/", 1)[1]]
+        assert client.head(location, headers=headers).status_code == 404
+
+
+class TestExport:
+    def seed(self):
+        from datetime import datetime
+        db = TestingSessionLocal()
+        me = db.query(models.User.id).filter(models.User.email == "uploader@example.com").scalar()
+        other = models.User(email="someone@example.com", hashed_password="x")
+        db.add(other)
+        db.flush()
+        for i, (user_id, session_type) in enumerate(
+            [(me, "race"), (me, "training"), (me, "training"), (other.id, "race")]
+        ):
+            db.add(models.Upload(
+                user_id=user_id, filename=f"{i}.fit", filepath=f"/tmp/{i}.fit",
+                upload_date=datetime(2024, 1 + i, 1), session_type=session_type,
+                fatigue_level=i + 1, notes="cramps, then \"fine\"" if i == 1 else None,
+            ))
+        db.commit()
+        db.close()
+
+    def test_ndjson_is_scoped_and_filtered(self):
+        headers = get_auth_header()
+        self.seed()
+
+        response = client.get("/api/upload/export", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [r["filename"] for r in rows] == ["0.fit", "1.fit", "2.fit"]
+        assert rows[1]["notes"] == 'cramps, then "fine"'
+        assert rows[0]["session_type"] == "race"
+
+        response = client.get(
+            "/api/upload/export",
+            headers=headers,
+            params={"session_type": "training", "from": "2024-02-15", "to": "2024-12-31"},
+        )
+        assert [json.loads(line)["filename"] for line in response.text.splitlines()] == ["2.fit"]
+
+    def test_csv(self):
+        import csv
+        import io
+        headers = get_auth_header()
+        self.seed()
+
+        response = client.get("/api/upload/export", headers=headers, params={"format": "csv"})
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert [r["fatigue_level"] for r in rows] == ["1", "2", "3"]
+        assert rows[1]["notes"] == 'cramps, then "fine"'
+        assert rows[0]["race_name"] == ""
+
+    def test_parquet(self):
+        import io
+        pq = pytest.importorskip("pyarrow.parquet")
+        headers = get_auth_header()
+        self.seed()
+
+        response = client.get("/api/upload/export", headers=headers, params={"format": "parquet"})
+        table = pq.read_table(io.BytesIO(response.content))
+        assert table.column("filename").to_pylist() == ["0.fit", "1.fit", "2.fit"]
+        assert table.column("session_type").to_pylist() == ["race", "training", "training"]
+
+    def test_rows_are_streamed_in_batches(self, monkeypatch):
+        import export
+        monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 2)
+        get_auth_header()
+        self.seed()
+
+        db = TestingSessionLocal()
+        chunks = list(export.stream(db, export.build_query(), "ndjson"))
+        db.close()
+        assert [chunk.count(b"\n") for chunk in chunks] == [2, 2]
+
+    def test_cli_exports_every_user(self, tmp_path, monkeypatch):
+        import cli
+        monkeypatch.setattr(cli, "SessionLocal", TestingSessionLocal)
+        get_auth_header()
+        self.seed()
+
+        output = tmp_path / "uploads.ndjson"
+        assert cli.main(["export", "--session-type", "race", "--output", str(output)]) == 0
+        rows = [json.loads(line) for line in output.read_text().splitlines()]
+        assert [r["filename"] for r in rows] == ["0.fit", "3.fit"]
+
+
+class TestUserStats:
+    def test_stats_follow_uploads_and_deletes(self, tmp_path, monkeypatch):
+        import routers.uploads
+        import user_stats
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        assert client.get("/api/users/me/stats", headers=headers).json()["total"]["uploads"] == 0
+
+        single = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("a.fit", b"a", "application/octet-stream")},
+            data={"session_type": "training", "fatigue_level": "2", "sleep_quality": "4"},
+        ).json()
+        client.post(
+            "/api/upload/batch",
+            headers=headers,
+            files=[("files", (f"{name}.fit", name.encode(), "application/octet-stream")) for name in "bc"],
+            data={"session_type": "race", "fatigue_level": "5"},
+        )
+
+        stats = client.get("/api/users/me/stats", headers=headers).json()
+        assert stats["total"] == {
+            "uploads": 3,
+            "by_session_type": {"race": 2, "training": 1, "recovery": 0},
+            "avg_fatigue": 4.0,
+            "avg_sensation": None,
+            "avg_sleep_quality": 4.0,
+        }
+        assert stats["last_30_days"] == stats["total"]
+        assert len(stats["weeks"]) == 1 and stats["weeks"][0]["uploads"] == 3
+
+        client.delete(f"/api/upload/{single['id']}", headers=headers)
+        stats = client.get("/api/users/me/stats", headers=headers).json()
+        assert stats["total"]["by_session_type"]["training"] == 0
+        assert stats["total"]["avg_sleep_quality"] is None
+
+        db = TestingSessionLocal()
+        assert user_stats.rebuild(db) == 2
+        db.commit()
+        db.close()
+        assert client.get("/api/users/me/stats", headers=headers).json() == stats
+
+    def test_weekly_buckets(self):
+        from datetime import date, datetime
+        import cli
+        import user_stats
+
+        db = TestingSessionLocal()
+        user = models.User(email="weeks@example.com", hashed_password="x")
+        db.add(user)
+        db.flush()
+        # Wednesday 2024-05-29 is "today"; its week starts on Monday 05-27.
+        for day, fatigue in [(datetime(2024, 5, 27, 6), 1), (datetime(2024, 5, 26, 23), 3),
+                             (datetime(2024, 4, 30, 7), 5), (datetime(2024, 4, 29, 10), 4),
+                             (datetime(2024, 1, 2), 2)]:
+            db.add(models.Upload(user_id=user.id, filename="x.fit", filepath="/tmp/x.fit",
+                                 upload_date=day, fatigue_level=fatigue))
+        db.commit()
+        cli.SessionLocal, original = TestingSessionLocal, cli.SessionLocal
+        try:
+            assert cli.main(["rebuild-stats", "--user-id", str(user.id)]) == 0
+        finally:
+            cli.SessionLocal = original
+
+        summary = user_stats.summary(db, user.id, weeks=2, today=date(2024, 5, 29))
+        db.close()
+        assert summary["total"]["uploads"] == 5
+        # The 30 days run from Tuesday 04-30, partway through a week.
+        assert summary["last_30_days"]["uploads"] == 3
+        assert summary["last_30_days"]["avg_fatigue"] == 3.0
+        assert [(w["week_start"], w["uploads"]) for w in summary["weeks"]] == [
+            (date(2024, 5, 27), 1), (date(2024, 5, 20), 1),
+        ]
+
+
+class TestBlobStore:
+    def test_duplicate_upload_is_stored_once(self, tmp_path, monkeypatch):
+        import routers.uploads
+        import storage
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        first = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("watch.fit", b"same activity", "application/octet-stream")},
+        )
+        assert first.status_code == 201
+
+        def fail_write(*args, **kwargs):
+            raise AssertionError("duplicate upload must not be written to disk")
+
+        monkeypatch.setattr(storage, "stream_to_file", fail_write)
+        second = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("connect.fit", b"same activity", "application/octet-stream")},
+        )
+        assert second.status_code == 201
+        assert second.json()["content_hash"] == first.json()["content_hash"]
+        assert second.json()["filepath"] == first.json()["filepath"]
+        assert len([p for p in tmp_path.rglob("*") if p.is_file()]) == 1
+
+        db = TestingSessionLocal()
+        blob = db.query(models.Blob).one()
+        assert blob.ref_count == 2
+        db.close()
+
+    def test_delete_releases_blob(self, tmp_path, monkeypatch):
+        import os
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        ids = []
+        for name in ("a.fit", "b.fit"):
+            response = client.post(
+                "/api/upload/",
+                headers=headers,
+                files={"file": (name, b"shared bytes", "application/octet-stream")},
+            )
+            ids.append(response.json()["id"])
+        path = response.json()["filepath"]
+
+        assert client.delete(f"/api/upload/{ids[0]}", headers=headers).status_code == 204
+        assert os.path.exists(path)
+        assert client.delete(f"/api/upload/{ids[1]}", headers=headers).status_code == 204
+        assert not os.path.exists(path)
+        assert client.delete(f"/api/upload/{ids[1]}", headers=headers).status_code == 404
+
+    def test_stale_blob_file_is_replaced(self, tmp_path):
+        import io
+        import os
+        import storage
+
+        db = TestingSessionLocal()
+        content_hash = storage.hash_stream(io.BytesIO(b"fresh bytes"))[0]
+        stale = storage.blob_path(str(tmp_path), content_hash)
+        os.makedirs(os.path.dirname(stale))
+        with open(stale, "wb") as f:
+            f.write(b"half")
+        stored = storage.acquire_blob(db, str(tmp_path), io.BytesIO(b"fresh bytes"), compression="none")
+        db.commit()
+        db.close()
+        with open(stored.path, "rb") as f:
+            assert f.read() == b"fresh bytes"
+
+    def test_reupload_during_delete_keeps_its_file(self, tmp_path):
+        import io
+        import os
+        import storage
+
+        root = str(tmp_path)
+        db = TestingSessionLocal()
+        stored = storage.acquire_blob(db, root, io.BytesIO(b"racy"), compression="none")
+        db.commit()
+
+        released = storage.release_blob(db, root, stored.sha256)
+        db.rollback()
+        released.restore()
+        assert os.path.exists(stored.path)
+
+        # The deleter commits, then an upload of the same bytes lands before
+        # it removes the file it released.
+        released = storage.release_blob(db, root, stored.sha256)
+        db.commit()
+        again = storage.acquire_blob(db, root, io.BytesIO(b"racy"), compression="none")
+        db.commit()
+        released.remove()
+        db.close()
+        with open(again.path, "rb") as f:
+            assert f.read() == b"racy"
+
+
+
+class TestBlobCompression:
+    def upload(self, headers, content):
+        response = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("activity.fit", content, "application/octet-stream")},
+        )
+        assert response.status_code == 201
+        return response.json()
+
+    def test_compressed_blob_is_parsed_transparently(self, tmp_path, monkeypatch):
+        import os
+        import ingestion
+        import routers.uploads
+        import storage
+        from fit_builder import build_activity
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        monkeypatch.setattr(storage, "BLOB_COMPRESSION", "zstd")
+
+        headers = get_auth_header()
+        data = build_activity(600)
+        upload = self.upload(headers, data)
+        assert upload["filepath"].endswith(".zst")
+        assert os.path.getsize(upload["filepath"]) < len(data)
+
+        db = TestingSessionLocal()
+        row = db.get(models.Upload, upload["id"])
+        assert (row.compression, row.original_size) == ("zstd", len(data))
+        assert db.get(models.Blob, upload["content_hash"]).stored_size == os.path.getsize(
+            upload["filepath"]
+        )
+        db.close()
+        with storage.open_blob(upload["filepath"], "zstd") as src:
+            assert src.read() == data
+
+        assert ingestion.run_pending(TestingSessionLocal) == 1
+        status_ = client.get(f"/api/upload/{upload['id']}/status", headers=headers).json()
+        assert status_["record_count"] == 600
+
+    def test_zstd_falls_back_to_gzip(self, tmp_path, monkeypatch):
+        import routers.uploads
+        import storage
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        monkeypatch.setattr(storage, "BLOB_COMPRESSION", "zstd")
+        monkeypatch.setattr(storage, "zstandard", None)
+
+        upload = self.upload(get_auth_header(), b"activity bytes" * 100)
+        assert upload["filepath"].endswith(".gz")
+        with storage.open_blob(upload["filepath"], "gzip") as src:
+            assert src.read() == b"activity bytes" * 100
+
+    def test_recompress_command_rewrites_existing_blobs(self, tmp_path, monkeypatch):
+        import os
+        import cli
+        import ingestion
+        import routers.uploads
+        import series
+        import storage
+        from fit_builder import build_activity
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        monkeypatch.setattr(cli, "SessionLocal", TestingSessionLocal)
+
+        headers = get_auth_header()
+        data = build_activity(300)
+        first = self.upload(headers, data)
+        second = self.upload(headers, data)
+        ingestion.run_pending(TestingSessionLocal)
+        old_path = first["filepath"]
+        assert not old_path.endswith(storage.SUFFIXES["zstd"])
+        etag = client.get("/api/upload/", headers=headers).headers["ETag"]
+
+        assert cli.main(["recompress", "--compression", "zstd"]) == 0
+        assert not os.path.exists(old_path)
+        # Cached lists hold the old filepath, so they must not revalidate.
+        listed = client.get("/api/upload/", headers={**headers, "If-None-Match": etag})
+        assert listed.status_code == 200
+        assert {u["filepath"] for u in listed.json()} == {old_path + ".zst"}
+        db = TestingSessionLocal()
+        rows = [db.get(models.Upload, upload["id"]) for upload in (first, second)]
+        assert {(row.filepath, row.compression) for row in rows} == {(old_path + ".zst", "zstd")}
+        db.close()
+        # The sidecar survives, and a reader holding the old path still gets the data.
+        assert series.Series.exists(old_path + ".zst")
+        with storage.open_blob(old_path) as src:
+            assert src.read() == data
+        assert client.get(f"/api/upload/{first['id']}/series", headers=headers).status_code == 200
+
+
+class TestDownload:
+    data = bytes(range(256)) * 40
+
+    def upload(self, tmp_path, monkeypatch, compression="none"):
+        import routers.uploads
+        import storage
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        monkeypatch.setattr(storage, "BLOB_COMPRESSION", compression)
+        headers = get_auth_header()
+        response = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("morning run.fit", self.data, "application/octet-stream")},
+        )
+        assert response.status_code == 201
+        return headers, f"/api/upload/{response.json()['id']}/file"
+
+    def test_download_whole_file(self, tmp_path, monkeypatch):
+        headers, url = self.upload(tmp_path, monkeypatch)
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert response.content == self.data
+        assert response.headers["accept-ranges"] == "bytes"
+        assert response.headers["content-length"] == str(len(self.data))
+        assert response.headers["etag"].startswith('"')
+        assert "morning%20run.fit" in response.headers["content-disposition"]
+
+        head = client.head(url, headers=headers)
+        assert head.status_code == 200
+        assert head.content == b""
+        assert head.headers["content-length"] == str(len(self.data))
+
+        other = get_auth_header("other@example.com")
+        assert client.get(url, headers=other).status_code == 404
+
+    @pytest.mark.parametrize("compression", ["none", "zstd"])
+    def test_single_ranges(self, tmp_path, monkeypatch, compression):
+        headers, url = self.upload(tmp_path, monkeypatch, compression)
+        size = len(self.data)
+        for spec, (first, last) in (
+            ("bytes=100-199", (100, 199)),
+            ("bytes=9000-", (9000, size - 1)),
+            ("bytes=-10", (size - 10, size - 1)),
+            ("bytes=10000-99999", (10000, size - 1)),
+        ):
+            response = client.get(url, headers={**headers, "Range": spec})
+            assert response.status_code == 206, spec
+            assert response.headers["content-range"] == f"bytes {first}-{last}/{size}"
+            assert response.content == self.data[first:last + 1]
+
+        response = client.get(url, headers={**headers, "Range": f"bytes={size}-"})
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{size}"
+        # Malformed ranges are ignored.
+        assert client.get(url, headers={**headers, "Range": "bytes=5-1"}).status_code == 200
+
+    @pytest.mark.parametrize("compression", ["none", "zstd"])
+    def test_multiple_ranges(self, tmp_path, monkeypatch, compression):
+        from email import message_from_bytes
+
+        headers, url = self.upload(tmp_path, monkeypatch, compression)
+        response = client.get(url, headers={**headers, "Range": "bytes=5000-5009, 0-9, 8-19"})
+        assert response.status_code == 206
+        content_type = response.headers["content-type"]
+        assert content_type.startswith("multipart/byteranges; boundary=")
+        assert int(response.headers["content-length"]) == len(response.content)
+
+        message = message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n"
+                                     + response.content)
+        parts = [(part["Content-Range"], part.get_payload(decode=True)) for part in message.get_payload()]
+        size = len(self.data)
+        assert parts == [
+            (f"bytes 0-19/{size}", self.data[0:20]),
+            (f"bytes 5000-5009/{size}", self.data[5000:5010]),
+        ]
+
+    def test_conditional_requests(self, tmp_path, monkeypatch):
+        headers, url = self.upload(tmp_path, monkeypatch)
+        first = client.get(url, headers=headers)
+        etag = first.headers["etag"]
+        last_modified = first.headers["last-modified"]
+
+        response = client.get(url, headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        response = client.get(url, headers={**headers, "If-Modified-Since": last_modified})
+        assert response.status_code == 304
+        response = client.get(
+            url, headers={**headers, "If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"}
+        )
+        assert response.status_code == 200
+
+        resume = {**headers, "Range": "bytes=100-"}
+        assert client.get(url, headers={**resume, "If-Range": etag}).status_code == 206
+        assert client.get(url, headers={**resume, "If-Range": last_modified}).status_code == 206
+        stale = client.get(url, headers={**resume, "If-Range": '"changed"'})
+        assert stale.status_code == 200
+        assert stale.content == self.data
+
+    def test_zerocopy_extension_is_used_when_offered(self, tmp_path):
+        import asyncio
+        import download
+
+        path = tmp_path / "blob"
+        path.write_bytes(self.data)
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        response = download.BlobResponse(open(path, "rb"), len(self.data), [(10, 19)])
+        scope = {"type": "http", "method": "GET", "extensions": {"http.response.zerocopy": {}}}
+        asyncio.run(response(scope, None, send))
+        zerocopy = [m for m in messages if m["type"] == "http.response.zerocopy"]
+        assert [(m["offset"], m["count"]) for m in zerocopy] == [(10, 10)]
+        assert response.src.closed
+
+class TestIngestion:
+    def upload(self, headers, content, name="activity.fit"):
+        response = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": (name, content, "application/octet-stream")},
+        )
+        assert response.status_code == 201
+        return response.json()["id"]
+
+    def test_upload_enqueues_job_processed_in_background(self, tmp_path, monkeypatch):
+        import ingestion
+        import routers.uploads
+        from fit_builder import build_activity
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        upload_id = self.upload(headers, build_activity(120))
+
+        response = client.get(f"/api/upload/{upload_id}/status", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["state"] == "queued"
+
+        assert ingestion.run_pending(TestingSessionLocal) == 1
+        data = client.get(f"/api/upload/{upload_id}/status", headers=headers).json()
+        assert data["state"] == "done"
+        assert data["attempts"] == 1
+        assert data["record_count"] == 120
+
+    def test_failed_job_is_retried_then_marked_failed(self, tmp_path, monkeypatch):
+        import ingestion
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        monkeypatch.setattr(ingestion, "MAX_ATTEMPTS", 2)
+        monkeypatch.setattr(ingestion, "RETRY_BACKOFF_SECONDS", 0)
+
+        headers = get_auth_header()
+        upload_id = self.upload(headers, b"not a fit file")
+
+        ingestion.run_pending(TestingSessionLocal)
+        data = client.get(f"/api/upload/{upload_id}/status", headers=headers).json()
+        assert data["state"] == "failed"
+        assert data["attempts"] == 2
+        assert "FitError" in data["error"]
+
+    def test_status_of_other_users_upload_is_hidden(self, tmp_path, monkeypatch):
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        upload_id = self.upload(get_auth_header(), b"data")
+        other = get_auth_header("other@example.com")
+        assert client.get(f"/api/upload/{upload_id}/status", headers=other).status_code == 404
+
+    def test_worker_runs_jobs_on_executor(self, tmp_path, monkeypatch):
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        import ingestion
+        import routers.uploads
+        from fit_builder import build_activity
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        monkeypatch.setattr(ingestion, "POLL_INTERVAL_SECONDS", 0.01)
+
+        headers = get_auth_header()
+        ids = [self.upload(headers, build_activity(10 + i), f"{i}.fit") for i in range(3)]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            worker = ingestion.IngestionWorker(TestingSessionLocal, max_workers=2, executor=executor)
+            worker.start()
+            deadline = time.time() + 10
+            states = []
+            while time.time() < deadline:
+                states = [
+                    client.get(f"/api/upload/{i}/status", headers=headers).json()["state"]
+                    for i in ids
+                ]
+                if states == ["done"] * 3:
+                    break
+                time.sleep(0.05)
+            worker.stop()
+        assert states == ["done"] * 3
+
+    def test_worker_replaces_broken_pool(self, tmp_path, monkeypatch):
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+        import ingestion
+        import routers.uploads
+        from fit_builder import build_activity
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        monkeypatch.setattr(ingestion, "POLL_INTERVAL_SECONDS", 0.01)
+        monkeypatch.setattr(ingestion, "RETRY_BACKOFF_SECONDS", 0)
+
+        class BrokenExecutor(ThreadPoolExecutor):
+            def submit(self, *args, **kwargs):
+                raise BrokenProcessPool("A child process terminated abruptly")
+
+        pools = [BrokenExecutor(max_workers=1), ThreadPoolExecutor(max_workers=1)]
+        monkeypatch.setattr(ingestion.IngestionWorker, "_new_executor", lambda self: pools.pop(0))
+
+        headers = get_auth_header()
+        ids = [self.upload(headers, build_activity(10 + i), f"{i}.fit") for i in range(2)]
+        worker = ingestion.IngestionWorker(TestingSessionLocal, max_workers=1)
+        worker.start()
+        deadline = time.time() + 10
+        statuses = []
+        while time.time() < deadline:
+            statuses = [client.get(f"/api/upload/{i}/status", headers=headers).json() for i in ids]
+            if all(status["state"] == "done" for status in statuses):
+                break
+            time.sleep(0.05)
+        worker.stop()
+        assert [status["state"] for status in statuses] == ["done", "done"]
+        # The job claimed when the pool broke was retried on the new one.
+        assert statuses[0]["attempts"] == 2
+
+
+class TestSeries:
+    def test_series_window_from_sidecar(self, tmp_path, monkeypatch):
+        import ingestion
+        import routers.uploads
+        from fit_builder import build_activity, record_values
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        upload_id = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("run.fit", build_activity(600), "application/octet-stream")},
+        ).json()["id"]
+
+        response = client.get(f"/api/upload/{upload_id}/series", headers=headers)
+        assert response.status_code == 409
+
+        ingestion.run_pending(TestingSessionLocal)
+        response = client.get(
+            f"/api/upload/{upload_id}/series",
+            headers=headers,
+            params={"channels": "hr,alt,power", "from": 100, "to": 109},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["t"] == list(range(100, 110))
+        assert data["channels"]["hr"] == [record_values(i)["heart_rate"] for i in range(100, 110)]
+        assert data["channels"]["alt"][0] == record_values(100)["altitude"] / 5 - 500
+        assert data["channels"]["power"] is None
+
+    def test_unknown_channel(self):
+        headers = get_auth_header()
+        response = client.get("/api/upload/1/series", headers=headers, params={"channels": "vo2"})
+        assert response.status_code == 400
+
+    def test_downsampled_series_is_cached(self, tmp_path, monkeypatch):
+        import ingestion
+        import routers.uploads
+        from fit_builder import build_activity
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        routers.uploads.SERIES_CACHE.clear()
+
+        headers = get_auth_header()
+        upload_id = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("run.fit", build_activity(5000), "application/octet-stream")},
+        ).json()["id"]
+        ingestion.run_pending(TestingSessionLocal)
+
+        before = client.get("/metrics/cache").json()["series"]
+        params = {"channels": "hr,alt", "max_points": 200}
+        for method in ("lttb", "lttb", "minmax"):
+            response = client.get(
+                f"/api/upload/{upload_id}/series",
+                headers=headers,
+                params={**params, "downsample": method},
+            )
+            assert response.status_code == 200
+            data = response.json()
+            assert 100 <= len(data["t"]) <= 200
+            assert len(data["channels"]["hr"]) == len(data["t"])
+            assert data["t"][0] == 0 and data["t"][-1] == 4999
+
+        after = client.get("/metrics/cache").json()["series"]
+        assert after["misses"] - before["misses"] == 4
+        assert after["hits"] - before["hits"] == 2
+
+    def test_max_points_bounds_all_channels(self, tmp_path, monkeypatch):
+        import numpy as np
+        import downsample
+        import ingestion
+        import routers.uploads
+        import series
+        from fit_builder import build_activity
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        routers.uploads.SERIES_CACHE.clear()
+        # Disjoint picks per channel, as with uncorrelated real channels.
+        rng = np.random.default_rng(0)
+        monkeypatch.setitem(
+            downsample.METHODS, "lttb", lambda t, y, n: np.sort(rng.choice(len(t), n, replace=False))
+        )
+
+        headers = get_auth_header()
+        upload_id = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("run.fit", build_activity(5000), "application/octet-stream")},
+        ).json()["id"]
+        ingestion.run_pending(TestingSessionLocal)
+
+        for max_points in (10, 25, 200):
+            response = client.get(
+                f"/api/upload/{upload_id}/series",
+                headers=headers,
+                params={"channels": ",".join(series.CHANNELS), "max_points": max_points},
+            )
+            assert response.status_code == 200
+            data = response.json()
+            assert len(data["t"]) <= max_points
+            assert data["t"][0] == 0 and data["t"][-1] == 4999
+            for values in data["channels"].values():
+                assert values is None or len(values) == len(data["t"])
+
+
+class TestCursorPagination:
+    def seed(self, count):
+        from datetime import datetime, timedelta
+        db = TestingSessionLocal()
+        user = db.query(models.User).filter(models.User.email == "uploader@example.com").one()
+        base = datetime(2024, 1, 1)
+        for i in range(count):
+            db.add(models.Upload(
+                user_id=user.id,
+                filename=f"file_{i}.fit",
+                filepath=f"/tmp/file_{i}.fit",
+                # Several uploads share each timestamp to exercise the id tiebreak.
+                upload_date=base + timedelta(hours=i // 3),
+            ))
+        db.commit()
+        db.close()
+
+    def test_cursor_pages_match_offset_pages(self):
+        headers = get_auth_header()
+        self.seed(25)
+
+        expected = [
+            u["id"] for u in client.get("/api/upload/", headers=headers, params={"limit": 100}).json()
+        ]
+        seen, cursor = [], None
+        while True:
+            params = {"limit": 7}
+            if cursor:
+                params["cursor"] = cursor
+            response = client.get("/api/upload/", headers=headers, params=params)
+            assert response.status_code == 200
+            seen += [u["id"] for u in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+        assert seen == expected
+        assert len(seen) == 25
+
+    def test_uploads_in_same_second_are_not_repeated(self, tmp_path, monkeypatch):
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        for i in range(3):
+            client.post(
+                "/api/upload/",
+                headers=headers,
+                files={"file": (f"{i}.fit", f"content {i}".encode(), "application/octet-stream")},
+            )
+        first = client.get("/api/upload/", headers=headers, params={"limit": 2})
+        second = client.get(
+            "/api/upload/",
+            headers=headers,
+            params={"limit": 2, "cursor": first.headers["X-Next-Cursor"]},
+        )
+        ids = [u["id"] for u in first.json() + second.json()]
+        assert len(ids) == len(set(ids)) == 3
+        assert "X-Next-Cursor" not in second.headers
+
+    def test_invalid_cursor(self):
+        import base64
+        headers = get_auth_header()
+        short = base64.urlsafe_b64encode(b'["2024-01-01T00:00:00"]').decode()
+        for path, params in (("/api/upload/", {}), ("/api/upload/search", {"q": "utmb"})):
+            for cursor in ("garbage", short):
+                response = client.get(path, headers=headers, params={**params, "cursor": cursor})
+                assert response.status_code == 400
+                assert response.json()["detail"] == "Invalid cursor"
+
+    def test_next_cursor_documented(self):
+        paths = app.openapi()["paths"]
+        for path in ("/api/upload/", "/api/upload/search"):
+            assert "X-Next-Cursor" in paths[path]["get"]["responses"]["200"]["headers"]
+
+
+
+class TestListFilters:
+    def seed(self, user_id, count, offset=0):
+        import random
+        from datetime import datetime, timedelta
+        from sqlalchemy import insert
+        rng = random.Random(count + offset)
+        rows = []
+        for i in range(offset, offset + count):
+            conditions = rng.random() < 0.3
+            rows.append({
+                "user_id": user_id,
+                "filename": f"file_{i}.fit",
+                "filepath": f"/tmp/file_{i}.fit",
+                "upload_date": datetime(2024, 1, 1) + timedelta(hours=i),
+                "session_type": rng.choices(["training", "recovery", "race"], [7, 2, 1])[0],
+                "fatigue_level": rng.randint(1, 5),
+                "sleep_quality": rng.randint(1, 5),
+                "hydration_status": rng.choice(["well_hydrated", "mildly_dehydrated", "uncertain"]),
+                "weather_condition": rng.choice(["sunny", "rain", "fog"]) if conditions else None,
+                "trail_condition": rng.choice(["dry", "muddy", "rocky"]) if conditions else None,
+            })
+        db = TestingSessionLocal()
+        db.execute(insert(models.Upload), rows)
+        db.commit()
+        db.close()
+        return rows
+
+    def user_id(self, email="uploader@example.com"):
+        db = TestingSessionLocal()
+        user_id = db.query(models.User.id).filter(models.User.email == email).scalar()
+        db.close()
+        return user_id
+
+    def test_filters_match_rows(self):
+        headers = get_auth_header()
+        rows = self.seed(self.user_id(), 300)
+        other = get_auth_header("other@example.com")
+        self.seed(self.user_id("other@example.com"), 50, offset=300)
+
+        params = {
+            "session_type": "race",
+            "trail_condition": "muddy",
+            "min_fatigue": 2,
+            "max_sleep": 4,
+            "from": "2024-01-02T00:00:00",
+            "to": "2024-01-12T00:00:00",
+            "limit": 100,
+        }
+        expected = [
+            row["filename"] for row in reversed(rows)
+            if row["session_type"] == "race" and row["trail_condition"] == "muddy"
+            and row["fatigue_level"] >= 2 and row["sleep_quality"] <= 4
+            and "2024-01-02" <= row["upload_date"].isoformat() < "2024-01-12"
+        ]
+        response = client.get("/api/upload/", headers=headers, params=params)
+        assert response.status_code == 200
+        assert [u["filename"] for u in response.json()] == expected
+        assert expected
+
+        weather = client.get("/api/upload/", headers=headers, params={"weather_condition": "fog", "limit": 100})
+        assert {u["weather_condition"] for u in weather.json()} == {"fog"}
+        assert client.get("/api/upload/", headers=other, params=params).json() == []
+
+    def test_filtered_cursor_pages(self):
+        headers = get_auth_header()
+        self.seed(self.user_id(), 200)
+        filters = {"session_type": "training", "hydration_status": "uncertain"}
+        expected = [
+            u["id"] for u in
+            client.get("/api/upload/", headers=headers, params={**filters, "limit": 100}).json()
+        ]
+        seen, cursor = [], None
+        while True:
+            params = {**filters, "limit": 7}
+            if cursor:
+                params["cursor"] = cursor
+            response = client.get("/api/upload/", headers=headers, params=params)
+            seen += [u["id"] for u in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+        assert seen == expected
+
+        # Filtered lists are tagged separately from the unfiltered one.
+        etag = client.get("/api/upload/", headers=headers).headers["ETag"]
+        filtered = client.get("/api/upload/", headers={**headers, "If-None-Match": etag}, params=filters)
+        assert filtered.status_code == 200
+
+    def test_invalid_filters(self):
+        headers = get_auth_header()
+        for params in ({"min_fatigue": 0}, {"max_sleep": 6}, {"session_type": "nap"}, {"from": "soon"}):
+            assert client.get("/api/upload/", headers=headers, params=params).status_code == 422
+
+    def test_filtered_lists_use_indexes(self):
+        from sqlalchemy import event
+        headers = get_auth_header()
+        self.seed(self.user_id(), 2000)
+        # Other users' rows make a scan of the whole table the costly plan.
+        for i in range(1, 10):
+            get_auth_header(f"runner{i}@example.com")
+            self.seed(self.user_id(f"runner{i}@example.com"), 2000, offset=i * 2000)
+        with engine.begin() as connection:
+            connection.exec_driver_sql("ANALYZE")
+
+        cases = [
+            ({"session_type": "race"}, {"ix_uploads_user_id_session_type_upload_date_id"}),
+            ({"trail_condition": "muddy"}, {"ix_uploads_user_id_trail_upload_date_id"}),
+            ({"weather_condition": "rain", "min_fatigue": 3}, {"ix_uploads_user_id_weather_upload_date_id"}),
+            ({"from": "2024-01-10T00:00:00", "to": "2024-01-20T00:00:00"}, {"ix_uploads_user_id_upload_date_id"}),
+            (
+                {"session_type": "race", "trail_condition": "muddy"},
+                {"ix_uploads_user_id_session_type_upload_date_id", "ix_uploads_user_id_trail_upload_date_id"},
+            ),
+        ]
+        for params, indexes in cases:
+            statements = []
+            listener = lambda conn, cursor, statement, parameters, *args: statements.append((statement, parameters))
+            event.listen(engine, "before_cursor_execute", listener)
+            try:
+                first = client.get("/api/upload/", headers=headers, params={**params, "limit": 10})
+                client.get(
+                    "/api/upload/", headers=headers,
+                    params={**params, "limit": 10, "cursor": first.headers["X-Next-Cursor"]},
+                )
+            finally:
+                event.remove(engine, "before_cursor_execute", listener)
+            listings = [(s, p) for s, p in statements if "FROM uploads" in s and "ORDER BY" in s]
+            assert len(listings) == 2
+            for statement, parameters in listings:
+                with engine.connect() as connection:
+                    plan = [
+                        row[3] for row in
+                        connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+                    ]
+                assert len(plan) == 1, plan
+                assert plan[0].startswith("SEARCH uploads USING"), plan
+                assert any(name in plan[0] for name in indexes), plan
+
+
+class TestSearch:
+    def seed(self, email="uploader@example.com"):
+        headers = get_auth_header(email)
+        db = TestingSessionLocal()
+        user = db.query(models.User).filter(models.User.email == email).one()
+        uploads = [
+            models.Upload(user_id=user.id, filename=f"{i}.fit", filepath=f"/tmp/{i}.fit",
+                          race_name=race_name, notes=notes)
+            for i, (race_name, notes) in enumerate([
+                ("UTMB", "Hot afternoon, walked the last climb"),
+                ("Lavaredo Ultra Trail", "Cramps in both calves after the Tre Cime"),
+                (None, "Easy recovery run, slight cramping on the descent"),
+                (None, "Intervals on the track"),
+            ])
+        ]
+        db.add_all(uploads)
+        db.commit()
+        ids = [upload.id for upload in uploads]
+        db.close()
+        return headers, ids
+
+    def test_search_matches_stems_and_ranks_race_names_first(self):
+        headers, ids = self.seed()
+        self.seed("coach@example.com")
+
+        response = client.get("/api/upload/search", params={"q": "cramp"}, headers=headers)
+        assert response.status_code == 200
+        results = response.json()
+        # The other user's matching uploads are not included.
+        assert sorted(r["id"] for r in results) == [ids[1], ids[2]]
+        assert all(r["rank"] > 0 for r in results)
+
+        results = client.get("/api/upload/search", params={"q": "ultra trail"}, headers=headers).json()
+        assert [r["id"] for r in results] == [ids[1]]
+        # A race name outranks the same word in notes.
+        db = TestingSessionLocal()
+        db.get(models.Upload, ids[3]).notes = "Recon for Lavaredo"
+        db.commit()
+        db.close()
+        results = client.get("/api/upload/search", params={"q": "lavaredo"}, headers=headers).json()
+        assert [r["id"] for r in results] == [ids[1], ids[3]]
+
+    def test_search_pages_with_cursor(self):
+        headers, ids = self.seed()
+        seen = []
+        params = {"q": "the", "limit": 1}
+        while True:
+            response = client.get("/api/upload/search", params=params, headers=headers)
+            assert len(response.json()) <= 1
+            seen += [r["id"] for r in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+            params["cursor"] = cursor
+        full = client.get("/api/upload/search", params={"q": "the"}, headers=headers).json()
+        assert seen == [r["id"] for r in full]
+        assert len(seen) == 4
+
+    def test_index_follows_updates_and_deletes(self):
+        headers, ids = self.seed()
+        db = TestingSessionLocal()
+        db.get(models.Upload, ids[3]).notes = "Blistered heel"
+        db.delete(db.get(models.Upload, ids[0]))
+        db.commit()
+        db.close()
+        found = lambda q: [r["id"] for r in client.get(
+            "/api/upload/search", params={"q": q}, headers=headers).json()]
+        assert found("blister") == [ids[3]]
+        assert found("intervals") == []
+        assert found("utmb") == []
+
+    def test_search_input_handling(self):
+        headers, _ = self.seed()
+        assert client.get("/api/upload/search", params={"q": "\"*)("}, headers=headers).json() == []
+        response = client.get("/api/upload/search", params={"q": "x", "cursor": "junk"}, headers=headers)
+        assert response.status_code == 400
+        assert client.get("/api/upload/search", params={"q": ""}, headers=headers).status_code == 422
+
+class TestListETag:
+    def test_unchanged_list_is_not_modified(self, tmp_path, monkeypatch):
+        from sqlalchemy import event
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+
+        headers = get_auth_header()
+        upload = client.post(
+            "/api/upload/", headers=headers,
+            files={"file": ("a.fit", b"a", "application/octet-stream")},
+        ).json()
+        first = client.get("/api/upload/", headers=headers)
+        etag = first.headers["ETag"]
+        assert etag.startswith('W/"')
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            cached = client.get("/api/upload/", headers={**headers, "If-None-Match": etag})
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        assert cached.status_code == 304
+        assert cached.headers["ETag"] == etag
+        assert not cached.content
+        assert not [s for s in statements if "FROM uploads" in s]
+
+        # Other pages are tagged separately.
+        assert client.get("/api/upload/", headers=headers, params={"limit": 5}).headers["ETag"] != etag
+
+        client.post(
+            "/api/upload/", headers=headers,
+            files={"file": ("b.fit", b"b", "application/octet-stream")},
+        )
+        after_upload = client.get("/api/upload/", headers={**headers, "If-None-Match": etag})
+        assert after_upload.status_code == 200
+        assert len(after_upload.json()) == 2
+
+        etag = after_upload.headers["ETag"]
+        client.delete(f"/api/upload/{upload['id']}", headers=headers)
+        assert client.get("/api/upload/", headers={**headers, "If-None-Match": etag}).status_code == 200
+
+    def test_etag_changes_on_update_and_rebuild(self):
+        import user_stats
+        headers = get_auth_header()
+        db = TestingSessionLocal()
+        user = db.query(models.User).one()
+        db.add(models.Upload(user_id=user.id, filename="legacy.fit", filepath="/tmp/legacy.fit"))
+        db.commit()
+
+        etags = [client.get("/api/upload/", headers=headers).headers["ETag"]]
+        upload = db.query(models.Upload).one()
+        upload.notes = "edited"
+        db.commit()
+        etags.append(client.get("/api/upload/", headers=headers).headers["ETag"])
+        user_stats.rebuild(db)
+        db.commit()
+        db.close()
+        etags.append(client.get("/api/upload/", headers=headers).headers["ETag"])
+        assert len(set(etags)) == 3
+
+    def test_etags_are_per_user(self, tmp_path, monkeypatch):
+        first = get_auth_header()
+        second = get_auth_header("other@example.com")
+        etag = client.get("/api/upload/", headers=first).headers["ETag"]
+        assert client.get("/api/upload/", headers={**second, "If-None-Match": etag}).status_code == 200
+
+
+class TestListSerialization:
+    def test_fast_path_matches_response_model(self):
+        from datetime import datetime, timezone
+        import schemas
+        headers = get_auth_header()
+        db = TestingSessionLocal()
+        user = db.query(models.User).one()
+        upload = models.Upload(
+            user_id=user.id, filename="race.fit", filepath="/tmp/race.fit", content_hash="ab" * 32,
+            upload_date=datetime(2024, 6, 1, 7, 30, tzinfo=timezone.utc),
+            session_type="race", race_name="Zegama", notes="Ünïcode ✓", fatigue_level=4,
+            general_sensation=2, sleep_quality=3, hydration_status="uncertain",
+            weather_condition="fog", trail_condition="muddy",
+        )
+        db.add(upload)
+        db.add(models.Upload(user_id=user.id, filename="bare.fit", filepath="/tmp/bare.fit",
+                             upload_date=datetime(2024, 5, 1)))
+        db.commit()
+        expected = [
+            schemas.UploadResponse.model_validate(u).model_dump(mode="json")
+            for u in db.query(models.Upload).order_by(models.Upload.upload_date.desc())
+        ]
+        db.close()
+
+        response = client.get("/api/upload/", headers=headers)
+        assert response.headers["content-type"] == "application/json"
+        assert response.json() == expected
+
+
+class TestAuthCache:
+    def test_repeated_requests_skip_user_lookup(self):
+        from sqlalchemy import event
+
+        headers = get_auth_header()
+        client.get("/api/upload/", headers=headers)
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            before = USER_CACHE.stats()
+            assert client.get("/api/upload/", headers=headers).status_code == 200
+            after = USER_CACHE.stats()
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+
+        assert after["hits"] == before["hits"] + 1
+        assert not [s for s in statements if "FROM users" in s]
+        assert client.get("/metrics/cache").json()["auth"]["hits"] >= 1
+
+    def test_user_update_invalidates_cache(self):
+        headers = get_auth_header()
+        client.get("/api/upload/", headers=headers)
+        assert len(USER_CACHE) == 1
+
+        db = TestingSessionLocal()
+        user = db.query(models.User).filter(models.User.email == "uploader@example.com").one()
+        user.vo2max = 61.0
+        db.commit()
+        db.close()
+        assert len(USER_CACHE) == 0
+
+    def test_expired_token_is_not_cached(self):
+        from datetime import timedelta
+        from auth import create_access_token
+
+        get_auth_header()
+        token = create_access_token({"sub": "uploader@example.com"}, timedelta(seconds=-1))
+        response = client.get("/api/upload/", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 401
+        assert len(USER_CACHE) == 0
+
+
+class TestPasswordHashing:
+    def test_saturated_hashing_pool_returns_503(self, monkeypatch):
+        import threading
+        import hashing
+        monkeypatch.setattr(hashing, "PASSWORD_HASH_WORKERS", 1)
+        monkeypatch.setattr(hashing, "_pending", threading.BoundedSemaphore(1))
+        hashing._pending.acquire()
+
+        response = client.post(
+            "/api/users/register",
+            json={"email": "busy@example.com", "password": "securepassword123"},
+        )
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+    def test_waiting_login_holds_no_worker_thread(self, monkeypatch):
+        import asyncio
+        from concurrent.futures import Future
+        import anyio.to_thread
+        from fastapi.security import OAuth2PasswordRequestForm
+        import hashing
+        from routers import users
+
+        get_auth_header("waiting@example.com")
+        pending, submitted = Future(), []
+        monkeypatch.setattr(hashing, "PASSWORD_HASH_WORKERS", 1)
+        monkeypatch.setattr(hashing, "_submit", lambda fn, *args: submitted.append(fn) or pending)
+        form = OAuth2PasswordRequestForm(username="waiting@example.com", password="securepassword123")
+
+        async def scenario():
+            db = TestingSessionLocal()
+            login = asyncio.ensure_future(users.login(form, db))
+            while not submitted:
+                await asyncio.sleep(0.01)
+            borrowed = anyio.to_thread.current_default_thread_limiter().borrowed_tokens
+            pending.set_result((True, None))
+            tokens = await login
+            db.close()
+            return borrowed, tokens
+
+        borrowed, tokens = asyncio.run(scenario())
+        assert borrowed == 0
+        assert tokens["access_token"]
+
+    def test_login_rehashes_when_cost_changes(self):
+        from passlib.context import CryptContext
+        import hashing
+
+        old_hash = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=4).hash(
+            "securepassword123"
+        )
+        db = TestingSessionLocal()
+        db.add(models.User(email="legacy@example.com", hashed_password=old_hash))
+        db.commit()
+
+        response = client.post(
+            "/api/users/login",
+            data={"username": "legacy@example.com", "password": "securepassword123"},
+        )
+        assert response.status_code == 200
+
+        db.expire_all()
+        user = db.query(models.User).filter(models.User.email == "legacy@example.com").one()
+        assert user.hashed_password != old_hash
+        assert user.hashed_password.startswith(f"$2b${hashing.BCRYPT_ROUNDS:02d}$")
+        db.close()
+
+
+class TestRefreshTokens:
+    def login(self):
+        client.post(
+            "/api/users/register",
+            json={"email": "refresh@example.com", "password": "securepassword123"},
+        )
+        response = client.post(
+            "/api/users/login",
+            data={"username": "refresh@example.com", "password": "securepassword123"},
+        )
+        return response.json()
+
+    def test_refresh_rotates_without_password_check(self, monkeypatch):
+        import hashing
+        tokens = self.login()
+        assert tokens["refresh_token"]
+
+        async def no_bcrypt(*args):
+            raise AssertionError("refresh must not verify the password")
+
+        monkeypatch.setattr(hashing, "verify_password_async", no_bcrypt)
+        response = client.post("/api/users/refresh", json={"refresh_token": tokens["refresh_token"]})
+        assert response.status_code == 200
+        rotated = response.json()
+        assert rotated["refresh_token"] != tokens["refresh_token"]
+
+        headers = {"Authorization": f"Bearer {rotated['access_token']}"}
+        assert client.get("/api/upload/", headers=headers).status_code == 200
+
+    def test_reusing_rotated_token_revokes_family(self):
+        tokens = self.login()
+        rotated = client.post(
+            "/api/users/refresh", json={"refresh_token": tokens["refresh_token"]}
+        ).json()
+
+        reuse = client.post("/api/users/refresh", json={"refresh_token": tokens["refresh_token"]})
+        assert reuse.status_code == 401
+        response = client.post("/api/users/refresh", json={"refresh_token": rotated["refresh_token"]})
+        assert response.status_code == 401
+
+    def test_logout_revokes_token(self):
+        tokens = self.login()
+        response = client.post("/api/users/logout", json={"refresh_token": tokens["refresh_token"]})
+        assert response.status_code == 204
+        response = client.post("/api/users/refresh", json={"refresh_token": tokens["refresh_token"]})
+        assert response.status_code == 401
+        response = client.post("/api/users/refresh", json={"refresh_token": "unknown"})
+        assert response.status_code == 401
+
+    def test_purge_keeps_live_and_recent_tokens(self):
+        from datetime import datetime, timedelta
+        import auth
+
+        tokens = self.login()
+        rotated = client.post("/api/users/refresh", json={"refresh_token": tokens["refresh_token"]}).json()
+        db = TestingSessionLocal()
+        now = datetime.utcnow()
+        assert auth.purge_refresh_tokens(db, now=now) == 0
+        # Past the retention period the revoked token goes; the live one stays.
+        later = now + timedelta(days=auth.REFRESH_TOKEN_RETENTION_DAYS + 1)
+        assert auth.purge_refresh_tokens(db, now=later) == 1
+        db.commit()
+        db.close()
+        response = client.post("/api/users/refresh", json={"refresh_token": rotated["refresh_token"]})
+        assert response.status_code == 200
+
+        db = TestingSessionLocal()
+        expired = now + timedelta(days=auth.REFRESH_TOKEN_EXPIRE_DAYS + auth.REFRESH_TOKEN_RETENTION_DAYS + 1)
+        assert auth.purge_refresh_tokens(db, now=expired) == 2
+        db.commit()
+        assert db.query(models.RefreshToken).count() == 0
+        db.close()
+
+    def test_purger_runs_on_its_own_thread(self, monkeypatch):
+        import threading
+        import auth
+
+        purged = threading.Event()
+        monkeypatch.setattr(auth, "purge_refresh_tokens", lambda db: purged.set())
+        purger = auth.RefreshTokenPurger(TestingSessionLocal, interval=60)
+        purger.start()
+        try:
+            assert purged.wait(5)
+        finally:
+            purger.stop()
+
+
+class TestAsyncDatabase:
+    def test_async_handlers_match_sync(self, tmp_path):
+        import asyncio
+        from datetime import datetime, timedelta
+        from fastapi.security import OAuth2PasswordRequestForm
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+        import auth
+        import schemas
+        from routers import uploads, users
+
+        path = tmp_path / "async.db"
+        sync_engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(bind=sync_engine)
+        SyncSession = sessionmaker(bind=sync_engine)
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+        form = OAuth2PasswordRequestForm(
+            grant_type=None, username="async@example.com", password="securepassword123",
+            scope="", client_id=None, client_secret=None,
+        )
+
+        async def scenario():
+            async with AsyncSession() as db:
+                created = await users.register_async(
+                    schemas.UserCreate(email="async@example.com", password="securepassword123"), db
+                )
+            async with AsyncSession() as db:
+                tokens = await users.login_async(form, db)
+            async with AsyncSession() as db:
+                identity = await auth.get_current_user_async(tokens["access_token"], db)
+
+            with SyncSession() as db:
+                for i in range(5):
+                    db.add(models.Upload(
+                        user_id=created.id, filename=f"{i}.fit", filepath=f"/tmp/{i}.fit",
+                        upload_date=datetime(2024, 5, 1) + timedelta(days=i),
+                    ))
+                db.commit()
+
+            async with AsyncSession() as db:
+                response = await uploads.list_uploads_async(
+                    0, 3, None, None, identity, db, uploads.UploadFilters()
+                )
+            await async_engine.dispose()
+            return identity, response
+
+        identity, response = asyncio.run(scenario())
+        assert identity.email == "async@example.com"
+
+        with SyncSession() as db:
+            sync_response = uploads.list_uploads(0, 3, None, None, identity, db, uploads.UploadFilters())
+        assert response.body == sync_response.body
+        assert [u["id"] for u in json.loads(response.body)] == [5, 4, 3]
+        assert response.headers["X-Next-Cursor"] == sync_response.headers["X-Next-Cursor"]
+
+
+class TestPoolMetrics:
+    def test_checkout_waits_and_timeouts_are_recorded(self, tmp_path):
+        from sqlalchemy import exc
+        from dbpool import PoolMetrics, TimedQueuePool
+
+        pool_engine = create_engine(
+            f"sqlite:///{tmp_path / 'pool.db'}",
+            poolclass=TimedQueuePool, pool_size=1, max_overflow=1, pool_timeout=0.05,
+        )
+        metrics = PoolMetrics("test-pool", pool_engine)
+        first = pool_engine.connect()
+        second = pool_engine.connect()
+        stats = metrics.stats()
+        assert stats["checked_out"] == 2
+        assert stats["overflow"] == 1
+        with pytest.raises(exc.TimeoutError):
+            pool_engine.connect()
+        first.close()
+        second.close()
+
+        stats = metrics.stats()
+        assert stats["checked_out"] == 0
+        assert stats["peak_overflow"] == 1
+        assert stats["timeouts"] == 1
+        assert stats["wait_seconds_max"] >= 0.05
+        assert client.get("/metrics/db").json()["test-pool"]["timeouts"] == 1
+
+
+class TestTelemetry:
+    @staticmethod
+    def sample(text, prefix):
+        for line in text.splitlines():
+            if line.startswith(prefix + " "):
+                return float(line.rsplit(" ", 1)[1])
+        return 0.0
+
+    def test_requests_are_counted_by_route_template(self):
+        headers = get_auth_header()
+        counter = 'http_requests_total{method="GET",route="/api/upload/{upload_id}/status",status="404"}'
+        before = self.sample(client.get("/metrics").text, counter)
+        client.get("/api/upload/12345/status", headers=headers)
+        client.get("/api/upload/67890/status", headers=headers)
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        assert self.sample(response.text, counter) == before + 2
+        assert "# TYPE http_request_duration_seconds histogram" in response.text
+        assert 'cache_hits_total{cache="auth"}' in response.text
+
+    def test_unmatched_paths_share_one_label(self):
+        client.get("/no/such/path")
+        assert 'route="<unmatched>",status="404"' in client.get("/metrics").text
+
+    def test_db_statements_and_request_bytes_are_recorded(self, tmp_path, monkeypatch):
+        import routers.uploads
+        monkeypatch.setattr(routers.uploads, "UPLOAD_DIR", str(tmp_path))
+        headers = get_auth_header()
+        route = 'method="POST",route="/api/upload/"'
+        body = client.get("/metrics").text
+        bytes_before = self.sample(body, f"http_request_body_bytes_total{{{route}}}")
+        statements_before = self.sample(body, f"http_request_db_statements_sum{{{route}}}")
+
+        response = client.post(
+            "/api/upload/",
+            headers=headers,
+            files={"file": ("ride.fit", b"x" * 5000, "application/octet-stream")},
+        )
+        assert response.status_code == 201
+
+        body = client.get("/metrics").text
+        assert self.sample(body, f"http_request_body_bytes_total{{{route}}}") > bytes_before + 5000
+        assert self.sample(body, f"http_request_db_statements_sum{{{route}}}") > statements_before
+
+    def test_failed_statements_are_recorded(self):
+        from sqlalchemy import exc
+        import telemetry
+
+        before = self.sample(telemetry.render(), "db_background_statements_total")
+        with engine.connect() as connection:
+            for _ in range(3):
+                with pytest.raises(exc.OperationalError):
+                    connection.exec_driver_sql("SELECT * FROM no_such_table")
+                connection.rollback()
+            assert connection.info.get("telemetry_start") == []
+        assert self.sample(telemetry.render(), "db_background_statements_total") == before + 3
+
+    def test_metrics_token(self, monkeypatch):
+        from routers import metrics
+
+        monkeypatch.setattr(metrics, "METRICS_TOKEN", "scrape-secret")
+        for path in ("/metrics", "/metrics/db", "/metrics/cache"):
+            assert client.get(path).status_code == 401
+            wrong = client.get(path, headers={"Authorization": "Bearer nope"})
+            assert wrong.status_code == 401
+            right = client.get(path, headers={"Authorization": "Bearer scrape-secret"})
+            assert right.status_code == 200
+
+    def test_server_timing_header(self):
+        from fastapi import FastAPI
+        from responses import TimedJSONResponse
+        from telemetry import MetricsMiddleware
+
+        timed = FastAPI(default_response_class=TimedJSONResponse)
+
+        @timed.get("/ping")
+        def ping():
+            return {"ok": True}
+
+        timed.add_middleware(MetricsMiddleware, server_timing=True)
+        response = TestClient(timed).get("/ping")
+        assert response.json() == {"ok": True}
+        metrics = [part.split(";")[0] for part in response.headers["server-timing"].split(", ")]
+        assert metrics == ["db", "serialize", "total"]
+        assert "server-timing" not in client.get("/health").headers
+
+
+class TestMigrations:
+    def test_upgrade_creates_schema_once(self, tmp_path):
+        import migrations
+
+        fresh = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+        assert migrations.upgrade(fresh) == [m.version for m in migrations.MIGRATIONS]
+        assert migrations.upgrade(fresh) == []
+        with fresh.connect() as connection:
+            assert migrations.current_version(connection) == migrations.head()
+            tables = set(inspect(connection).get_table_names())
+        assert {"users", "uploads", "user_stats", "schema_version"} <= tables
+
+    def test_upgrade_brings_legacy_database_up_to_date(self, tmp_path):
+        import migrations
+
+        legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+        with legacy.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE uploads (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+                "filename VARCHAR NOT NULL, filepath VARCHAR NOT NULL, upload_date DATETIME, "
+                "session_type VARCHAR, race_name VARCHAR, notes VARCHAR, fatigue_level INTEGER, "
+                "general_sensation INTEGER, sleep_quality INTEGER, hydration_status VARCHAR, "
+                "weather_condition VARCHAR, trail_condition VARCHAR)"
+            ))
+            connection.execute(text(
+                "INSERT INTO uploads (user_id, filename, filepath, notes, upload_date, session_type) "
+                "VALUES (1, 'old.fit', '/tmp/old.fit', 'Legs cramped at km 30', "
+                "'2024-03-05 08:00:00', 'race')"
+            ))
+        migrations.upgrade(legacy)
+        with legacy.connect() as connection:
+            columns = {c["name"] for c in inspect(connection).get_columns("uploads")}
+            indexes = {i["name"] for i in inspect(connection).get_indexes("uploads")}
+            found = connection.execute(
+                text("SELECT rowid FROM uploads_fts WHERE uploads_fts MATCH 'cramp*'")
+            ).all()
+        assert "content_hash" in columns
+        assert "ix_uploads_user_id_upload_date_id" in indexes
+        assert "ix_uploads_user_id_trail_upload_date_id" in indexes
+        assert len(found) == 1
+
+        # Uploads from before the statistics are counted, so deleting one
+        # brings the counts to zero rather than below.
+        import user_stats
+        from sqlalchemy.orm import Session
+        with Session(legacy) as db:
+            stats = db.get(models.UserStats, 1)
+            assert (stats.upload_count, stats.race_count) == (1, 1)
+            upload = db.get(models.Upload, 1)
+            user_stats.record(db, [upload], sign=-1)
+            db.delete(upload)
+            db.commit()
+            db.expire_all()
+            assert (stats.upload_count, stats.race_count) == (0, 0)
+            week = db.scalars(select(models.UserWeeklyStats)).one()
+            assert week.upload_count == 0
+
+    def test_startup_check_is_one_query_when_current(self, tmp_path):
+        from sqlalchemy import event
+        import migrations
+
+        current = create_engine(f"sqlite:///{tmp_path / 'current.db'}")
+        migrations.upgrade(current)
+        statements = []
+        event.listen(current, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        migrations.ensure_current(current, migrate=False)
+        assert len(statements) == 1
+
+    def test_startup_check_refuses_outdated_schema(self, tmp_path):
+        import migrations
+
+        outdated = create_engine(f"sqlite:///{tmp_path / 'outdated.db'}")
+        migrations.upgrade(outdated, target=1)
+        with pytest.raises(migrations.SchemaOutOfDate):
+            migrations.ensure_current(outdated, migrate=False)
+        migrations.ensure_current(outdated, migrate=True)
+        with outdated.connect() as connection:
+            assert migrations.current_version(connection) == migrations.head()
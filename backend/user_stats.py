@@ -0,0 +1,278 @@
+"""Incrementally maintained per-user upload statistics.
+
+Routes that create or delete uploads call ``record`` in the same
+transaction, which adds each upload's contribution to the user's
+``UserStats`` row and to the ``UserWeeklyStats`` bucket for its week, so
+reading a summary never scans ``uploads``. ``rebuild`` recomputes the
+tables from scratch.
+
+``UserStats.uploads_version`` is bumped by the same writes, and by ORM
+updates of an upload, giving each user's upload list a cheap version.
+"""
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable, Optional
+
+from sqlalchemy import delete, event, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import models
+
+AGGREGATES = [
+    "upload_count",
+    "race_count",
+    "training_count",
+    "recovery_count",
+    "fatigue_sum",
+    "fatigue_count",
+    "sensation_sum",
+    "sensation_count",
+    "sleep_sum",
+    "sleep_count",
+]
+
+_SCORES = [
+    ("fatigue", "fatigue_level"),
+    ("sensation", "general_sensation"),
+    ("sleep", "sleep_quality"),
+]
+
+
+def week_start(moment: datetime) -> date:
+    """The Monday (UTC) of the week containing ``moment``."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    day = moment.date()
+    return day - timedelta(days=day.weekday())
+
+
+def contribution(upload) -> dict[str, int]:
+    """What one upload adds to each aggregate."""
+    values = {"upload_count": 1}
+    if upload.session_type is not None:
+        session_type = getattr(upload.session_type, "value", upload.session_type)
+        values[f"{session_type}_count"] = 1
+    for name, attribute in _SCORES:
+        score = getattr(upload, attribute)
+        if score is not None:
+            values[f"{name}_sum"] = score
+            values[f"{name}_count"] = 1
+    return values
+
+
+def _totals(uploads: Iterable, sign: int = 1):
+    users: dict[int, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    weeks: dict[tuple[int, date], dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for upload in uploads:
+        week = (upload.user_id, week_start(upload.upload_date))
+        for key, value in contribution(upload).items():
+            users[upload.user_id][key] += sign * value
+            weeks[week][key] += sign * value
+    return users, weeks
+
+
+def record(db: Session, uploads: Iterable, sign: int = 1) -> None:
+    """Add (or with ``sign=-1`` remove) uploads' contributions.
+
+    ``uploads`` must have been flushed so ``upload_date`` is set. Updates
+    are atomic increments, so concurrent requests never lose counts. The
+    caller commits ``db``.
+    """
+    users, weeks = _totals(uploads, sign)
+    for user_id, deltas in users.items():
+        deltas["uploads_version"] = 1
+        # The user row is always upserted so the version moves even for
+        # uploads made before statistics were kept.
+        initial = deltas if sign > 0 else {"uploads_version": 1}
+        _increment(db, models.UserStats, {"user_id": user_id}, deltas, initial)
+    for (user_id, week), deltas in weeks.items():
+        _increment(
+            db,
+            models.UserWeeklyStats,
+            {"user_id": user_id, "week_start": week},
+            deltas,
+            deltas if sign > 0 else None,
+        )
+
+
+def bump_uploads_version(db: Session, user_ids: Iterable[int]) -> None:
+    """Move the upload list version of users whose uploads were changed in bulk.
+
+    ORM updates of an upload do this by themselves; Core updates, which
+    bypass the ORM events, must call it. The caller commits ``db``.
+    """
+    bump = {"uploads_version": 1}
+    for user_id in set(user_ids):
+        _increment(db, models.UserStats, {"user_id": user_id}, bump, bump)
+
+
+def _increment(db: Session, model, key: dict, deltas: dict, initial: Optional[dict]) -> None:
+    """Add ``deltas`` to the row at ``key``, inserting ``initial`` if it is missing.
+
+    Without ``initial`` a missing row is left alone.
+    """
+    if initial is None:
+        db.execute(
+            update(model)
+            .where(*(getattr(model, column) == value for column, value in key.items()))
+            .values({column: getattr(model, column) + delta for column, delta in deltas.items()})
+        )
+        return
+    db.execute(_upsert(db.get_bind().dialect.name, model, key, deltas, initial))
+
+
+def _upsert(dialect: str, model, key: dict, deltas: dict, initial: dict):
+    insert_ = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}[dialect]
+    statement = insert_(model).values({**dict.fromkeys(AGGREGATES, 0), **initial, **key})
+    return statement.on_conflict_do_update(
+        index_elements=list(key),
+        set_={column: getattr(model, column) + delta for column, delta in deltas.items()},
+    )
+
+
+def rebuild(db: Session, user_id: Optional[int] = None, batch_size: int = 1000) -> int:
+    """Recompute the statistics of one user, or everyone, from ``uploads``.
+
+    Returns the number of uploads counted. The caller commits ``db``.
+    """
+    filters = [] if user_id is None else [models.Upload.user_id == user_id]
+    # Versions carry on from the old rows so no earlier ETag is reissued.
+    versions = dict(db.execute(
+        select(models.UserStats.user_id, models.UserStats.uploads_version).where(
+            *([] if user_id is None else [models.UserStats.user_id == user_id])
+        )
+    ).all())
+    for model in (models.UserStats, models.UserWeeklyStats):
+        condition = [] if user_id is None else [model.user_id == user_id]
+        db.execute(delete(model).where(*condition))
+
+    rows = db.execute(
+        select(
+            models.Upload.user_id,
+            models.Upload.upload_date,
+            models.Upload.session_type,
+            models.Upload.fatigue_level,
+            models.Upload.general_sensation,
+            models.Upload.sleep_quality,
+        )
+        .where(*filters)
+        .execution_options(yield_per=batch_size)
+    )
+    counted = 0
+
+    def counting():
+        nonlocal counted
+        for row in rows:
+            counted += 1
+            yield row
+
+    users, weeks = _totals(counting())
+    for uid in versions:
+        users.setdefault(uid, {})
+    if users:
+        db.execute(insert(models.UserStats), [
+            {
+                **dict.fromkeys(AGGREGATES, 0),
+                **totals,
+                "user_id": uid,
+                "uploads_version": versions.get(uid, 0) + 1,
+            }
+            for uid, totals in users.items()
+        ])
+    if weeks:
+        db.execute(insert(models.UserWeeklyStats), [
+            {**dict.fromkeys(AGGREGATES, 0), **totals, "user_id": uid, "week_start": week}
+            for (uid, week), totals in weeks.items()
+        ])
+    return counted
+
+
+def uploads_version(db: Session, user_id: int) -> int:
+    return db.scalar(
+        select(models.UserStats.uploads_version).where(models.UserStats.user_id == user_id)
+    ) or 0
+
+
+async def uploads_version_async(db, user_id: int) -> int:
+    return await db.scalar(
+        select(models.UserStats.uploads_version).where(models.UserStats.user_id == user_id)
+    ) or 0
+
+
+@event.listens_for(models.Upload, "after_update")
+def _bump_uploads_version(mapper, connection, target):
+    # Metadata edits don't change the aggregates but do change the list.
+    bump = {"uploads_version": 1}
+    connection.execute(
+        _upsert(connection.dialect.name, models.UserStats, {"user_id": target.user_id}, bump, bump)
+    )
+
+
+def _aggregates(row) -> dict[str, int]:
+    return {column: getattr(row, column) if row is not None else 0 for column in AGGREGATES}
+
+
+def _summary(totals: dict[str, int]) -> dict:
+    def average(name: str) -> Optional[float]:
+        count = totals[f"{name}_count"]
+        return round(totals[f"{name}_sum"] / count, 2) if count else None
+
+    return {
+        "uploads": totals["upload_count"],
+        "by_session_type": {
+            session_type.value: totals[f"{session_type.value}_count"]
+            for session_type in models.SessionTypeEnum
+        },
+        "avg_fatigue": average("fatigue"),
+        "avg_sensation": average("sensation"),
+        "avg_sleep_quality": average("sleep"),
+    }
+
+
+def summary(db: Session, user_id: int, weeks: int = 12, today: Optional[date] = None) -> dict:
+    """A user's totals, the last 30 days and the most recent weeks.
+
+    Reads one ``user_stats`` row and at most ``weeks`` weekly buckets by
+    primary key, whatever the number of uploads. The last 30 days, today
+    included, are summed from the buckets of the weeks wholly inside them;
+    for the week they start in, which buckets can't split, the few uploads
+    from the window's first day to that week's end are read instead.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    current_week = today - timedelta(days=today.weekday())
+    window_start = today - timedelta(days=29)
+    edge_week = window_start - timedelta(days=window_start.weekday())
+    first_whole_week = edge_week if edge_week == window_start else edge_week + timedelta(weeks=1)
+    oldest = min(current_week - timedelta(weeks=weeks - 1), first_whole_week)
+    buckets = db.scalars(
+        select(models.UserWeeklyStats)
+        .where(
+            models.UserWeeklyStats.user_id == user_id,
+            models.UserWeeklyStats.week_start >= oldest,
+        )
+        .order_by(models.UserWeeklyStats.week_start.desc())
+    ).all()
+    recent = [_aggregates(b) for b in buckets if b.week_start >= first_whole_week]
+    if first_whole_week > window_start:
+        edge, _ = _totals(db.scalars(
+            select(models.Upload).where(
+                models.Upload.user_id == user_id,
+                models.Upload.upload_date >= _utc_midnight(window_start),
+                models.Upload.upload_date < _utc_midnight(first_whole_week),
+            )
+        ))
+        recent.append(_aggregates(None) | edge.get(user_id, {}))
+    return {
+        "total": _summary(_aggregates(db.get(models.UserStats, user_id))),
+        "last_30_days": _summary({column: sum(r[column] for r in recent) for column in AGGREGATES}),
+        "weeks": [
+            {"week_start": b.week_start, **_summary(_aggregates(b))}
+            for b in buckets
+            if b.week_start > current_week - timedelta(weeks=weeks)
+        ],
+    }
+
+
+def _utc_midnight(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)